@@ -1,27 +1,67 @@
 import asyncio
 import logging
+import logging.handlers
+import sys
 import sqlite3
 import os
 import json
+import re
+import threading
+import traceback
+import contextvars
+import time
+import hashlib
+import html
+import queue
+import heapq
+import functools
+import inspect
+from bisect import bisect_left
+import tempfile
+from contextlib import contextmanager
+from types import MappingProxyType
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from aiogram import Bot, Dispatcher, Router, F
+from aiohttp import web
+from pydantic import ValidationError
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
     WebAppInfo, ReplyKeyboardMarkup, KeyboardButton,
-    ReplyKeyboardRemove, PhotoSize, Document
+    ReplyKeyboardRemove, PhotoSize, Document, Update
 )
 from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError,
+    TelegramForbiddenError, TelegramBadRequest
+)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 
 # =================== КОНФИГУРАЦИЯ ===================
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8381986284:AAHhJWbm3b0dAep7lpIw2porfmQEt2-vvw0")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "7725796090"))
 WEBAPP_URL = os.getenv("WEBAPP_URL", "https://artureooe.github.io/Jsjjeje/")
+# Свой адрес Bot API (локальный сервер или фейк для тестов), по умолчанию — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# Режим получения апдейтов: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес бота, без пути
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# По умолчанию секрет выводится из токена, чтобы все экземпляры бота совпадали
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
 
-# Начальные цены (полностью по сайту)
+# Начальные цены (полностью по сайту); текущие цены — в price_catalog
 PRICES = {
     "star_rate": 1.45,      # ₽ за звезду
     "ton_rate": 149.0,      # ₽ за TON (было 167, исправлено на 149 как на сайте)
@@ -42,18 +82,454 @@ CRYPTO_BOT_LINKS = {
 # BEP20 кошелек (по сайту)
 BEP20_WALLET = "0x798236f6980A595FE823b595d71816Dc713fAFdE"
 
+# База данных: один писатель + пул читателей в режиме WAL
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.expanduser('~'), 'art_stars_full.db'))
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_PRAGMAS = {
+    "synchronous": os.getenv("DB_SYNCHRONOUS", "FULL"),       # FULL — коммит подтверждается только после fsync
+    "cache_size": int(os.getenv("DB_CACHE_SIZE", "-16000")),  # отрицательное значение — в КиБ
+    "mmap_size": int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024))),
+    "busy_timeout": int(os.getenv("DB_BUSY_TIMEOUT", "5000")),  # мс
+}
+
 # =================== БАЗА ДАННЫХ ===================
+def _counter_sql(name, delta, condition="1"):
+    # UPSERT счётчика внутри триггера; WHERE нужен, чтобы ON CONFLICT не спутался с JOIN
+    return (f"INSERT INTO stats_counters (name, value) SELECT {name}, {delta} WHERE {condition} "
+            f"ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;")
+
+def _trigger_sql(name, event, *statements):
+    return f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} BEGIN {' '.join(statements)} END"
+
+# Триггеры держат stats_counters в актуальном состоянии при любой записи
+STATS_TRIGGERS = [
+    _trigger_sql('trg_stats_users_insert', 'INSERT ON users', _counter_sql("'users'", "1")),
+    _trigger_sql('trg_stats_users_delete', 'DELETE ON users', _counter_sql("'users'", "-1")),
+    _trigger_sql(
+        'trg_stats_orders_insert', 'INSERT ON orders',
+        _counter_sql("'orders'", "1"),
+        _counter_sql("'pending_orders'", "1", "NEW.status = 'pending'"),
+        _counter_sql("'revenue_' || COALESCE(NEW.currency, '')", "COALESCE(NEW.total, 0)",
+                     "NEW.status = 'completed'")
+    ),
+    _trigger_sql(
+        'trg_stats_orders_update', 'UPDATE OF status, total, currency ON orders',
+        _counter_sql("'pending_orders'", "(NEW.status = 'pending') - (OLD.status = 'pending')",
+                     "NEW.status IS NOT OLD.status"),
+        _counter_sql("'revenue_' || COALESCE(OLD.currency, '')", "-COALESCE(OLD.total, 0)",
+                     "OLD.status = 'completed'"),
+        _counter_sql("'revenue_' || COALESCE(NEW.currency, '')", "COALESCE(NEW.total, 0)",
+                     "NEW.status = 'completed'")
+    ),
+    _trigger_sql(
+        'trg_stats_orders_delete', 'DELETE ON orders',
+        _counter_sql("'orders'", "-1"),
+        _counter_sql("'pending_orders'", "-1", "OLD.status = 'pending'"),
+        _counter_sql("'revenue_' || COALESCE(OLD.currency, '')", "-COALESCE(OLD.total, 0)",
+                     "OLD.status = 'completed'")
+    ),
+    _trigger_sql('trg_stats_tickets_insert', 'INSERT ON support_tickets',
+                 _counter_sql("'new_tickets'", "1", "NEW.status = 'new'")),
+    _trigger_sql('trg_stats_tickets_update', 'UPDATE OF status ON support_tickets',
+                 _counter_sql("'new_tickets'", "(NEW.status = 'new') - (OLD.status = 'new')",
+                              "NEW.status IS NOT OLD.status")),
+    _trigger_sql('trg_stats_tickets_delete', 'DELETE ON support_tickets',
+                 _counter_sql("'new_tickets'", "-1", "OLD.status = 'new'")),
+    _trigger_sql('trg_stats_admins_insert', 'INSERT ON support_admins',
+                 _counter_sql("'admins_level_' || NEW.admin_level", "1")),
+    _trigger_sql(
+        'trg_stats_admins_update', 'UPDATE OF admin_level ON support_admins',
+        _counter_sql("'admins_level_' || OLD.admin_level", "-1", "NEW.admin_level IS NOT OLD.admin_level"),
+        _counter_sql("'admins_level_' || NEW.admin_level", "1", "NEW.admin_level IS NOT OLD.admin_level")
+    ),
+    _trigger_sql('trg_stats_admins_delete', 'DELETE ON support_admins',
+                 _counter_sql("'admins_level_' || OLD.admin_level", "-1")),
+]
+
+# =================== КАТАЛОГ ЦЕН ===================
+# Ключи из админки (callback price_star / price_ton) -> ключи каталога
+PRICE_KEY_ALIASES = {"star": "star_rate", "ton": "ton_rate"}
+
+class PriceSnapshot:
+    """Неизменяемый срез цен вместе с версией каталога, по которой они действуют"""
+    __slots__ = ('version', '_prices')
+    
+    def __init__(self, version, prices):
+        self.version = version
+        self._prices = MappingProxyType(dict(prices))
+    
+    def __getitem__(self, key):
+        return self._prices[key]
+    
+    def get(self, key, default=None):
+        return self._prices.get(key, default)
+    
+    def as_dict(self):
+        return dict(self._prices)
+    
+    # Срезы одной версии равны: по срезу кэшируются тексты и клавиатуры с ценами (render_cache)
+    def __eq__(self, other):
+        return isinstance(other, PriceSnapshot) and self.version == other.version
+    
+    def __hash__(self):
+        return hash(self.version)
+
+class PriceCatalog:
+    """Текущие цены бота. Хендлер берёт один срез (snapshot) и считает всё по нему без запросов к БД.
+
+    Обновление собирает новый срез и подменяет ссылку целиком, старый срез не меняется.
+    """
+    def __init__(self, defaults):
+        self.defaults = MappingProxyType(dict(defaults))
+        self.snapshot = PriceSnapshot(0, defaults)
+    
+    def resolve_key(self, key):
+        key = PRICE_KEY_ALIASES.get(key, key)
+        if key not in self.defaults:
+            raise KeyError(f"неизвестная цена: {key}")
+        return key
+    
+    def install(self, version, prices):
+        """Ставит срез версии version; более старые версии (запоздавшее чтение) игнорируются"""
+        if version < self.snapshot.version:
+            return False
+        merged = dict(self.defaults)
+        for key, value in prices.items():
+            if key in merged:
+                try:
+                    merged[key] = float(value)
+                except (TypeError, ValueError):
+                    merged[key] = value
+        self.snapshot = PriceSnapshot(version, merged)
+        return True
+
+price_catalog = PriceCatalog(PRICES)
+
+# =================== ПРОФИЛИРОВАНИЕ SQL ===================
+# SQL_PROFILE=1 включает учёт каждого запроса Database; запросы дольше SQL_SLOW_MS пишутся в slow log
+SQL_PROFILE = os.getenv("SQL_PROFILE", "0") == "1"
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50"))
+SQL_SLOW_LOG = os.getenv("SQL_SLOW_LOG", os.path.splitext(DB_PATH)[0] + "_slow.log")
+SQL_SLOW_LOG_BYTES = int(os.getenv("SQL_SLOW_LOG_BYTES", str(5 * 1024 * 1024)))
+SQL_SLOW_LOG_BACKUPS = int(os.getenv("SQL_SLOW_LOG_BACKUPS", "3"))
+
+# Какой хендлер сейчас выполняется — ставит MetricsMiddleware, в поток БД переносится с контекстом
+current_handler = contextvars.ContextVar("current_handler", default="background")
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+def sql_fingerprint(sql):
+    """Запрос без литералов и лишних пробелов — одинаковые по форме запросы складываются вместе"""
+    return " ".join(_SQL_LITERALS.sub("?", sql).split())
+
+class SqlProfiler:
+    """Сводка по запросам (fingerprint -> количество, время, строки) и slow log с ротацией"""
+    def __init__(self, slow_ms=SQL_SLOW_MS, slow_log=SQL_SLOW_LOG):
+        self.slow_seconds = slow_ms / 1000
+        self.slow_log_path = slow_log
+        self._stats = {}  # fingerprint -> [вызовы, сумма секунд, максимум секунд, строки]
+        self._lock = threading.Lock()  # пишут потоки читателей и писателя
+        self._slow_log = None
+    
+    def record(self, sql, param_count, rows, seconds):
+        fingerprint = sql_fingerprint(sql)
+        with self._lock:
+            entry = self._stats.get(fingerprint)
+            if entry is None:
+                entry = self._stats[fingerprint] = [0, 0.0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            entry[3] += max(rows, 0)
+        if seconds >= self.slow_seconds:
+            self._write_slow(fingerprint, param_count, rows, seconds)
+    
+    def _write_slow(self, fingerprint, param_count, rows, seconds):
+        if self._slow_log is None:
+            handler = logging.handlers.RotatingFileHandler(
+                self.slow_log_path, maxBytes=SQL_SLOW_LOG_BYTES, backupCount=SQL_SLOW_LOG_BACKUPS, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("art_stars.slow_sql")
+            logger.propagate = False
+            logger.addHandler(handler)
+            self._slow_log = logger
+        self._slow_log.warning(json.dumps({
+            "ts": round(time.time(), 3), "ms": round(seconds * 1000, 2), "sql": fingerprint,
+            "params": param_count, "rows": rows, "handler": current_handler.get()
+        }, ensure_ascii=False))
+    
+    def top(self, limit=10):
+        """[(fingerprint, вызовы, сумма с, среднее мс, максимум мс, строки)] по суммарному времени"""
+        with self._lock:
+            items = [(fp, calls, total, total / calls * 1000, longest * 1000, rows)
+                     for fp, (calls, total, longest, rows) in self._stats.items()]
+        return sorted(items, key=lambda item: item[2], reverse=True)[:limit]
+    
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+sql_profiler = SqlProfiler()
+
+def read_slow_log(path=SQL_SLOW_LOG, limit=10):
+    """Топ запросов из slow log и его ротированных копий: [(fingerprint, вызовы, сумма мс, максимум мс)]"""
+    totals = {}
+    for candidate in [path] + [f"{path}.{i}" for i in range(1, SQL_SLOW_LOG_BACKUPS + 1)]:
+        if not os.path.exists(candidate):
+            continue
+        with open(candidate, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                entry = totals.setdefault(record["sql"], [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += record["ms"]
+                entry[2] = max(entry[2], record["ms"])
+    items = [(fp, calls, total, longest) for fp, (calls, total, longest) in totals.items()]
+    return sorted(items, key=lambda item: item[2], reverse=True)[:limit]
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Курсор, который отдаёт в sql_profiler время выполнения и выборки каждого запроса.
+
+    Строки SELECT считаются при каждой выборке (fetchone/fetchmany/fetchall и обход циклом for),
+    а запрос учитывается, когда строки кончились или курсор перешёл к следующему запросу,
+    закрыт или удалён. Остальные запросы учитываются сразу после execute.
+    """
+    _pending = None  # [sql, число параметров, строки, секунды] запроса, строки которого ещё выбираются
+    
+    def _start(self, sql, param_count, seconds):
+        self._finish()
+        self._pending = [sql, param_count, 0, seconds]
+        if self.description is None:
+            self._pending[2] = self.rowcount
+            self._finish()
+    
+    def _finish(self):
+        if self._pending is not None:
+            sql_profiler.record(*self._pending)
+            self._pending = None
+    
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._start(sql, len(parameters), time.perf_counter() - start)
+    
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._start(sql, len(seq_of_parameters[0]) if seq_of_parameters else 0,
+                        time.perf_counter() - start)
+    
+    def _fetched(self, rows, seconds, exhausted):
+        if self._pending is not None:
+            self._pending[2] += rows
+            self._pending[3] += seconds
+            if exhausted:
+                self._finish()
+    
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(row is not None, time.perf_counter() - start, row is None)
+        return row
+    
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(len(rows), time.perf_counter() - start, len(rows) < size)
+        return rows
+    
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), time.perf_counter() - start, True)
+        return rows
+    
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(0, time.perf_counter() - start, True)
+            raise
+        self._fetched(1, time.perf_counter() - start, False)
+        return row
+    
+    def close(self):
+        self._finish()
+        super().close()
+    
+    def __del__(self):
+        # Запрос, строки которого выбрали не до конца (обычно один fetchone), учитываем при удалении курсора
+        self._finish()
+
+class ProfilingConnection(sqlite3.Connection):
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+    
+    # Connection.execute создаёт обычный курсор в обход cursor() — направляем через профилирующий
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Колонки заказа в постоянном порядке — хендлеры читают поля по индексу, а в базах,
+# доведённых миграциями через ALTER TABLE, порядок колонок в o.* другой
+ORDER_COLUMNS = (
+    'id', 'user_id', 'product', 'quantity', 'total', 'currency', 'username', 'payment_method',
+    'crypto_bot_link', 'bep20_wallet', 'screenshot', 'status', 'admin_comment', 'completed_by',
+    'created_at', 'updated_at', 'price_version', 'version'
+)
+ORDER_SELECT = ', '.join(f'o.{column}' for column in ORDER_COLUMNS)
+
+class ConnectionPool:
+    """Одно соединение на запись и несколько read-only соединений к одной базе в режиме WAL.
+
+    В WAL читатели не блокируют писателя и видят последнее закоммиченное состояние.
+    """
+    def __init__(self, path, readers=DB_READERS, pragmas=None):
+        self.path = path
+        self.pragmas = dict(DB_PRAGMAS if pragmas is None else pragmas)
+        self.writer = self._connect()
+        self.writer.execute('PRAGMA journal_mode = WAL')
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect(readonly=True))
+        self.size = readers
+    
+    def _connect(self, readonly=False):
+        factory = ProfilingConnection if SQL_PROFILE else sqlite3.Connection
+        if readonly:
+            conn = sqlite3.connect(f"file:{quote(self.path)}?mode=ro", uri=True, check_same_thread=False,
+                                   factory=factory)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False, factory=factory)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+    
+    @contextmanager
+    def reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+    
+    def close(self):
+        for _ in range(self.size):
+            self._readers.get().close()
+        self.writer.close()
+
 class Database:
-    def __init__(self):
-        db_path = os.path.join(os.path.expanduser('~'), 'art_stars_full.db')
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.create_tables()
+    # Методы, которые меняют данные: в боте они идут через групповой коммит (GroupCommitWriter)
+    WRITE_METHODS = frozenset({
+        'update_price', 'add_user', 'add_support_admin', 'update_admin_level', 'remove_support_admin',
+        'create_support_ticket', 'transition_ticket', 'add_ticket_reply', 'escalate_stale_tickets',
+        'set_admin_shift', 'fire_timers',
+        'bulk_transition_tickets', 'create_order', 'transition_order', 'bulk_transition_orders',
+        'set_order_comment', 'enqueue_notification', 'complete_outbox',
+        'save_fsm_records', 'expire_fsm_records', 'rebuild_stats', 'run_backfill_batch'
+    })
+    
+    def __init__(self, db_path=DB_PATH, readers=DB_READERS):
+        self.pool = ConnectionPool(db_path, readers)
+        # Все записи идут через единственное соединение-писатель
+        self.conn = self.pool.writer
+        self._in_batch = False
+        self._commit_hooks = []
+        # Кэш уровней админов: {user_id: admin_level}, словарь заменяется целиком, а не изменяется
+        self._admin_levels = None
+        self._admin_cache_version = None
+        self.migrate()
         self.load_prices()
-        print(f"📦 База данных: {db_path}")
+        self.load_admin_levels()
+        self.ensure_main_admin()
+        print(f"📦 База данных: {db_path} (WAL, читателей: {readers})")
+    
+    # ---------- Миграции схемы ----------
+    # (версия, описание, метод). Текущая версия хранится в PRAGMA user_version базы.
+    # Новая миграция добавляется в конец со следующим номером; уже применённые не меняются.
+    MIGRATIONS = (
+        (1, 'базовые таблицы', '_migration_base_schema'),
+        (2, 'недостающие колонки старых баз', '_migration_legacy_columns'),
+        (3, 'счётчики статистики', '_migration_stats_counters'),
+        (4, 'составные и покрывающие индексы', '_migration_indexes'),
+        (5, 'история цен и версия цен в заказах', '_migration_price_history'),
+        (6, 'полнотекстовый поиск по заявкам', '_migration_ticket_search'),
+        (7, 'версии строк заказов и заявок', '_migration_row_versions'),
+        (8, 'смены админов и маршрутизация заявок', '_migration_ticket_routing'),
+        (9, 'сроки таймеров заказов и заявок', '_migration_timers'),
+    )
     
-    def create_tables(self):
-        cursor = self.conn.cursor()
+    # Фоновые донастройки данных: имя -> (таблица, SET, условие строки).
+    # Миграция только ставит задачу в schema_backfills, данные правятся пачками уже после запуска бота.
+    BACKFILLS = {
+        'orders_updated_at': ('orders', 'updated_at = created_at', 'updated_at IS NULL'),
+    }
+    
+    # Колонки, которых может не быть в базах от старых версий бота: таблица -> [(колонка, тип)]
+    LEGACY_COLUMNS = {
+        'orders': [
+            ('currency', 'TEXT'), ('username', 'TEXT'), ('payment_method', 'TEXT'),
+            ('crypto_bot_link', 'TEXT'), ('bep20_wallet', 'TEXT'), ('screenshot', 'TEXT'),
+            ('status', "TEXT DEFAULT 'pending'"), ('admin_comment', 'TEXT'),
+            ('completed_by', 'INTEGER'), ('updated_at', 'TIMESTAMP'),
+        ],
+        'support_admins': [('admin_level', 'INTEGER DEFAULT 1'), ('added_at', 'TIMESTAMP')],
+    }
+    
+    def migrate(self):
+        """Применяет недостающие миграции, каждую в своей транзакции.
+
+        Если схема актуальна, это одно чтение PRAGMA user_version — запуск не зависит от размера базы.
+        """
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        latest = self.MIGRATIONS[-1][0]
+        if version > latest:
+            logging.warning(f"Схема БД версии {version} новее кода ({latest}), миграции пропущены")
+            return 0
+        
+        applied = 0
+        for number, description, method in self.MIGRATIONS:
+            if number <= version:
+                continue
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            # Версию перечитываем под блокировкой записи: параллельно стартовавший процесс
+            # мог уже применить эту миграцию, пока мы ждали BEGIN IMMEDIATE
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            if number <= version:
+                self.conn.rollback()
+                continue
+            try:
+                getattr(self, method)(cursor)
+                cursor.execute(f'PRAGMA user_version = {number}')
+            except Exception:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+            applied += 1
+            print(f"🔧 Миграция {number}: {description}")
         
+        print(f"✅ Схема БД: версия {latest}")
+        return applied
+    
+    def _schedule_backfill(self, cursor, name):
+        cursor.execute('INSERT OR IGNORE INTO schema_backfills (name) VALUES (?)', (name,))
+    
+    def _migration_base_schema(self, cursor):
+        # IF NOT EXISTS: базы без версии уже могут содержать часть таблиц
         # Пользователи
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -133,42 +609,303 @@ class Database:
             )
         ''')
         
-        # Главный админ (уровень 2)
-        cursor.execute('INSERT OR IGNORE INTO support_admins (user_id, added_by, admin_level) VALUES (?, ?, ?)', 
-                      (ADMIN_ID, ADMIN_ID, 2))
+        # Очередь исходящих уведомлений (outbox): пишется в одной транзакции с заказом/заявкой
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                method TEXT NOT NULL,  -- send_message / send_photo / send_document
+                payload TEXT NOT NULL,  -- JSON с аргументами метода
+                status TEXT DEFAULT 'pending',  -- pending / dead
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,  -- unix-время следующей попытки
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Состояния FSM (незавершённые покупки и т.п.), переживают перезапуск бота
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,  -- компактный JSON
+                updated_at REAL  -- unix-время последнего изменения
+            )
+        ''')
         
-        # Начальные цены
-        for key, value in PRICES.items():
-            cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', 
-                          (key, str(value)))
+        # Фоновые донастройки данных после миграций: прогресс по id, чтобы продолжить после перезапуска
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_backfills (
+                name TEXT PRIMARY KEY,
+                last_id INTEGER DEFAULT 0,
+                done INTEGER DEFAULT 0
+            )
+        ''')
         
-        # Индексы для производительности
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_status ON support_tickets(status)')
+        # Начальные цены — только при создании базы, изменённые админом цены не перезаписываются
+        cursor.executemany('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)',
+                          [(key, str(value)) for key, value in PRICES.items()])
+    
+    def _migration_legacy_columns(self, cursor):
+        for table, columns in self.LEGACY_COLUMNS.items():
+            cursor.execute(f'PRAGMA table_info({table})')
+            existing = {row[1] for row in cursor.fetchall()}
+            for column, column_type in columns:
+                if column not in existing:
+                    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+                    # DEFAULT CURRENT_TIMESTAMP в ALTER TABLE недопустим — заполняем в фоне
+                    if (table, column) == ('orders', 'updated_at'):
+                        self._schedule_backfill(cursor, 'orders_updated_at')
+    
+    def _migration_stats_counters(self, cursor):
+        # Счётчики для статистики, их поддерживают триггеры в той же транзакции, что и запись
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value NUMERIC DEFAULT 0
+            )
+        ''')
+        for trigger in STATS_TRIGGERS:
+            cursor.execute(trigger)
+        self._rebuild_stats(cursor)
+    
+    def _migration_indexes(self, cursor):
+        # План каждого запроса проверяет `python Bot.py check-plans`
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_user_id ON support_tickets(user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at)')
+        # Для постраничного просмотра: фильтр + сортировка (created_at, id) одним индексом
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_status_created ON support_tickets(status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_admin_status_created '
+                      'ON support_tickets(admin_id, status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_created_at ON support_tickets(created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_replies_ticket_created ON ticket_replies(ticket_id, created_at)')
+        # Покрывающие: сводка по заказам и список админов читаются из индекса без сортировки
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_currency ON orders(status, currency, total)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_admins_level_added '
+                      'ON support_admins(admin_level DESC, added_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, chat_id, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status_id ON outbox(status, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)')
         
-        self.conn.commit()
-        print("✅ Таблицы созданы/обновлены")
+        # Одноколоночные индексы стали префиксами составных — только замедляют запись
+        for index in ('idx_orders_user_id', 'idx_orders_status', 'idx_tickets_status'):
+            cursor.execute(f'DROP INDEX IF EXISTS {index}')
     
-    def load_prices(self):
+    def _migration_price_history(self, cursor):
+        # Журнал изменений цен только дополняется; version — номер среза каталога после изменения
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS price_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                version INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                old_value TEXT,
+                new_value TEXT NOT NULL,
+                changed_by INTEGER,
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('price_version', '0')")
+        # Версия каталога, по которой клиенту назвали сумму (NULL — старые заказы и заказы с сайта)
+        cursor.execute('PRAGMA table_info(orders)')
+        if 'price_version' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE orders ADD COLUMN price_version INTEGER')
+    
+    @staticmethod
+    def _search_text(column):
+        """SQL-выражение: текст колонки для полнотекстового индекса, ё и Ё заменены на е и Е"""
+        return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+    
+    def _migration_ticket_search(self, cursor):
+        # Строка индекса на заявку (rowid = id заявки): имя клиента, его сообщение и все ответы одним полем.
+        # Регистр и латинская диакритика не различаются; ё токенизатор не сворачивает, поэтому в индекс
+        # текст попадает уже с е вместо ё. Префиксные индексы — для поиска по началу слова
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS ticket_search USING fts5(
+                user_name, message, replies,
+                tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+            )
+        ''')
+        # Совпадение в имени весомее, чем в сообщении, а в сообщении — чем в ответах админов
+        cursor.execute("INSERT INTO ticket_search (ticket_search, rank) VALUES ('rank', 'bm25(2.0, 1.0, 0.5)')")
+        # Каждый триггер — отдельный execute: executescript сам делает COMMIT и разорвал бы транзакцию миграции
+        triggers = (
+            """CREATE TRIGGER IF NOT EXISTS ticket_search_insert AFTER INSERT ON support_tickets BEGIN
+                INSERT INTO ticket_search (rowid, user_name, message, replies)
+                VALUES (new.id, {user_name}, {message}, '');
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS ticket_search_update AFTER UPDATE OF user_name, message ON support_tickets BEGIN
+                UPDATE ticket_search SET user_name = {user_name}, message = {message} WHERE rowid = new.id;
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS ticket_search_delete AFTER DELETE ON support_tickets BEGIN
+                DELETE FROM ticket_search WHERE rowid = old.id;
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS ticket_search_reply_insert AFTER INSERT ON ticket_replies BEGIN
+                UPDATE ticket_search SET replies = replies || char(10) || coalesce({message}, '')
+                WHERE rowid = new.ticket_id;
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS ticket_search_reply_delete AFTER DELETE ON ticket_replies BEGIN
+                UPDATE ticket_search SET replies = coalesce(
+                    (SELECT group_concat({reply}, char(10)) FROM ticket_replies WHERE ticket_id = old.ticket_id), ''
+                ) WHERE rowid = old.ticket_id;
+            END""",
+        )
+        for trigger in triggers:
+            cursor.execute(trigger.format(user_name=self._search_text('new.user_name'),
+                                          message=self._search_text('new.message'),
+                                          reply=self._search_text('message')))
+        # Уже существующие заявки индексируются здесь же: это одна вставка, без построчных триггеров
+        cursor.execute(f'''
+            INSERT INTO ticket_search (rowid, user_name, message, replies)
+            SELECT t.id, {self._search_text('t.user_name')}, {self._search_text('t.message')},
+                   coalesce((SELECT group_concat({self._search_text('r.message')}, char(10))
+                             FROM ticket_replies r WHERE r.ticket_id = t.id), '')
+            FROM support_tickets t
+        ''')
+    
+    def _migration_row_versions(self, cursor):
+        # version растёт на каждом переходе статуса — по ней видно, что строку успели поменять
+        for table in ('orders', 'support_tickets'):
+            cursor.execute(f'PRAGMA table_info({table})')
+            if 'version' not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    
+    def _migration_ticket_routing(self, cursor):
+        # on_shift = 0 — админ не на смене и новых заявок не получает
+        # routed_to/routed_at — кому и когда (unix time) назначена новая заявка, route_attempts — сколько раз
+        for table, column, column_type in (
+            ('support_admins', 'on_shift', 'INTEGER NOT NULL DEFAULT 1'),
+            ('support_tickets', 'routed_to', 'INTEGER'),
+            ('support_tickets', 'routed_at', 'REAL'),
+            ('support_tickets', 'route_attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ):
+            cursor.execute(f'PRAGMA table_info({table})')
+            if column not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        # Нагрузка админа — COUNT по индексу; заявки, ждущие ответа, — диапазон (status, routed_at)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_routed_status ON support_tickets(routed_to, status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_status_routed_at ON support_tickets(status, routed_at)')
+    
+    def _migration_timers(self, cursor):
+        # due_at — когда сработает таймер строки (unix time), NULL — таймера нет.
+        # Частичный индекс хранит только строки с таймером — по нему планировщик читает ближайшие сроки
+        for table, index in (('orders', 'idx_orders_due_at'), ('support_tickets', 'idx_tickets_due_at')):
+            cursor.execute(f'PRAGMA table_info({table})')
+            if 'due_at' not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN due_at REAL')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {table}(due_at) WHERE due_at IS NOT NULL')
+    
+    def run_backfill_batch(self, batch_size):
+        """Следующая пачка первой незавершённой фоновой донастройки; False — делать больше нечего"""
         cursor = self.conn.cursor()
-        cursor.execute('SELECT key, value FROM settings')
-        for key, value in cursor.fetchall():
-            if key in PRICES:
+        cursor.execute('SELECT name, last_id FROM schema_backfills WHERE done = 0 ORDER BY name LIMIT 1')
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        
+        name, last_id = row
+        table, assignment, condition = self.BACKFILLS[name]
+        cursor.execute(f'SELECT MAX(id) FROM (SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?)',
+                      (last_id, batch_size))
+        upper = cursor.fetchone()[0]
+        if upper is None:
+            cursor.execute('UPDATE schema_backfills SET done = 1 WHERE name = ?', (name,))
+        else:
+            cursor.execute(f'UPDATE {table} SET {assignment} WHERE id > ? AND id <= ? AND ({condition})',
+                          (last_id, upper))
+            cursor.execute('UPDATE schema_backfills SET last_id = ? WHERE name = ?', (upper, name))
+        self._commit()
+        return True
+    
+    def ensure_main_admin(self):
+        """Главный админ (уровень 2) из конфигурации — проверка по кэшу, запись только если его нет"""
+        if ADMIN_ID not in self._admin_levels:
+            self.add_support_admin(ADMIN_ID, ADMIN_ID, 2)
+    
+    def _commit(self, on_commit=None):
+        """Коммитит запись; on_commit вызывается только после того, как данные закоммичены"""
+        # Внутри пачки коммит делает run_batch — один на всю пачку
+        if self._in_batch:
+            if on_commit:
+                self._commit_hooks.append(on_commit)
+            return
+        self.conn.commit()
+        if on_commit:
+            on_commit()
+    
+    def run_batch(self, calls):
+        """Выполняет пачку записей одной транзакцией с одним коммитом.
+
+        calls — список (метод, args, kwargs). Каждая запись обёрнута в SAVEPOINT,
+        поэтому ошибка в одной откатывает только её. Возвращает список (ok, результат/исключение).
+        """
+        results = []
+        self._in_batch = True
+        self._commit_hooks = []
+        try:
+            self.conn.execute('BEGIN IMMEDIATE')
+            for func, args, kwargs in calls:
+                self.conn.execute('SAVEPOINT batch_write')
+                hooks_before = len(self._commit_hooks)
                 try:
-                    PRICES[key] = float(value)
-                except:
-                    PRICES[key] = value
-        print("💰 Цены загружены")
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    self.conn.execute('ROLLBACK TO batch_write')
+                    del self._commit_hooks[hooks_before:]
+                    results.append((False, e))
+                else:
+                    results.append((True, result))
+                self.conn.execute('RELEASE batch_write')
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self._in_batch = False
+            hooks, self._commit_hooks = self._commit_hooks, []
+        for hook in hooks:
+            hook()
+        return results
+    
+    def load_prices(self):
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT key, value FROM settings')
+            settings = dict(cursor.fetchall())
+        price_catalog.install(int(settings.get('price_version', 0)), settings)
+        print(f"💰 Цены загружены (версия {price_catalog.snapshot.version})")
+    
+    def refresh_prices_if_stale(self):
+        """Перечитывает цены, если их поменял другой процесс бота; True — срез обновлён"""
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM settings WHERE key = 'price_version'")
+            row = cursor.fetchone()
+        if row is None or int(row[0]) == price_catalog.snapshot.version:
+            return False
+        self.load_prices()
+        return True
     
-    def update_price(self, key, value):
+    def update_price(self, key, value, changed_by=None):
+        """Меняет цену, пишет её в price_history и после коммита подменяет срез каталога; возвращает версию"""
+        key = price_catalog.resolve_key(key)
         cursor = self.conn.cursor()
+        cursor.execute('SELECT key, value FROM settings')
+        settings = dict(cursor.fetchall())
+        version = int(settings.get('price_version', 0)) + 1
         cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', 
                       (key, str(value)))
-        self.conn.commit()
-        PRICES[key] = value
-        return True
+        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('price_version', ?)",
+                      (str(version),))
+        cursor.execute('''
+            INSERT INTO price_history (version, key, old_value, new_value, changed_by)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (version, key, settings.get(key), str(value), changed_by))
+        settings[key] = value
+        self._commit(on_commit=lambda: price_catalog.install(version, settings))
+        return version
     
     def add_user(self, user_id, username, full_name):
         cursor = self.conn.cursor()
@@ -176,14 +913,48 @@ class Database:
             INSERT OR IGNORE INTO users (user_id, username, full_name)
             VALUES (?, ?, ?)
         ''', (user_id, username, full_name))
-        self.conn.commit()
+        self._commit()
+    
+    def load_admin_levels(self):
+        """Загружает всю таблицу support_admins в кэш уровней"""
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id, admin_level FROM support_admins')
+            levels = dict(cursor.fetchall())
+            cursor.execute("SELECT value FROM settings WHERE key = 'admin_cache_version'")
+            result = cursor.fetchone()
+        self._admin_levels = levels
+        self._admin_cache_version = result[0] if result else None
+        return levels
+    
+    def invalidate_admin_cache(self):
+        self._admin_levels = None
+    
+    def refresh_admin_cache_if_stale(self):
+        """Сбрасывает кэш, если уровни поменял другой процесс бота (версия в settings изменилась)"""
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM settings WHERE key = 'admin_cache_version'")
+            result = cursor.fetchone()
+        version = result[0] if result else None
+        if version != self._admin_cache_version:
+            self.load_admin_levels()
+            return True
+        return False
+    
+    def _bump_admin_cache_version(self, cursor):
+        # Меняется в той же транзакции, что и support_admins — по ней другие процессы узнают о правке
+        cursor.execute('''
+            INSERT INTO settings (key, value) VALUES ('admin_cache_version', '1')
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        ''')
     
     def get_admin_level(self, user_id):
         """Возвращает уровень админа: 0 = не админ, 1 = ТП, 2 = Админ"""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT admin_level FROM support_admins WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else 0
+        levels = self._admin_levels
+        if levels is None:
+            levels = self.load_admin_levels()
+        return levels.get(user_id, 0)
     
     def is_support_admin(self, user_id):
         """Проверяет, является ли пользователь ТП или Админом (уровень 1 или 2)"""
@@ -196,10 +967,12 @@ class Database:
     def add_support_admin(self, admin_id, added_by, admin_level=1):
         cursor = self.conn.cursor()
         cursor.execute('''
-            INSERT OR REPLACE INTO support_admins (user_id, added_by, admin_level)
+            INSERT INTO support_admins (user_id, added_by, admin_level)
             VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET added_by = excluded.added_by, admin_level = excluded.admin_level
         ''', (admin_id, added_by, admin_level))
-        self.conn.commit()
+        self._bump_admin_cache_version(cursor)
+        self._commit(on_commit=self.invalidate_admin_cache)
         return True
     
     def update_admin_level(self, admin_id, new_level):
@@ -209,83 +982,358 @@ class Database:
             SET admin_level = ?
             WHERE user_id = ?
         ''', (new_level, admin_id))
-        self.conn.commit()
-        return cursor.rowcount > 0
+        updated = cursor.rowcount > 0
+        self._bump_admin_cache_version(cursor)
+        self._commit(on_commit=self.invalidate_admin_cache)
+        return updated
     
     def remove_support_admin(self, admin_id):
         cursor = self.conn.cursor()
         cursor.execute('DELETE FROM support_admins WHERE user_id = ?', (admin_id,))
-        self.conn.commit()
-        return cursor.rowcount > 0
+        removed = cursor.rowcount > 0
+        self._bump_admin_cache_version(cursor)
+        self._commit(on_commit=self.invalidate_admin_cache)
+        return removed
     
     def get_all_support_admins(self):
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT sa.user_id, u.username, u.full_name, sa.admin_level, sa.added_at 
+                FROM support_admins sa
+                LEFT JOIN users u ON sa.user_id = u.user_id
+                ORDER BY sa.admin_level DESC, sa.added_at
+            ''')
+            return cursor.fetchall()
+    
+    def set_admin_shift(self, admin_id, on_shift):
+        """Начало или конец смены; новые заявки ушедшего со смены сразу уходят на эскалацию"""
         cursor = self.conn.cursor()
+        cursor.execute('UPDATE support_admins SET on_shift = ? WHERE user_id = ?', (int(on_shift), admin_id))
+        updated = cursor.rowcount > 0
+        if not on_shift:
+            cursor.execute('''
+                UPDATE support_tickets SET routed_at = 0
+                WHERE routed_to = ? AND status = 'new' AND routed_at IS NOT NULL
+            ''', (admin_id,))
+        self._commit()
+        return updated
+    
+    def is_on_shift(self, admin_id):
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT on_shift FROM support_admins WHERE user_id = ?', (admin_id,))
+            row = cursor.fetchone()
+            return bool(row and row[0])
+    
+    def _admin_loads(self, cursor):
+        """{user_id: открытых заявок} для админов на смене: взятые в работу плюс назначенные и ещё не взятые"""
         cursor.execute('''
-            SELECT sa.user_id, u.username, u.full_name, sa.admin_level, sa.added_at 
-            FROM support_admins sa
-            LEFT JOIN users u ON sa.user_id = u.user_id
-            ORDER BY sa.admin_level DESC, sa.added_at
+            SELECT user_id,
+                   (SELECT COUNT(*) FROM support_tickets t
+                    WHERE t.admin_id = support_admins.user_id AND t.status = 'in_progress')
+                 + (SELECT COUNT(*) FROM support_tickets t
+                    WHERE t.routed_to = support_admins.user_id AND t.status = 'new')
+            FROM support_admins
+            WHERE on_shift = 1
         ''')
-        return cursor.fetchall()
+        return dict(cursor.fetchall())
+    
+    def get_admin_loads(self):
+        with self.pool.reader() as conn:
+            return self._admin_loads(conn.cursor())
     
-    def create_support_ticket(self, user_id, user_name, message, file_id=None, file_type=None):
+    def _route_ticket(self, cursor, ticket_id, notification, exclude=None):
+        """Назначает заявку наименее загруженному админу на смене (кроме exclude) и уведомляет только его.
+
+        Возвращает id админа или None, если назначить некому — тогда заявка уходит старшим админам.
+        """
+        loads = self._admin_loads(cursor)
+        loads.pop(exclude, None)
+        if not loads:
+            self._enqueue_for_admins(cursor, *notification, min_level=2)
+            cursor.execute('UPDATE support_tickets SET routed_to = NULL, routed_at = NULL WHERE id = ?',
+                          (ticket_id,))
+            return None
+        admin_id = min(loads, key=lambda user_id: (loads[user_id], user_id))
+        cursor.execute('''
+            UPDATE support_tickets
+            SET routed_to = ?, routed_at = ?, route_attempts = route_attempts + 1
+            WHERE id = ?
+        ''', (admin_id, time.time(), ticket_id))
+        method, payload = notification
+        cursor.execute('INSERT INTO outbox (chat_id, method, payload) VALUES (?, ?, ?)',
+                      (admin_id, method, json.dumps(payload, ensure_ascii=False)))
+        return admin_id
+    
+    def create_support_ticket(self, user_id, user_name, message, file_id=None, file_type=None,
+                              admin_notification=None):
+        """admin_notification(ticket_id) -> (метод, аргументы) — уведомление админу, которому назначена заявка"""
         cursor = self.conn.cursor()
         cursor.execute('''
             INSERT INTO support_tickets (user_id, user_name, message, file_id, file_type)
             VALUES (?, ?, ?, ?, ?)
         ''', (user_id, user_name, message, file_id, file_type))
-        self.conn.commit()
-        return cursor.lastrowid
-    
-    def get_new_tickets(self):
+        ticket_id = cursor.lastrowid
+        if admin_notification:
+            self._route_ticket(cursor, ticket_id, admin_notification(ticket_id))
+        self._commit()
+        return ticket_id
+    
+    def escalate_stale_tickets(self, cutoff, max_attempts, notification, limit=50):
+        """Заявки, которые назначенный админ не взял до cutoff, переходят к следующему по нагрузке.
+
+        После max_attempts назначений (или если больше некому) заявка уходит всем старшим админам
+        и больше не эскалируется. notification(ticket, senior) -> (метод, аргументы), где
+        ticket = (id, user_id, user_name, message, file_id, file_type). Возвращает число заявок.
+        """
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT * FROM support_tickets 
-            WHERE status = 'new'
-            ORDER BY created_at DESC
-        ''')
-        return cursor.fetchall()
+            SELECT id, user_id, user_name, message, file_id, file_type, routed_to, route_attempts
+            FROM support_tickets
+            WHERE status = 'new' AND routed_at <= ?
+            ORDER BY routed_at
+            LIMIT ?
+        ''', (cutoff, limit))
+        stale = cursor.fetchall()
+        for *ticket, routed_to, attempts in stale:
+            if attempts < max_attempts:
+                self._route_ticket(cursor, ticket[0], notification(ticket, False), exclude=routed_to)
+            else:
+                self._enqueue_for_admins(cursor, *notification(ticket, True), min_level=2)
+                # Заявка теперь общая для старших — с последнего назначенного админа она снимается
+                cursor.execute('UPDATE support_tickets SET routed_to = NULL, routed_at = NULL WHERE id = ?',
+                              (ticket[0],))
+        self._commit()
+        return len(stale)
+    
+    def _keyset_page(self, select_sql, table, alias, where, params, cursor_id, backwards, limit):
+        """Страница по ключу (created_at, id) от новых к старым — один диапазонный запрос по индексу.
+
+        cursor_id — id последней показанной записи: вперёд идём к более старым, назад — к более новым.
+        Возвращает (строки в порядке показа, есть ли ещё записи в этом направлении).
+        """
+        if cursor_id is not None:
+            op = '>' if backwards else '<'
+            where += f' AND ({alias}.created_at, {alias}.id) {op} (SELECT created_at, id FROM {table} WHERE id = ?)'
+            params = (*params, cursor_id)
+        order = 'ASC' if backwards else 'DESC'
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                {select_sql}
+                WHERE {where}
+                ORDER BY {alias}.created_at {order}, {alias}.id {order}
+                LIMIT ?
+            ''', (*params, limit + 1))
+            rows = cursor.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        return rows, has_more
+    
+    def get_new_tickets_page(self, cursor_id=None, backwards=False, limit=1):
+        return self._keyset_page(
+            'SELECT t.* FROM support_tickets t', 'support_tickets', 't',
+            "t.status = 'new'", (), cursor_id, backwards, limit
+        )
     
-    def get_my_tickets(self, admin_id):
-        """Получить заявки, взятые в работу конкретным админом"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT * FROM support_tickets 
-            WHERE admin_id = ? AND status = 'in_progress'
-            ORDER BY created_at DESC
-        ''', (admin_id,))
-        return cursor.fetchall()
+    def get_my_tickets_page(self, admin_id, cursor_id=None, backwards=False, limit=1):
+        """Заявки, взятые в работу конкретным админом"""
+        return self._keyset_page(
+            'SELECT t.* FROM support_tickets t', 'support_tickets', 't',
+            "t.admin_id = ? AND t.status = 'in_progress'", (admin_id,), cursor_id, backwards, limit
+        )
     
-    def get_all_tickets(self):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT * FROM support_tickets 
-            ORDER BY created_at DESC
-        ''')
-        return cursor.fetchall()
+    def get_tickets_summary(self):
+        """Количество заявок по статусам: {'new': 3, 'in_progress': 1, ...}"""
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT status, COUNT(*) FROM support_tickets GROUP BY status')
+            return dict(cursor.fetchall())
+    
+    def get_latest_tickets(self, limit=5):
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, user_name, status FROM support_tickets 
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (limit,))
+            return cursor.fetchall()
     
     def get_ticket_by_id(self, ticket_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM support_tickets WHERE id = ?', (ticket_id,))
-        return cursor.fetchone()
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM support_tickets WHERE id = ?', (ticket_id,))
+            return cursor.fetchone()
     
-    def assign_ticket(self, ticket_id, admin_id, admin_name):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE support_tickets 
-            SET status = 'in_progress', admin_id = ?, admin_name = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (admin_id, admin_name, ticket_id))
-        self.conn.commit()
+    def search_tickets(self, text, limit=10):
+        """Заявки по словам из text, лучшие первыми: [(id, user_name, status, created_at, фрагмент)].
+
+        Каждое слово ищется по началу, нужны все слова. В фрагменте найденное обрамлено
+        символами \\x02 и \\x03 — их заменяет на разметку тот, кто показывает результат.
+        """
+        words = re.findall(r'\w+', text.lower().replace('ё', 'е'))
+        if not words:
+            return []
+        query = ' '.join(f'"{word}"*' for word in words)
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT t.id, t.user_name, t.status, t.created_at,
+                       snippet(ticket_search, -1, char(2), char(3), '…', 12)
+                FROM ticket_search
+                JOIN support_tickets t ON t.id = ticket_search.rowid
+                WHERE ticket_search MATCH ?
+                ORDER BY ticket_search.rank
+                LIMIT ?
+            ''', (query, limit))
+            return cursor.fetchall()
+    
+    # ---------- Переходы статусов ----------
+    # действие -> (статусы, из которых оно допустимо, новый статус)
+    TICKET_TRANSITIONS = {
+        'take': (('new',), 'in_progress'),
+        'close': (('new', 'in_progress'), 'closed'),
+    }
+    ORDER_TRANSITIONS = {
+        'complete': (('pending',), 'completed'),
+        'cancel': (('pending',), 'cancelled'),
+        'expire': (('pending',), 'expired'),
+    }
     
-    def close_ticket(self, ticket_id):
+    def _transition(self, table, transitions, row_id, action, assignments=(), expected_version=None,
+                    notification=None, due_at=None):
+        """Переход статуса одним условным UPDATE — без блокировок и без гонок между админами.
+
+        Строка меняется, только если её статус допускает действие (и версия равна expected_version,
+        если она задана); version при этом растёт. Возвращает (True, новый статус) тому, кто успел,
+        и (False, текущий статус) опоздавшему; (False, None) — строки нет.
+        notification — (метод, аргументы) сообщения владельцу строки: ставится в outbox той же
+        транзакцией и только при успешном переходе, поэтому клиент получает его ровно один раз.
+        due_at — новый срок таймера строки; по умолчанию переход снимает таймер.
+        """
+        allowed, new_status = transitions[action]
+        columns = ['status = ?', 'version = version + 1', 'updated_at = CURRENT_TIMESTAMP', 'due_at = ?']
+        columns += [f'{column} = ?' for column, _ in assignments]
+        where = f"id = ? AND status IN ({', '.join('?' * len(allowed))})"
+        params = [new_status, due_at, *(value for _, value in assignments), row_id, *allowed]
+        if expected_version is not None:
+            where += ' AND version = ?'
+            params.append(expected_version)
+        
         cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE support_tickets 
-            SET status = 'closed', updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (ticket_id,))
-        self.conn.commit()
+        cursor.execute(f"UPDATE {table} SET {', '.join(columns)} WHERE {where}", params)
+        if cursor.rowcount == 0:
+            status = self._row_status(cursor, table, row_id)
+            # UPDATE без изменений тоже открыл транзакцию — вне пачки её надо закрыть
+            self._commit()
+            return False, status
+        if notification:
+            self._notify_owner(cursor, table, row_id, *notification)
+        self._commit()
+        return True, new_status
+    
+    def _row_status(self, cursor, table, row_id):
+        cursor.execute(f'SELECT status FROM {table} WHERE id = ?', (row_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    
+    def _notify_owner(self, cursor, table, row_id, method, payload):
+        """Сообщение в outbox пользователю, которому принадлежит строка (user_id заказа или заявки)"""
+        cursor.execute(f'''
+            INSERT INTO outbox (chat_id, method, payload)
+            SELECT user_id, ?, ? FROM {table} WHERE id = ?
+        ''', (method, json.dumps(payload, ensure_ascii=False), row_id))
+    
+    def _bulk_transition(self, table, transitions, row_ids, action, assignments=(), notification=None,
+                         columns=()):
+        """Один переход для многих строк в одной транзакции (см. _transition).
+
+        Какие строки перейдут, решает чтение на соединении-писателе под блокировкой записи (своей
+        или пачки run_batch) — другие записи между ним и UPDATE не встают. Статусы меняет один
+        executemany с тем же условием на статус, что и в _transition: строка, которую всё же успели
+        перевести после чтения (например, триггером), пропускается и попадает в отказы. Если по статусам
+        нельзя понять, какие строки изменил этот вызов, он откатывается целиком. Уведомления владельцам
+        ставит второй executemany — только для действительно перешедших строк.
+        notification(строка) -> (метод, аргументы), строка — (id, user_id, *columns).
+        Возвращает (id перешедших, {id: текущий статус или None} для остальных,
+        (первый, последний) id поставленных уведомлений или None).
+        """
+        allowed, new_status = transitions[action]
+        row_ids = list(dict.fromkeys(row_ids))
+        cursor = self.conn.cursor()
+        if not self.conn.in_transaction:
+            # Вызов вне пачки: берём блокировку записи до чтения, иначе между ним и UPDATE успеют другие
+            cursor.execute('BEGIN IMMEDIATE')
+        rows = self._rows_by_id(cursor, table, row_ids, ('status', 'user_id', *columns))
+        done = [row_id for row_id in row_ids if row_id in rows and rows[row_id][1] in allowed]
+        refused = {row_id: rows[row_id][1] if row_id in rows else None
+                   for row_id in row_ids if row_id not in done}
+        
+        values = [new_status, *(value for _, value in assignments)]
+        cursor.executemany(f'''
+            UPDATE {table}
+            SET status = ?, version = version + 1, updated_at = CURRENT_TIMESTAMP, due_at = NULL
+                {''.join(f', {column} = ?' for column, _ in assignments)}
+            WHERE id = ? AND status IN ({', '.join('?' * len(allowed))})
+        ''', [(*values, row_id, *allowed) for row_id in done])
+        changed = cursor.rowcount
+        if changed != len(done):
+            # Часть строк условие на статус не пропустило — узнаём какие по их текущему статусу
+            statuses = {row_id: row[1] for row_id, row in self._rows_by_id(cursor, table, done, ('status',)).items()}
+            skipped = [row_id for row_id in done if statuses.get(row_id) != new_status]
+            if len(done) - len(skipped) != changed:
+                # Кто-то другой перевёл строку в тот же статус — не отличить от своей, не рискуем уведомлениями
+                if not self._in_batch:
+                    self.conn.rollback()
+                raise sqlite3.DatabaseError(
+                    f"{table}: перешло {changed} строк из {len(done)} — статусы изменились после чтения")
+            refused.update((row_id, statuses.get(row_id)) for row_id in skipped)
+            done = [row_id for row_id in done if row_id not in refused]
+        
+        outbox_range = None
+        if notification and done:
+            # Автоинкремент outbox: всё, что выше прежнего максимума, поставлено этим вызовом
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM outbox')
+            first_id = cursor.fetchone()[0] + 1
+            messages = []
+            for row_id in done:
+                _, _, user_id, *extra = rows[row_id]
+                method, payload = notification((row_id, user_id, *extra))
+                messages.append((user_id, method, json.dumps(payload, ensure_ascii=False)))
+            cursor.executemany('INSERT INTO outbox (chat_id, method, payload) VALUES (?, ?, ?)', messages)
+            cursor.execute('SELECT MAX(id) FROM outbox')
+            outbox_range = (first_id, cursor.fetchone()[0])
+        self._commit()
+        return done, refused, outbox_range
+    
+    def _rows_by_id(self, cursor, table, row_ids, columns):
+        """{id: (id, *columns)} для существующих строк из row_ids"""
+        rows = {}
+        # Не больше 500 параметров в одном IN — ниже лимита SQLite на переменные
+        for start in range(0, len(row_ids), 500):
+            chunk = row_ids[start:start + 500]
+            cursor.execute(f'''
+                SELECT id, {', '.join(columns)} FROM {table}
+                WHERE id IN ({', '.join('?' * len(chunk))})
+            ''', chunk)
+            rows.update((row[0], row) for row in cursor.fetchall())
+        return rows
+    
+    def transition_ticket(self, ticket_id, action, admin_id=None, admin_name=None, notification=None,
+                          due_at=None):
+        """take/close заявки; admin_id и admin_name записываются, только если переданы"""
+        assignments = (('admin_id', admin_id), ('admin_name', admin_name)) if admin_id else ()
+        return self._transition('support_tickets', self.TICKET_TRANSITIONS, ticket_id, action,
+                                assignments, notification=notification, due_at=due_at)
+    
+    def bulk_transition_tickets(self, ticket_ids, action, notification=None):
+        """Массовый переход заявок (см. _bulk_transition); notification получает (id, user_id)"""
+        return self._bulk_transition('support_tickets', self.TICKET_TRANSITIONS, ticket_ids, action,
+                                     notification=notification)
     
     def add_ticket_reply(self, ticket_id, admin_id, admin_name, message):
         cursor = self.conn.cursor()
@@ -293,128 +1341,750 @@ class Database:
             INSERT INTO ticket_replies (ticket_id, admin_id, admin_name, message)
             VALUES (?, ?, ?, ?)
         ''', (ticket_id, admin_id, admin_name, message))
-        self.conn.commit()
+        self._commit()
     
     def get_ticket_replies(self, ticket_id):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT * FROM ticket_replies 
-            WHERE ticket_id = ?
-            ORDER BY created_at ASC
-        ''', (ticket_id,))
-        return cursor.fetchall()
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM ticket_replies 
+                WHERE ticket_id = ?
+                ORDER BY created_at ASC, id ASC
+            ''', (ticket_id,))
+            return cursor.fetchall()
     
     def create_order(self, user_id, product, quantity, total, currency, username, 
-                     payment_method=None, crypto_bot_link=None, bep20_wallet=None, screenshot=None):
+                     payment_method=None, crypto_bot_link=None, bep20_wallet=None, screenshot=None,
+                     price_version=None, admin_notification=None, due_at=None):
+        """admin_notification(order_id) -> (метод, аргументы) — уведомление всем ТП-админам через outbox;
+        due_at — срок таймера заказа (см. fire_timers)"""
         cursor = self.conn.cursor()
         cursor.execute('''
             INSERT INTO orders (user_id, product, quantity, total, currency, username, 
-                              payment_method, crypto_bot_link, bep20_wallet, screenshot)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                              payment_method, crypto_bot_link, bep20_wallet, screenshot, price_version, due_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (user_id, product, quantity, total, currency, username, 
-              payment_method, crypto_bot_link, bep20_wallet, screenshot))
-        self.conn.commit()
-        return cursor.lastrowid
+              payment_method, crypto_bot_link, bep20_wallet, screenshot, price_version, due_at))
+        order_id = cursor.lastrowid
+        if admin_notification:
+            self._enqueue_for_admins(cursor, *admin_notification(order_id))
+        self._commit()
+        return order_id
+    
+    def get_user_orders_page(self, user_id, cursor_id=None, backwards=False, limit=10):
+        return self._keyset_page(
+            f'SELECT {ORDER_SELECT} FROM orders o', 'orders', 'o',
+            'o.user_id = ?', (user_id,), cursor_id, backwards, limit
+        )
     
-    def get_orders_by_user(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT * FROM orders 
-            WHERE user_id = ? 
-            ORDER BY created_at DESC
-        ''', (user_id,))
-        return cursor.fetchall()
+    def get_orders_summary(self):
+        """Сводка по заказам одним GROUP BY: количество по статусам и выручка выполненных по валютам"""
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT status, currency, COUNT(*), SUM(total) FROM orders 
+                GROUP BY status, currency
+            ''')
+            summary = {'total': 0, 'by_status': {}, 'revenue': {}}
+            for status, currency, count, amount in cursor.fetchall():
+                summary['total'] += count
+                summary['by_status'][status] = summary['by_status'].get(status, 0) + count
+                if status == 'completed':
+                    summary['revenue'][currency] = summary['revenue'].get(currency, 0) + (amount or 0)
+            return summary
+    
+    def get_latest_orders(self, limit=5):
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, product, total, currency, status FROM orders 
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (limit,))
+            return cursor.fetchall()
+    
+    def get_pending_orders_page(self, cursor_id=None, backwards=False, limit=1):
+        return self._keyset_page(
+            f'SELECT {ORDER_SELECT}, u.username, u.full_name FROM orders o LEFT JOIN users u ON o.user_id = u.user_id',
+            'orders', 'o', "o.status = 'pending'", (), cursor_id, backwards, limit
+        )
     
-    def get_all_orders(self):
+    def get_order_by_id(self, order_id):
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {ORDER_SELECT}, u.username, u.full_name 
+                FROM orders o
+                LEFT JOIN users u ON o.user_id = u.user_id
+                WHERE o.id = ?
+            ''', (order_id,))
+            return cursor.fetchone()
+    
+    def transition_order(self, order_id, action, admin_id=None, comment=None, notification=None):
+        """complete/cancel заказа (см. _transition); админ и комментарий записываются вместе со статусом"""
+        assignments = (('completed_by', admin_id), ('admin_comment', comment)) if admin_id else ()
+        return self._transition('orders', self.ORDER_TRANSITIONS, order_id, action,
+                                assignments, notification=notification)
+    
+    def bulk_transition_orders(self, order_ids, action, admin_id, comment, notification=None):
+        """Массовый complete/cancel (см. _bulk_transition); notification получает (id, user_id, product)"""
+        return self._bulk_transition('orders', self.ORDER_TRANSITIONS, order_ids, action,
+                                     (('completed_by', admin_id), ('admin_comment', comment)),
+                                     notification, ('product',))
+    
+    def set_order_comment(self, order_id, comment, expected_version, notification=None):
+        """Комментарий к заказу, если с expected_version заказ никто не менял; (ok, текущий статус)"""
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT o.*, u.username, u.full_name 
-            FROM orders o
-            LEFT JOIN users u ON o.user_id = u.user_id
-            ORDER BY o.created_at DESC
-        ''')
-        return cursor.fetchall()
-    
-    def get_pending_orders(self):
+            UPDATE orders 
+            SET admin_comment = ?, version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND version = ?
+        ''', (comment, order_id, expected_version))
+        if cursor.rowcount == 0:
+            status = self._row_status(cursor, 'orders', order_id)
+            self._commit()
+            return False, status
+        if notification:
+            self._notify_owner(cursor, 'orders', order_id, *notification)
+        status = self._row_status(cursor, 'orders', order_id)
+        self._commit()
+        return True, status
+    
+    # ---------- Таймеры ----------
+    # Вид таймера -> таблица, в строках которой хранится его срок (due_at)
+    TIMER_TABLES = {'order': 'orders', 'ticket': 'support_tickets'}
+    
+    def get_due_timers(self, until, limit):
+        """Таймеры со сроком до until: [(срок, вид, id)] по возрастанию срока, не больше limit"""
+        timers = []
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            for kind, table in self.TIMER_TABLES.items():
+                cursor.execute(f'SELECT due_at, ?, id FROM {table} WHERE due_at <= ? ORDER BY due_at LIMIT ?',
+                              (kind, until, limit))
+                timers.extend(cursor.fetchall())
+        timers.sort()
+        return timers[:limit]
+    
+    def fire_timers(self, timers, now, notification):
+        """Срабатывание таймеров [(вид, id)]; notification(событие, строка) -> (метод, аргументы).
+
+        Строка перечитывается с условием due_at <= now, так что таймер, который успели снять
+        или сдвинуть (заказ подтверждён, заявка закрыта), просто пропускается. События:
+        order_expired — неоплаченный заказ (без скриншота) истёк, клиенту сообщение;
+        order_overdue — заказ со скриншотом слишком долго ждёт проверки, напоминание старшим админам;
+        ticket_overdue — заявка в работе дольше SLA, напоминание взявшему админу и старшим.
+        Возвращает список случившихся событий.
+        """
         cursor = self.conn.cursor()
+        events = []
+        for kind, row_id in timers:
+            if kind == 'order':
+                cursor.execute('''
+                    SELECT id, user_id, product, total, currency, screenshot, status FROM orders
+                    WHERE id = ? AND due_at <= ?
+                ''', (row_id, now))
+                row = cursor.fetchone()
+                if row is None or row[6] != 'pending':
+                    continue
+                if row[5]:
+                    cursor.execute('UPDATE orders SET due_at = NULL WHERE id = ?', (row_id,))
+                    self._enqueue_for_admins(cursor, *notification('order_overdue', row), min_level=2)
+                    events.append('order_overdue')
+                elif self._transition('orders', self.ORDER_TRANSITIONS, row_id, 'expire',
+                                      notification=notification('order_expired', row))[0]:
+                    events.append('order_expired')
+            else:
+                cursor.execute('''
+                    SELECT id, user_id, user_name, message, admin_id, admin_name, status FROM support_tickets
+                    WHERE id = ? AND due_at <= ?
+                ''', (row_id, now))
+                row = cursor.fetchone()
+                if row is None or row[6] != 'in_progress':
+                    continue
+                cursor.execute('UPDATE support_tickets SET due_at = NULL WHERE id = ?', (row_id,))
+                method, payload = notification('ticket_overdue', row)
+                if row[4]:
+                    cursor.execute('INSERT INTO outbox (chat_id, method, payload) VALUES (?, ?, ?)',
+                                  (row[4], method, json.dumps(payload, ensure_ascii=False)))
+                self._enqueue_for_admins(cursor, method, payload, min_level=2, exclude=row[4])
+                events.append('ticket_overdue')
+        self._commit()
+        return events
+    
+    # ---------- Outbox уведомлений ----------
+    def _enqueue_for_admins(self, cursor, method, payload, min_level=1, exclude=None):
         cursor.execute('''
-            SELECT o.*, u.username, u.full_name 
-            FROM orders o
-            LEFT JOIN users u ON o.user_id = u.user_id
-            WHERE o.status = 'pending'
-            ORDER BY o.created_at DESC
-        ''')
-        return cursor.fetchall()
+            INSERT INTO outbox (chat_id, method, payload)
+            SELECT user_id, ?, ? FROM support_admins WHERE admin_level >= ? AND user_id IS NOT ? ORDER BY user_id
+        ''', (method, json.dumps(payload, ensure_ascii=False), min_level, exclude))
     
-    def get_order_by_id(self, order_id):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT o.*, u.username, u.full_name 
-            FROM orders o
-            LEFT JOIN users u ON o.user_id = u.user_id
-            WHERE o.id = ?
-        ''', (order_id,))
-        return cursor.fetchone()
-    
-    def update_order_status(self, order_id, status, admin_id=None, comment=None):
+    def enqueue_notification(self, chat_id, method, **payload):
         cursor = self.conn.cursor()
-        if admin_id:
+        cursor.execute('INSERT INTO outbox (chat_id, method, payload) VALUES (?, ?, ?)',
+                      (chat_id, method, json.dumps(payload, ensure_ascii=False)))
+        self._commit()
+        return cursor.lastrowid
+    
+    def get_outbox_progress(self, first_id, last_id):
+        """(ещё ждут отправки, не доставлены совсем) среди сообщений outbox с id в [first_id, last_id];
+        доставленные из outbox удаляются"""
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                UPDATE orders 
-                SET status = ?, completed_by = ?, admin_comment = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (status, admin_id, comment, order_id))
-        else:
+                SELECT COALESCE(SUM(status = 'pending'), 0), COALESCE(SUM(status = 'dead'), 0) FROM outbox
+                WHERE id BETWEEN ? AND ?
+            ''', (first_id, last_id))
+            return cursor.fetchone()
+    
+    def get_due_outbox(self, now, limit):
+        """Первое неотправленное сообщение каждого чата, если подошло его время.
+
+        Следующее сообщение в тот же чат не выдаётся, пока не отправлено предыдущее —
+        так сохраняется порядок доставки получателю.
+        """
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                UPDATE orders 
-                SET status = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (status, order_id))
-        self.conn.commit()
-        return cursor.rowcount > 0
+                SELECT o.id, o.chat_id, o.method, o.payload, o.attempts
+                FROM outbox o
+                WHERE o.status = 'pending' AND o.next_attempt_at <= ?
+                  AND o.id = (SELECT MIN(p.id) FROM outbox p
+                              WHERE p.status = 'pending' AND p.chat_id = o.chat_id)
+                ORDER BY o.id
+                LIMIT ?
+            ''', (now, limit))
+            return cursor.fetchall()
+    
+    def complete_outbox(self, sent_ids, failures):
+        """Удаляет доставленные сообщения и планирует повтор для неудачных.
+
+        failures — список (id, ошибка, время следующей попытки или None для dead-letter).
+        """
+        cursor = self.conn.cursor()
+        cursor.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in sent_ids])
+        cursor.executemany('''
+            UPDATE outbox
+            SET attempts = attempts + 1, last_error = ?,
+                status = CASE WHEN ? IS NULL THEN 'dead' ELSE 'pending' END,
+                next_attempt_at = COALESCE(?, next_attempt_at)
+            WHERE id = ?
+        ''', [(error, retry_at, retry_at, i) for i, error, retry_at in failures])
+        self._commit()
+    
+    # ---------- Состояния FSM ----------
+    def load_fsm_record(self, key):
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT state, data, updated_at FROM fsm_states WHERE key = ?', (key,))
+            return cursor.fetchone()
+    
+    def save_fsm_records(self, records):
+        """records — список (key, state, data_json, updated_at); пустые состояния удаляются"""
+        cursor = self.conn.cursor()
+        cursor.executemany('''
+            INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data,
+                                           updated_at = excluded.updated_at
+        ''', [r for r in records if r[1] is not None or r[2] != '{}'])
+        cursor.executemany('DELETE FROM fsm_states WHERE key = ?',
+                          [(r[0],) for r in records if r[1] is None and r[2] == '{}'])
+        self._commit()
+    
+    def expire_fsm_records(self, older_than):
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM fsm_states WHERE updated_at < ?', (older_than,))
+        self._commit()
+        return cursor.rowcount
     
     def get_stats(self):
-        cursor = self.conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM users')
-        users = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM orders')
-        orders = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM orders WHERE status = "pending"')
-        pending_orders = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT SUM(total) FROM orders WHERE status = "completed" AND currency = "RUB"')
-        total_rub = cursor.fetchone()[0] or 0
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT name, value FROM stats_counters')
+            counters = dict(cursor.fetchall())
         
-        cursor.execute('SELECT SUM(total) FROM orders WHERE status = "completed" AND currency = "USDT"')
-        total_usdt = cursor.fetchone()[0] or 0
-        
-        cursor.execute('SELECT COUNT(*) FROM support_tickets WHERE status = "new"')
-        new_tickets = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM support_admins WHERE admin_level >= 1')
-        all_admins = cursor.fetchone()[0]
+        admins_by_level = {int(name.rsplit('_', 1)[1]): value for name, value in counters.items()
+                           if name.startswith('admins_level_')}
+        return {
+            'users': counters.get('users', 0),
+            'orders': counters.get('orders', 0),
+            'pending_orders': counters.get('pending_orders', 0),
+            'total_rub': round(counters.get('revenue_RUB', 0), 2),
+            'total_usdt': round(counters.get('revenue_USDT', 0), 2),
+            'new_tickets': counters.get('new_tickets', 0),
+            'all_admins': sum(v for level, v in admins_by_level.items() if level >= 1),
+            'support_admins': admins_by_level.get(1, 0),
+            'full_admins': admins_by_level.get(2, 0),
+            'prices': price_catalog.snapshot.as_dict()
+        }
+    
+    def _rebuild_stats(self, cursor):
+        cursor.execute('DELETE FROM stats_counters')
+        cursor.execute('''
+            INSERT INTO stats_counters (name, value)
+            SELECT 'users', COUNT(*) FROM users
+            UNION ALL SELECT 'orders', COUNT(*) FROM orders
+            UNION ALL SELECT 'pending_orders', COUNT(*) FROM orders WHERE status = 'pending'
+            UNION ALL SELECT 'new_tickets', COUNT(*) FROM support_tickets WHERE status = 'new'
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_counters (name, value)
+            SELECT 'revenue_' || COALESCE(currency, ''), SUM(COALESCE(total, 0)) FROM orders
+            WHERE status = 'completed' GROUP BY COALESCE(currency, '')
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_counters (name, value)
+            SELECT 'admins_level_' || admin_level, COUNT(*) FROM support_admins GROUP BY admin_level
+        ''')
+    
+    def rebuild_stats(self):
+        """Пересчитывает счётчики по таблицам и возвращает расхождения {имя: (было, стало)}"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT name, value FROM stats_counters')
+        before = dict(cursor.fetchall())
+        self._rebuild_stats(cursor)
+        cursor.execute('SELECT name, value FROM stats_counters')
+        after = dict(cursor.fetchall())
+        self._commit()
+        return {name: (before.get(name, 0), after.get(name, 0))
+                for name in before.keys() | after.keys()
+                if before.get(name, 0) != after.get(name, 0)}
+
+# =================== МЕТРИКИ ===================
+# /metrics в формате Prometheus; METRICS_PORT=0 — не поднимать
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+# Верхние границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    __slots__ = ('buckets', 'sum', 'count')
+    
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # последняя — больше всех границ (+Inf)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        self.buckets[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Гистограммы и счётчики в памяти процесса. Запись — только из event loop, без блокировок.
+
+    Метки передаются готовой строкой ('handler="x"'), чтобы на горячем пути не собирать словари.
+    """
+    def __init__(self):
+        self.histograms = {}  # имя -> {метки: Histogram}
+        self.counters = {}    # имя -> {метки: число}
+        self.help = {}
+    
+    def describe(self, name, text):
+        self.help[name] = text
+    
+    def observe(self, name, labels, value):
+        series = self.histograms.setdefault(name, {})
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram()
+        histogram.observe(value)
+    
+    def inc(self, name, labels, value=1):
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+    
+    def render(self):
+        """Текстовый формат экспозиции Prometheus 0.0.4"""
+        lines = []
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(series.items()):
+                cumulative = 0
+                prefix = f"{labels}," if labels else ""
+                for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), histogram.buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in sorted(series.items()):
+                lines.append(f"{name}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "Время обработки апдейта хендлером")
+metrics.describe("bot_handler_errors_total", "Исключения в хендлерах")
+metrics.describe("bot_db_seconds", "Время вызова метода Database, включая ожидание потока и коммита")
+metrics.describe("bot_db_errors_total", "Исключения в методах Database")
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.render().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# =================== КОНТРОЛЬ EVENT LOOP ===================
+# Как часто loop отмечается и как долго он может не отвечать, прежде чем снимем его стек (0 — не снимать)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", "200"))
+
+class LoopWatchdog:
+    """Следит за задержкой event loop и ловит код, который его держит.
+
+    Задача в loop каждые interval секунд отмечается и пишет фактическое опоздание
+    в bot_loop_lag_seconds. Поток-сторож видит, что отметки давно не было, и снимает
+    стек потока loop прямо во время блокировки — это и есть виновник. Метрики пишет
+    только задача в loop, когда он освободился.
+    """
+    def __init__(self, interval=LOOP_LAG_INTERVAL, stall_ms=LOOP_STALL_MS):
+        self.interval = interval
+        self.stall = stall_ms / 1000
+        self._beat = time.monotonic()
+        self._stalled_in = None  # функция, которую поток-сторож застал в loop при последней блокировке
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+    
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        if self.stall > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._stop.set()
+    
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._beat = now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            metrics.observe("bot_loop_lag_seconds", "", lag)
+            culprit, self._stalled_in = self._stalled_in, None
+            if culprit is not None:
+                metrics.inc("bot_loop_stalls_total", f'where="{culprit}"')
+                logging.warning(f"Event loop был занят {lag * 1000:.0f} мс, держал: {culprit}")
+    
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            if beat == reported or time.monotonic() - beat < self.interval + self.stall:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            reported = beat
+            self._stalled_in = self._culprit(frame)
+            logging.warning(f"Event loop не отвечает дольше {self.stall * 1000:.0f} мс, "
+                            f"стек:\n{''.join(traceback.format_stack(frame))}")
+    
+    @staticmethod
+    def _culprit(frame):
+        """Самая глубокая функция бота в стеке, а если её нет — самая глубокая вообще"""
+        innermost = frame
+        while frame is not None:
+            if frame.f_code.co_filename == __file__:
+                return frame.f_code.co_qualname
+            frame = frame.f_back
+        return innermost.f_code.co_qualname
+
+loop_watchdog = LoopWatchdog()
+metrics.describe("bot_loop_lag_seconds", "Опоздание event loop относительно запланированного пробуждения")
+metrics.describe("bot_loop_stalls_total", "Блокировки event loop дольше LOOP_STALL_MS по функции, которая его держала")
+
+# =================== АСИНХРОННЫЙ ДОСТУП К БД ===================
+# Сколько миллисекунд писатель собирает записи перед общим коммитом
+DB_COMMIT_WINDOW_MS = float(os.getenv("DB_COMMIT_WINDOW_MS", "5"))
+DB_MAX_BATCH = int(os.getenv("DB_MAX_BATCH", "256"))
+
+class GroupCommitWriter:
+    """Единственный писатель: копит записи несколько миллисекунд и коммитит их одной транзакцией.
+
+    Вызывающий получает результат метода (например lastrowid) только после того,
+    как пачка закоммичена на диск.
+    """
+    def __init__(self, database, executor, window=DB_COMMIT_WINDOW_MS / 1000, max_batch=DB_MAX_BATCH):
+        self._db = database
+        self._executor = executor
+        self._window = window
+        self._max_batch = max_batch
+        self._queue = None
+        self._task = None
+    
+    async def submit(self, func, *args, **kwargs):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((func, args, kwargs, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            if self._window > 0:
+                await asyncio.sleep(self._window)
+            while len(batch) < self._max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._flush(loop, batch)
+    
+    async def _flush(self, loop, batch):
+        calls = [(func, args, kwargs) for func, args, kwargs, _ in batch]
+        try:
+            results = await loop.run_in_executor(self._executor, self._db.run_batch, calls)
+        except Exception as e:
+            # Коммит не прошёл — ни одна запись пачки не подтверждена
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (*_, future), (ok, result) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+    
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        # Дописываем то, что успело попасть в очередь
+        pending = []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        if pending:
+            await self._flush(asyncio.get_running_loop(), pending)
+        self._task = None
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database: запросы выполняются в отдельном потоке, а не в event loop.
+
+    Имена методов те же, что у Database, но каждый вызов нужно ждать через await.
+    Записи (Database.WRITE_METHODS) идут через GroupCommitWriter.
+    """
+    def __init__(self, database):
+        self._db = database
+        # Чтения параллельно — по потоку на соединение пула, запись — всегда в одном потоке
+        self._read_executor = ThreadPoolExecutor(max_workers=database.pool.size, thread_name_prefix="db-read")
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._writer = GroupCommitWriter(database, self._write_executor)
+    
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, functools.partial(func, *args, **kwargs))
+    
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
         
-        cursor.execute('SELECT COUNT(*) FROM support_admins WHERE admin_level = 1')
-        support_admins = cursor.fetchone()[0]
+        submit = self._writer.submit if name in self._db.WRITE_METHODS else self._run
+        labels = f'method="{name}"'
         
-        cursor.execute('SELECT COUNT(*) FROM support_admins WHERE admin_level = 2')
-        full_admins = cursor.fetchone()[0]
+        async def method(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                # С копией контекста в поток БД уходит current_handler — для профилировщика SQL
+                return await submit(contextvars.copy_context().run, attr, *args, **kwargs)
+            except Exception:
+                metrics.inc("bot_db_errors_total", labels)
+                raise
+            finally:
+                metrics.observe("bot_db_seconds", labels, time.perf_counter() - start)
         
-        return {
-            'users': users,
-            'orders': orders,
-            'pending_orders': pending_orders,
-            'total_rub': round(total_rub, 2),
-            'total_usdt': round(total_usdt, 2),
-            'new_tickets': new_tickets,
-            'all_admins': all_admins,
-            'support_admins': support_admins,
-            'full_admins': full_admins,
-            'prices': PRICES
-        }
+        method.__name__ = name
+        # Кэшируем обёртку, чтобы __getattr__ не вызывался повторно
+        setattr(self, name, method)
+        return method
+    
+    # Проверки прав отвечают прямо из кэша, без перехода в поток БД
+    async def get_admin_level(self, user_id):
+        levels = self._db._admin_levels
+        if levels is None:
+            return await self._run(self._db.get_admin_level, user_id)
+        return levels.get(user_id, 0)
+    
+    async def is_support_admin(self, user_id):
+        return await self.get_admin_level(user_id) >= 1
+    
+    async def is_admin(self, user_id):
+        return await self.get_admin_level(user_id) >= 2
+    
+    async def close(self):
+        await self._writer.close()
+        self._read_executor.shutdown(wait=True)
+        self._write_executor.shutdown(wait=True)
+        self._db.pool.close()
+
+# =================== РАССЫЛКА УВЕДОМЛЕНИЙ ===================
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+# Немедленные повторы внутри одной отправки; долгие повторы делает outbox
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "2"))
+
+class TokenBucket:
+    """Ведро токенов: не больше rate отправок в секунду, всплеск до capacity"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = None
+    
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Notifier:
+    """Отправка сообщений под общим лимитом бота и лимитом на каждый чат.
+
+    Вызовы можно делать параллельно — лимиты общие.
+    На RetryAfter ждём столько, сколько просит Telegram, сетевые ошибки повторяем с backoff.
+    """
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 max_retries=NOTIFY_MAX_RETRIES):
+        self._bucket = TokenBucket(global_rate)
+        self._chat_interval = 1 / chat_rate
+        self._chat_next = {}  # chat_id -> время, раньше которого в чат писать нельзя
+        self._max_retries = max_retries
+    
+    async def _wait_chat_slot(self, chat_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._chat_next.get(chat_id, 0))
+        self._chat_next[chat_id] = slot + self._chat_interval
+        if len(self._chat_next) > 10000:
+            # Чистим чаты, у которых лимит давно истёк
+            self._chat_next = {cid: t for cid, t in self._chat_next.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+    
+    async def send(self, send_func, chat_id, **kwargs):
+        """Отправляет одно сообщение с соблюдением лимитов и повторами"""
+        for attempt in range(self._max_retries + 1):
+            await self._wait_chat_slot(chat_id)
+            await self._bucket.acquire()
+            try:
+                return await send_func(chat_id, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == self._max_retries:
+                    raise
+                self._chat_next[chat_id] = asyncio.get_running_loop().time() + e.retry_after
+            except (TelegramNetworkError, TelegramServerError):
+                if attempt == self._max_retries:
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 30))
+    
+
+# Outbox: уведомления лежат в БД и доставляются фоновым воркером, даже после перезапуска
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+
+class OutboxWorker:
+    """Вычитывает outbox пачками и отправляет через Notifier.
+
+    Неудачи повторяются с экспоненциальной задержкой, после OUTBOX_MAX_ATTEMPTS попыток
+    (или сразу, если Telegram отказал окончательно — бот заблокирован, чат не найден)
+    сообщение остаётся в таблице со статусом dead.
+    """
+    def __init__(self, database, notifier, bot):
+        self._db = database
+        self._notifier = notifier
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    def wake(self):
+        """Будит воркер сразу после записи в outbox, не дожидаясь опроса"""
+        self._wakeup.set()
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                delivered = await self.deliver_batch()
+            except Exception as e:
+                logging.exception(f"Ошибка воркера outbox: {e}")
+                delivered = 0
+            if delivered:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+    
+    async def deliver_batch(self):
+        rows = await self._db.get_due_outbox(time.time(), OUTBOX_BATCH)
+        if not rows:
+            return 0
+        results = await asyncio.gather(*[self._send(row) for row in rows], return_exceptions=True)
+        sent_ids, failures = [], []
+        for (outbox_id, chat_id, method, payload, attempts), result in zip(rows, results):
+            if not isinstance(result, Exception):
+                sent_ids.append(outbox_id)
+                continue
+            error = f"{type(result).__name__}: {result}"[:500]
+            if isinstance(result, (TelegramForbiddenError, TelegramBadRequest)) or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                print(f"Не удалось отправить уведомление {outbox_id} в чат {chat_id}: {error}")
+                failures.append((outbox_id, error, None))
+            else:
+                delay = min(2 ** attempts, OUTBOX_BACKOFF_MAX)
+                failures.append((outbox_id, error, time.time() + delay))
+        await self._db.complete_outbox(sent_ids, failures)
+        return len(rows)
+    
+    async def _send(self, row):
+        _, chat_id, method, payload, _ = row
+        return await self._notifier.send(getattr(self._bot, method), chat_id, **json.loads(payload))
 
 # =================== FSM СОСТОЯНИЯ ===================
 class Form(StatesGroup):
@@ -428,21 +2098,350 @@ class Form(StatesGroup):
     waiting_screenshot = State()
     waiting_quantity = State()  # Для ввода количества
     waiting_admin_comment = State()  # Для комментария админа
+    waiting_ticket_search = State()
+
+# =================== ХРАНИЛИЩЕ FSM ===================
+# Незаконченные сценарии старше FSM_TTL_SECONDS считаются брошенными и удаляются
+FSM_TTL_SECONDS = float(os.getenv("FSM_TTL_SECONDS", str(7 * 24 * 3600)))
+FSM_FLUSH_SECONDS = float(os.getenv("FSM_FLUSH_SECONDS", "1"))
+FSM_CACHE_IDLE_SECONDS = float(os.getenv("FSM_CACHE_IDLE_SECONDS", "600"))
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_states с кэшем в памяти и отложенной записью.
+
+    Изменения копятся в кэше и раз в FSM_FLUSH_SECONDS пишутся в БД одной пачкой.
+    Давно не используемые записи выгружаются из кэша, брошенные — удаляются из БД.
+    """
+    def __init__(self, database):
+        self._db = database
+        self._cache = {}  # key -> [state, data, updated_at]
+        self._dirty = set()
+        self._task = None
+        self._last_expire = 0
+    
+    @staticmethod
+    def _key(key: StorageKey):
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+                f"{key.business_connection_id or ''}:{key.destiny}")
+    
+    async def _record(self, key):
+        skey = self._key(key)
+        record = self._cache.get(skey)
+        if record is None:
+            row = await self._db.load_fsm_record(skey)
+            if row and row[2] >= time.time() - FSM_TTL_SECONDS:
+                record = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+            else:
+                record = [None, {}, time.time()]
+            # Пока ждали БД, запись могла появиться в кэше
+            record = self._cache.setdefault(skey, record)
+        return skey, record
+    
+    def _touch(self, skey, record):
+        record[2] = time.time()
+        self._dirty.add(skey)
+    
+    async def set_state(self, key: StorageKey, state=None):
+        skey, record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._touch(skey, record)
+    
+    async def get_state(self, key: StorageKey):
+        _, record = await self._record(key)
+        return record[0]
+    
+    async def set_data(self, key: StorageKey, data):
+        skey, record = await self._record(key)
+        record[1] = dict(data)
+        self._touch(skey, record)
+    
+    async def get_data(self, key: StorageKey):
+        _, record = await self._record(key)
+        return dict(record[1])
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(FSM_FLUSH_SECONDS)
+            try:
+                await self.flush()
+                await self.evict()
+            except Exception as e:
+                logging.exception(f"Ошибка сохранения FSM: {e}")
+    
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        records = []
+        for skey in dirty:
+            state, data, updated_at = self._cache[skey]
+            records.append((skey, state, json.dumps(data, ensure_ascii=False, separators=(',', ':')), updated_at))
+        try:
+            await self._db.save_fsm_records(records)
+        except Exception:
+            self._dirty |= dirty
+            raise
+    
+    async def evict(self):
+        now = time.time()
+        idle_before = now - FSM_CACHE_IDLE_SECONDS
+        for skey in [k for k, r in self._cache.items() if r[2] < idle_before and k not in self._dirty]:
+            del self._cache[skey]
+        # Чистка БД от брошенных сценариев — не чаще раза в минуту
+        if now - self._last_expire >= 60:
+            self._last_expire = now
+            expired = await self._db.expire_fsm_records(now - FSM_TTL_SECONDS)
+            if expired:
+                logging.info(f"Удалено брошенных FSM-состояний: {expired}")
+    
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+# =================== ТАЙМЕРЫ ===================
+# Сколько заказ ждёт оплаты (без скриншота) или проверки (со скриншотом) и сколько заявка может быть в работе
+ORDER_PAYMENT_SECONDS = float(os.getenv("ORDER_PAYMENT_SECONDS", str(24 * 3600)))
+ORDER_REVIEW_SECONDS = float(os.getenv("ORDER_REVIEW_SECONDS", str(2 * 3600)))
+TICKET_SLA_SECONDS = float(os.getenv("TICKET_SLA_SECONDS", str(4 * 3600)))
+# В памяти — только таймеры ближайших TIMER_HORIZON_SECONDS, но не больше TIMER_LOAD_LIMIT
+TIMER_HORIZON_SECONDS = float(os.getenv("TIMER_HORIZON_SECONDS", "600"))
+TIMER_LOAD_LIMIT = int(os.getenv("TIMER_LOAD_LIMIT", "10000"))
+TIMER_FIRE_BATCH = int(os.getenv("TIMER_FIRE_BATCH", "100"))
+
+metrics.describe("bot_timers_fired_total", "Сработавшие таймеры заказов и заявок")
+
+def order_due_at(screenshot):
+    """Срок таймера нового заказа: ждём оплату или, если скриншот уже есть, проверку админом"""
+    return time.time() + (ORDER_REVIEW_SECONDS if screenshot else ORDER_PAYMENT_SECONDS)
+
+def timer_notification(event, row):
+    """(метод, аргументы) уведомления о сработавшем таймере, см. Database.fire_timers"""
+    if event == 'order_expired':
+        order_id, _, product, total, currency = row[:5]
+        return "send_message", {"text": (
+            f"⌛ Заказ #{order_id} отменён: оплата не поступила вовремя.\n\n"
+            f"📦 Товар: {product}\n"
+            f"💰 Сумма: {total} {currency}\n\n"
+            f"Если ты уже оплатил — напиши в техподдержку."
+        )}
+    if event == 'order_overdue':
+        order_id, user_id, product, total, currency = row[:5]
+        return "send_message", {"text": (
+            f"⏰ ЗАКАЗ #{order_id} ЖДЁТ ПРОВЕРКИ\n\n"
+            f"🆔 Клиент: {user_id}\n"
+            f"📦 Товар: {product}\n"
+            f"💰 Сумма: {total} {currency}\n\n"
+            f"Для управления: /order_{order_id}"
+        )}
+    ticket_id, user_id, user_name, text, _, admin_name = row[:6]
+    return "send_message", {"text": (
+        f"⏰ ЗАЯВКА #{ticket_id} В РАБОТЕ ДОЛЬШЕ СРОКА\n\n"
+        f"👤 Клиент: {user_name}\n"
+        f"🆔 ID: {user_id}\n"
+        f"👨‍💼 Взял: {admin_name or 'неизвестно'}\n"
+        f"📝 Сообщение: {text[:200]}...\n\n"
+        f"Для ответа нажми: /ticket_{ticket_id}"
+    )}
+
+class TimerScheduler:
+    """Таймеры заказов и заявок. Сроки хранятся в БД (колонка due_at), в памяти — только ближайшие.
+
+    В куче лежат таймеры со сроком до horizon — окно на TIMER_HORIZON_SECONDS вперёд, не больше
+    TIMER_LOAD_LIMIT штук, поэтому память не зависит от того, сколько таймеров в базе. Когда окно
+    заканчивается, следующее читается из БД по индексу по due_at — так же состояние восстанавливается
+    после перезапуска. Новый таймер внутри окна кладётся в кучу сразу, дальний подхватится со своим окном.
+    Снятый таймер (заказ подтверждён, заявка закрыта) из кучи не удаляется: fire_timers перечитывает
+    строку и пропускает его.
+    """
+    def __init__(self, database, outbox, notification):
+        self._db = database
+        self._outbox = outbox
+        self._notification = notification
+        self._heap = []  # (срок, вид, id)
+        self._horizon = 0  # все таймеры со сроком до этого момента уже в куче
+        self._wakeup = asyncio.Event()
+        self._task = None
+    
+    def schedule(self, kind, row_id, due_at):
+        """Таймер уже записан в БД вместе со строкой; если он в текущем окне — будим планировщик"""
+        if due_at <= self._horizon:
+            heapq.heappush(self._heap, (due_at, kind, row_id))
+            self._wakeup.set()
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _load_window(self, now):
+        until = now + TIMER_HORIZON_SECONDS
+        # Окно сдвигаем до чтения: таймеры, созданные во время запроса, schedule положит в кучу сам
+        self._horizon = until
+        loaded = await self._db.get_due_timers(until, TIMER_LOAD_LIMIT)
+        if len(loaded) >= TIMER_LOAD_LIMIT:
+            # Прочитали не всё окно — оно заканчивается на последнем прочитанном сроке
+            self._horizon = loaded[-1][0]
+        # В куче могут быть те же таймеры, что и в выборке
+        self._heap = list(set(self._heap).union(loaded))
+        heapq.heapify(self._heap)
+    
+    async def _run(self):
+        while True:
+            try:
+                now = time.time()
+                if now >= self._horizon:
+                    await self._load_window(now)
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < TIMER_FIRE_BATCH:
+                    _, kind, row_id = heapq.heappop(self._heap)
+                    due.append((kind, row_id))
+                if due:
+                    events = await self._db.fire_timers(due, now, self._notification)
+                    if events:
+                        self._outbox.wake()
+                        logging.info(f"Сработало таймеров: {len(events)}")
+                    for event in events:
+                        metrics.inc("bot_timers_fired_total", f'event="{event}"')
+                    continue
+                next_due = min(self._heap[0][0], self._horizon) if self._heap else self._horizon
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(next_due - time.time(), 0))
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+            except Exception as e:
+                logging.exception(f"Ошибка планировщика таймеров: {e}")
+                # Снятые с кучи таймеры остались в БД — перечитаем окно заново
+                self._horizon = 0
+                await asyncio.sleep(OUTBOX_POLL_SECONDS)
 
 # =================== ИНИЦИАЛИЗАЦИЯ ===================
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
+db = AsyncDatabase(Database())
+
+storage = SQLiteStorage(db)
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
+notifier = Notifier()
+outbox_worker = OutboxWorker(db, notifier, bot)
+timers = TimerScheduler(db, outbox_worker, timer_notification)
 
-db = Database()
+# =================== CALLBACK-КНОПКИ ===================
+# callback_data — "действие" или "действие:аргумент" (id записи или короткий ключ).
+# Все нажатия приходят в один хендлер и ищутся в таблице по действию — за один поиск в словаре,
+# сколько бы кнопок ни было. Замер: benchmarks/callback_routing.py
+CALLBACK_HANDLERS = {}
 
-# =================== КЛАВИАТУРЫ ===================
-def main_menu(user_id):
-    admin_level = db.get_admin_level(user_id)
+def pack_callback(action, arg=None):
+    return action if arg is None else f"{action}:{arg}"
+
+def _callback_arg(arg):
+    return int(arg) if arg.isdigit() else arg
+
+def unpack_callback(data):
+    """callback_data -> (действие, аргумент); числовой аргумент превращается в int"""
+    action, sep, arg = data.partition(':')
+    if sep:
+        return action, _callback_arg(arg)
+    if data in CALLBACK_HANDLERS:
+        return data, None
+    # Старый формат "take_ticket_5" у кнопок в уже отправленных сообщениях:
+    # отрезаем хвосты по "_", пока не найдётся известное действие
+    action = data
+    while '_' in action:
+        action = action.rpartition('_')[0]
+        if action in CALLBACK_HANDLERS:
+            return action, _callback_arg(data[len(action) + 1:])
+    return data, None
+
+def on_callback(*actions):
+    """Регистрирует хендлер кнопок для действий; хендлер получает только те из state/action/item_id,
+    которые объявлены в его сигнатуре"""
+    def decorator(handler):
+        wanted = tuple(name for name in ('state', 'action', 'item_id')
+                       if name in inspect.signature(handler).parameters)
+        for action in actions:
+            CALLBACK_HANDLERS[action] = (handler, wanted)
+        return handler
+    return decorator
+
+@router.callback_query()
+async def dispatch_callback(callback: CallbackQuery, state: FSMContext):
+    action, item_id = unpack_callback(callback.data or "")
+    entry = CALLBACK_HANDLERS.get(action)
+    if entry is None:
+        # Кнопка из старой версии бота, которой больше нет
+        await callback.answer()
+        return
     
-    if admin_level >= 1:
+    handler, wanted = entry
+    available = {'state': state, 'action': action, 'item_id': item_id}
+    await handler(callback, **{name: available[name] for name in wanted})
+
+class MetricsMiddleware(BaseMiddleware):
+    """Задержка, количество и исключения по хендлерам, для кнопок — ещё и по действию"""
+    def __init__(self, event_type):
+        self.event_type = event_type
+        self._labels = {}  # (хендлер, действие) -> строка меток
+    
+    async def __call__(self, handler, event, data):
+        start = time.perf_counter()
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        action = ""
+        if isinstance(event, CallbackQuery):
+            action = unpack_callback(event.data or "")[0]
+            entry = CALLBACK_HANDLERS.get(action)
+            if entry is None:
+                action = "unknown"  # произвольный текст из старых кнопок не должен плодить метки
+            else:
+                name = entry[0].__name__
+        labels = self._labels.get((name, action))
+        if labels is None:
+            labels = self._labels[name, action] = f'event="{self.event_type}",handler="{name}",action="{action}"'
+        token = current_handler.set(name)
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", f'{labels},error="{type(e).__name__}"')
+            raise
+        finally:
+            current_handler.reset(token)
+            metrics.observe("bot_handler_seconds", labels, time.perf_counter() - start)
+
+router.message.middleware(MetricsMiddleware("message"))
+router.callback_query.middleware(MetricsMiddleware("callback_query"))
+
+# =================== КЛАВИАТУРЫ ===================
+# Клавиатуры и тексты собираются один раз на набор аргументов (уровень админа, срез цен)
+# и дальше переиспользуются. Возвращаемые объекты общие: менять их нельзя, только собирать новые.
+def render_cache(maxsize=None):
+    return functools.lru_cache(maxsize=maxsize)
+
+async def main_menu(user_id):
+    return main_menu_keyboard(await db.get_admin_level(user_id) >= 1)
+
+@render_cache()
+def main_menu_keyboard(is_admin):
+    if is_admin:
         keyboard = ReplyKeyboardMarkup(
             keyboard=[
                 [KeyboardButton(text="🛍️ Магазин"), KeyboardButton(text="🛒 Мои заказы")],
@@ -461,6 +2460,7 @@ def main_menu(user_id):
         )
     return keyboard
 
+@render_cache()
 def shop_keyboard():
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -477,27 +2477,30 @@ def shop_keyboard():
     )
     return keyboard
 
-def premium_options_keyboard():
+# По последним срезам цен: новая версия каталога — новая клавиатура
+@render_cache(maxsize=2)
+def premium_options_keyboard(prices):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="3 мес - 15 USDT", callback_data="premium_3"),
-                InlineKeyboardButton(text="6 мес - 19 USDT", callback_data="premium_6")
+                InlineKeyboardButton(text=f"3 мес - {prices['premium_3']} USDT", callback_data=pack_callback("premium", 3)),
+                InlineKeyboardButton(text=f"6 мес - {prices['premium_6']} USDT", callback_data=pack_callback("premium", 6))
             ],
             [
-                InlineKeyboardButton(text="12 мес - 28 USDT", callback_data="premium_12"),
+                InlineKeyboardButton(text=f"12 мес - {prices['premium_12']} USDT", callback_data=pack_callback("premium", 12)),
                 InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_shop")
             ]
         ]
     )
     return keyboard
 
+@render_cache()
 def payment_methods_keyboard():
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="🤖 Crypto Bot", callback_data="pay_crypto_bot"),
-                InlineKeyboardButton(text="💼 BEP20", callback_data="pay_bep20")
+                InlineKeyboardButton(text="🤖 Crypto Bot", callback_data=pack_callback("pay", "crypto_bot")),
+                InlineKeyboardButton(text="💼 BEP20", callback_data=pack_callback("pay", "bep20"))
             ],
             [
                 InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_shop"),
@@ -507,11 +2510,13 @@ def payment_methods_keyboard():
     )
     return keyboard
 
+@render_cache()
 def admin_menu(user_level):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📋 Новые заявки", callback_data="admin_new_tickets")],
         [InlineKeyboardButton(text="📝 Мои заявки", callback_data="admin_my_tickets")],
         [InlineKeyboardButton(text="📚 Все заявки", callback_data="all_tickets")],
+        [InlineKeyboardButton(text="🔎 Поиск заявок", callback_data="search_tickets")],
         [InlineKeyboardButton(text="🛒 Новые заказы", callback_data="admin_pending_orders")],
         [InlineKeyboardButton(text="📦 Все заказы", callback_data="admin_all_orders")],
         [InlineKeyboardButton(text="👨‍💼 Управление ТП", callback_data="admin_manage_support")],
@@ -527,6 +2532,7 @@ def admin_menu(user_level):
     
     return keyboard
 
+@render_cache()
 def support_management_menu(user_level):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Добавить ТП-админа", callback_data="admin_add_support")],
@@ -545,6 +2551,7 @@ def support_management_menu(user_level):
     
     return keyboard
 
+@render_cache()
 def levels_management_menu():
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Список с уровнями", callback_data="admin_list_with_levels")],
@@ -554,19 +2561,21 @@ def levels_management_menu():
     ])
     return keyboard
 
+@render_cache()
 def prices_management_menu():
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="⭐ Цена звезды", callback_data="price_star")],
-            [InlineKeyboardButton(text="💎 Цена TON", callback_data="price_ton")],
-            [InlineKeyboardButton(text="🏆 Premium 3 мес", callback_data="price_premium_3")],
-            [InlineKeyboardButton(text="🏆 Premium 6 мес", callback_data="price_premium_6")],
-            [InlineKeyboardButton(text="🏆 Premium 12 мес", callback_data="price_premium_12")],
+            [InlineKeyboardButton(text="⭐ Цена звезды", callback_data=pack_callback("price", "star"))],
+            [InlineKeyboardButton(text="💎 Цена TON", callback_data=pack_callback("price", "ton"))],
+            [InlineKeyboardButton(text="🏆 Premium 3 мес", callback_data=pack_callback("price", "premium_3"))],
+            [InlineKeyboardButton(text="🏆 Premium 6 мес", callback_data=pack_callback("price", "premium_6"))],
+            [InlineKeyboardButton(text="🏆 Premium 12 мес", callback_data=pack_callback("price", "premium_12"))],
             [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back")]
         ]
     )
     return keyboard
 
+@render_cache()
 def cancel_keyboard():
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -575,37 +2584,105 @@ def cancel_keyboard():
     )
     return keyboard
 
-def order_management_keyboard(order_id):
+# =================== ТЕКСТЫ ===================
+SHOP_TEXT = (
+    "🛍️ Магазин Art Stars\n\n"
+    "Что хочешь купить? 👇"
+)
+
+@render_cache(maxsize=2)
+def rates_text(prices):
+    return (
+        "💰 Текущие курсы:\n\n"
+        f"⭐ Звезда: {prices['star_rate']}₽\n"
+        f"💎 TON: {prices['ton_rate']}₽\n"
+        f"👑 Premium 3 мес: {prices['premium_3']} USDT\n"
+        f"👑 Premium 6 мес: {prices['premium_6']} USDT\n"
+        f"👑 Premium 12 мес: {prices['premium_12']} USDT\n\n"
+        "🔄 Курсы обновляются автоматически\n"
+        "💎 Самый выгодный курс на рынке!"
+    )
+
+@render_cache(maxsize=2)
+def stars_offer_text(prices):
+    return (
+        "⭐ Покупка звёзд\n\n"
+        f"Цена: {prices['star_rate']}₽ за звезду\n"
+        "Минимум: 100 звёзд\n"
+        "Максимум: 25,000 звёзд\n\n"
+        "Введи количество звёзд (от 100 до 25000):\n\n"
+        "Используй /cancel для отмены"
+    )
+
+@render_cache(maxsize=2)
+def ton_offer_text(prices):
+    return (
+        "💎 Покупка TON\n\n"
+        f"Цена: {prices['ton_rate']}₽ за TON\n"
+        "Минимум: 2 TON\n"
+        "Максимум: 165 TON\n\n"
+        "Введи количество TON (от 2 до 165):\n\n"
+        "Используй /cancel для отмены"
+    )
+
+@render_cache(maxsize=2)
+def prices_admin_text(prices):
+    text = f"💰 Текущие цены (версия {prices.version}):\n\n"
+    text += f"⭐ Звезда: {prices['star_rate']}₽\n"
+    text += f"💎 TON: {prices['ton_rate']}₽\n"
+    text += f"🏆 Premium 3 мес: {prices['premium_3']} USDT\n"
+    text += f"🏆 Premium 6 мес: {prices['premium_6']} USDT\n"
+    text += f"🏆 Premium 12 мес: {prices['premium_12']} USDT\n\n"
+    text += "👇 Выбери цену для изменения:"
+    return text
+
+def pager_row(view, first_id, last_id, has_prev, has_next):
+    """Кнопки листания: курсором служит id крайней записи на странице"""
+    row = []
+    if has_prev:
+        row.append(InlineKeyboardButton(text="◀️", callback_data=pack_callback(f"page_{view}_prev", first_id)))
+    if has_next:
+        row.append(InlineKeyboardButton(text="▶️", callback_data=pack_callback(f"page_{view}_next", last_id)))
+    return row
+
+def order_management_keyboard(order_id, pager=None):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"complete_order_{order_id}"),
-                InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_order_{order_id}")
+                InlineKeyboardButton(text="✅ Подтвердить", callback_data=pack_callback("complete_order", order_id)),
+                InlineKeyboardButton(text="❌ Отменить", callback_data=pack_callback("cancel_order", order_id))
             ],
             [
-                InlineKeyboardButton(text="💬 Комментарий", callback_data=f"comment_order_{order_id}"),
+                InlineKeyboardButton(text="💬 Комментарий", callback_data=pack_callback("comment_order", order_id)),
                 InlineKeyboardButton(text="📋 Все заказы", callback_data="admin_all_orders")
             ]
         ]
     )
+    
+    if pager:
+        keyboard.inline_keyboard.append(pager)
+    
     return keyboard
 
-def ticket_management_keyboard(ticket_id, status):
+def ticket_management_keyboard(ticket_id, status, pager=None):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
     
     if status == 'new':
         keyboard.inline_keyboard.append([
-            InlineKeyboardButton(text="✅ Взять в работу", callback_data=f"take_ticket_{ticket_id}")
+            InlineKeyboardButton(text="✅ Взять в работу", callback_data=pack_callback("take_ticket", ticket_id))
         ])
     elif status == 'in_progress':
         keyboard.inline_keyboard.append([
-            InlineKeyboardButton(text="💬 Ответить", callback_data=f"reply_ticket_{ticket_id}")
+            InlineKeyboardButton(text="💬 Ответить", callback_data=pack_callback("reply_ticket", ticket_id))
         ])
     
     keyboard.inline_keyboard.append([
-        InlineKeyboardButton(text="✅ Закрыть", callback_data=f"close_ticket_{ticket_id}")
+        InlineKeyboardButton(text="✅ Закрыть", callback_data=pack_callback("close_ticket", ticket_id))
     ])
     
+    if pager:
+        keyboard.inline_keyboard.append(pager)
+    
     keyboard.inline_keyboard.append([
         InlineKeyboardButton(text="📚 Все заявки", callback_data="all_tickets"),
         InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back")
@@ -616,7 +2693,7 @@ def ticket_management_keyboard(ticket_id, status):
 # =================== ОСНОВНЫЕ КОМАНДЫ ===================
 @router.message(CommandStart())
 async def cmd_start(message: Message):
-    db.add_user(message.from_user.id, 
+    await db.add_user(message.from_user.id, 
                 message.from_user.username, 
                 message.from_user.full_name)
     
@@ -628,47 +2705,39 @@ async def cmd_start(message: Message):
         "• 🛍 Проверить свои заказы\n"
         "• 🆘 Написать в поддержку\n\n"
         "👇 Используй кнопки ниже:",
-        reply_markup=main_menu(message.from_user.id)
+        reply_markup=await main_menu(message.from_user.id)
     )
 
 @router.message(F.text == "🛍️ Магазин")
 async def open_shop(message: Message):
-    await message.answer(
-        "🛍️ Магазин Art Stars\n\n"
-        "Что хочешь купить? 👇",
-        reply_markup=shop_keyboard()
-    )
+    await message.answer(SHOP_TEXT, reply_markup=shop_keyboard())
 
 @router.message(F.text == "💰 Курсы")
 async def show_rates(message: Message):
-    rates_text = (
-        "💰 Текущие курсы:\n\n"
-        f"⭐ Звезда: {PRICES['star_rate']}₽\n"
-        f"💎 TON: {PRICES['ton_rate']}₽\n"
-        f"👑 Premium 3 мес: {PRICES['premium_3']} USDT\n"
-        f"👑 Premium 6 мес: {PRICES['premium_6']} USDT\n"
-        f"👑 Premium 12 мес: {PRICES['premium_12']} USDT\n\n"
-        "🔄 Курсы обновляются автоматически\n"
-        "💎 Самый выгодный курс на рынке!"
-    )
-    await message.answer(rates_text)
+    await message.answer(rates_text(price_catalog.snapshot))
 
-@router.message(F.text == "🛒 Мои заказы")
-async def my_orders(message: Message):
-    orders = db.get_orders_by_user(message.from_user.id)
+def page_directions(cursor_id, backwards, has_more):
+    """Есть ли страницы до и после текущей"""
+    if backwards:
+        return has_more, True
+    return cursor_id is not None, has_more
+
+async def render_my_orders(user_id, cursor_id=None, backwards=False):
+    """Текст и клавиатура одной страницы заказов пользователя"""
+    orders, has_more = await db.get_user_orders_page(user_id, cursor_id, backwards)
     
     if not orders:
-        await message.answer("📭 У тебя пока нет заказов.\n\nНажми «🛍️ Магазин» чтобы сделать покупку!")
-        return
+        return None, None
     
     text = "🛒 Твои заказы:\n\n"
-    for order in orders[:10]:  # Показываем последние 10 заказов
+    for order in orders:
         status_emoji = {
             'pending': '🕐 Ожидает',
             'processing': '🔄 В обработке',
             'completed': '✅ Выполнен',
-            'cancelled': '❌ Отменён'
-        }.get(order[7], '❓ Неизвестно')
+            'cancelled': '❌ Отменён',
+            'expired': '⌛ Истёк'
+        }.get(order[11], '❓ Неизвестно')
         
         text += f"📦 Заказ #{order[0]}\n"
         text += f"Товар: {order[2]}\n"
@@ -679,20 +2748,30 @@ async def my_orders(message: Message):
         if order[12]:  # admin_comment
             text += f"Комментарий: {order[12]}\n"
         
-        text += f"Дата: {order[13].split()[0] if ' ' in str(order[13]) else order[13][:10]}\n\n"
+        text += f"Дата: {order[14].split()[0] if ' ' in str(order[14]) else order[14][:10]}\n\n"
     
-    if len(orders) > 10:
-        text += f"... и ещё {len(orders) - 10} заказов"
+    has_prev, has_next = page_directions(cursor_id, backwards, has_more)
+    pager = pager_row("myorders", orders[0][0], orders[-1][0], has_prev, has_next)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[pager]) if pager else None
+    return text, keyboard
+
+@router.message(F.text == "🛒 Мои заказы")
+async def my_orders(message: Message):
+    text, keyboard = await render_my_orders(message.from_user.id)
     
-    await message.answer(text)
+    if not text:
+        await message.answer("📭 У тебя пока нет заказов.\n\nНажми «🛍️ Магазин» чтобы сделать покупку!")
+        return
+    
+    await message.answer(text, reply_markup=keyboard)
 
 @router.message(F.text == "👑 Админ-панель")
 async def admin_panel_access(message: Message):
-    admin_level = db.get_admin_level(message.from_user.id)
+    admin_level = await db.get_admin_level(message.from_user.id)
     
     if admin_level < 1:
         await message.answer("❌ У тебя нет доступа к админ-панели!", 
-                           reply_markup=main_menu(message.from_user.id))
+                           reply_markup=await main_menu(message.from_user.id))
         return
     
     await message.answer(
@@ -702,34 +2781,27 @@ async def admin_panel_access(message: Message):
     )
 
 # =================== ПОКУПКА ТОВАРОВ ===================
-@router.callback_query(F.data == "buy_stars")
+@on_callback("buy_stars")
 async def buy_stars_start(callback: CallbackQuery, state: FSMContext):
-    await callback.message.edit_text(
-        "⭐ Покупка звёзд\n\n"
-        f"Цена: {PRICES['star_rate']}₽ за звезду\n"
-        "Минимум: 100 звёзд\n"
-        "Максимум: 25,000 звёзд\n\n"
-        "Введи количество звёзд (от 100 до 25000):\n\n"
-        "Используй /cancel для отмены"
-    )
+    await callback.message.edit_text(stars_offer_text(price_catalog.snapshot))
     await state.set_state(Form.waiting_quantity)
     await state.update_data(product_type="stars", min_value=100, max_value=25000)
     await callback.answer()
 
-@router.callback_query(F.data == "buy_premium")
+@on_callback("buy_premium")
 async def buy_premium_start(callback: CallbackQuery):
     await callback.message.edit_text(
         "👑 Покупка Premium\n\n"
         "Выбери срок подписки:",
-        reply_markup=premium_options_keyboard()
+        reply_markup=premium_options_keyboard(price_catalog.snapshot)
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("premium_"))
-async def select_premium_option(callback: CallbackQuery, state: FSMContext):
-    months = int(callback.data.split("_")[1])
-    price_key = f"premium_{months}"
-    price = PRICES[price_key]
+@on_callback("premium")
+async def select_premium_option(callback: CallbackQuery, state: FSMContext, item_id):
+    months = item_id
+    prices = price_catalog.snapshot
+    price = prices[f"premium_{months}"]
     
     await callback.message.edit_text(
         f"👑 Premium на {months} месяцев\n\n"
@@ -737,19 +2809,13 @@ async def select_premium_option(callback: CallbackQuery, state: FSMContext):
         f"Выбери способ оплаты👇",
         reply_markup=payment_methods_keyboard()
     )
-    await state.update_data(product_type="premium", months=months, quantity=1, total=price, currency="USDT")
+    await state.update_data(product_type="premium", months=months, quantity=1, total=price, currency="USDT",
+                            price_version=prices.version)
     await callback.answer()
 
-@router.callback_query(F.data == "buy_ton")
+@on_callback("buy_ton")
 async def buy_ton_start(callback: CallbackQuery, state: FSMContext):
-    await callback.message.edit_text(
-        "💎 Покупка TON\n\n"
-        f"Цена: {PRICES['ton_rate']}₽ за TON\n"
-        "Минимум: 2 TON\n"
-        "Максимум: 165 TON\n\n"
-        "Введи количество TON (от 2 до 165):\n\n"
-        "Используй /cancel для отмены"
-    )
+    await callback.message.edit_text(ton_offer_text(price_catalog.snapshot))
     await state.set_state(Form.waiting_quantity)
     await state.update_data(product_type="ton", min_value=2, max_value=165)
     await callback.answer()
@@ -759,7 +2825,7 @@ async def process_quantity(message: Message, state: FSMContext):
     if message.text and message.text.startswith('/cancel'):
         await state.clear()
         await message.answer("❌ Покупка отменена", 
-                           reply_markup=main_menu(message.from_user.id))
+                           reply_markup=await main_menu(message.from_user.id))
         return
     
     data = await state.get_data()
@@ -774,13 +2840,14 @@ async def process_quantity(message: Message, state: FSMContext):
             await message.answer(f"❌ Введи число от {min_val} до {max_val}!")
             return
         
-        # Рассчитываем сумму
+        # Рассчитываем сумму по одному срезу цен и запоминаем его версию для заказа
+        prices = price_catalog.snapshot
         if product_type == 'stars':
-            total = quantity * PRICES['star_rate']
+            total = quantity * prices['star_rate']
             product_name = "Звёзды"
             currency = "RUB"
         else:  # ton
-            total = quantity * PRICES['ton_rate']
+            total = quantity * prices['ton_rate']
             product_name = "TON"
             currency = "RUB"
         
@@ -788,7 +2855,8 @@ async def process_quantity(message: Message, state: FSMContext):
             quantity=quantity,
             total=total,
             product_name=product_name,
-            currency=currency
+            currency=currency,
+            price_version=prices.version
         )
         
         await message.answer(
@@ -803,9 +2871,9 @@ async def process_quantity(message: Message, state: FSMContext):
         await message.answer("❌ Введи число! Например: 1000 или 5.5")
 
 # =================== ВЫБОР СПОСОБА ОПЛАТЫ ===================
-@router.callback_query(F.data.startswith("pay_"))
-async def select_payment_method(callback: CallbackQuery, state: FSMContext):
-    payment_method = callback.data.split("_")[1]
+@on_callback("pay")
+async def select_payment_method(callback: CallbackQuery, state: FSMContext, item_id):
+    payment_method = item_id
     data = await state.get_data()
     
     if payment_method == "crypto_bot":
@@ -885,11 +2953,11 @@ async def select_payment_method(callback: CallbackQuery, state: FSMContext):
     
     await callback.answer()
 
-@router.callback_query(F.data == "copy_wallet")
+@on_callback("copy_wallet")
 async def copy_wallet_address(callback: CallbackQuery):
     await callback.answer("Адрес скопирован в буфер обмена! Отправляй только USDT (BEP20)", show_alert=True)
 
-@router.callback_query(F.data == "ready_screenshot")
+@on_callback("ready_screenshot")
 async def request_screenshot(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer(
         "📸 Пришли скриншот подтверждения оплаты:\n\n"
@@ -906,7 +2974,7 @@ async def process_screenshot(message: Message, state: FSMContext):
     if message.text and message.text.startswith('/cancel'):
         await state.clear()
         await message.answer("❌ Покупка отменена", 
-                           reply_markup=main_menu(message.from_user.id))
+                           reply_markup=await main_menu(message.from_user.id))
         return
     
     # Проверяем, есть ли фото
@@ -920,8 +2988,27 @@ async def process_screenshot(message: Message, state: FSMContext):
     file_id = message.photo[-1].file_id
     file_type = "photo"
     
-    # Создаем заказ в базе
-    order_id = db.create_order(
+    # Уведомление всем админам (и ТП и Админам) пишется в outbox вместе с заказом
+    def new_order_notification(order_id):
+        return "send_photo", {
+            "photo": file_id,
+            "caption": (
+                f"🛒 НОВЫЙ ЗАКАЗ #{order_id}\n\n"
+                f"👤 Клиент: {message.from_user.full_name or 'Без имени'}\n"
+                f"🆔 ID: {message.from_user.id}\n"
+                f"📦 Товар: {data.get('product_name', 'Товар')}\n"
+                f"📊 Количество: {data.get('quantity', 0)}\n"
+                f"💰 Сумма: {data.get('total', 0)} {data.get('currency', '')}\n"
+                f"💳 Способ: {'Crypto Bot' if data.get('payment_method') == 'crypto_bot' else 'BEP20'}\n"
+                f"📝 Username: @{message.from_user.username or 'нет'}\n\n"
+                f"Ожидает проверки и подтверждения!\n"
+                f"Для управления: /order_{order_id}"
+            )
+        }
+    
+    # Создаем заказ в базе; скриншот уже есть — таймер ждёт проверки админом
+    due_at = order_due_at(file_id)
+    order_id = await db.create_order(
         message.from_user.id,
         data.get('product_name', 'Товар'),
         data.get('quantity', 0),
@@ -931,32 +3018,13 @@ async def process_screenshot(message: Message, state: FSMContext):
         data.get('payment_method'),
         data.get('crypto_bot_link'),
         data.get('bep20_wallet'),
-        f"{file_id}_{file_type}"  # Сохраняем ID файла
+        f"{file_id}_{file_type}",  # Сохраняем ID файла
+        price_version=data.get('price_version'),
+        admin_notification=new_order_notification,
+        due_at=due_at
     )
-    
-    # Отправляем уведомление всем админам (и ТП и Админам)
-    admins = db.get_all_support_admins()
-    
-    for admin in admins:
-        try:
-            await bot.send_photo(
-                admin[0],
-                photo=file_id,
-                caption=(
-                    f"🛒 НОВЫЙ ЗАКАЗ #{order_id}\n\n"
-                    f"👤 Клиент: {message.from_user.full_name or 'Без имени'}\n"
-                    f"🆔 ID: {message.from_user.id}\n"
-                    f"📦 Товар: {data.get('product_name', 'Товар')}\n"
-                    f"📊 Количество: {data.get('quantity', 0)}\n"
-                    f"💰 Сумма: {data.get('total', 0)} {data.get('currency', '')}\n"
-                    f"💳 Способ: {'Crypto Bot' if data.get('payment_method') == 'crypto_bot' else 'BEP20'}\n"
-                    f"📝 Username: @{message.from_user.username or 'нет'}\n\n"
-                    f"Ожидает проверки и подтверждения!\n"
-                    f"Для управления: /order_{order_id}"
-                )
-            )
-        except Exception as e:
-            print(f"Не удалось отправить админу {admin[0]}: {e}")
+    outbox_worker.wake()
+    timers.schedule('order', order_id, due_at)
     
     await message.answer(
         f"✅ Заказ #{order_id} создан!\n\n"
@@ -965,7 +3033,7 @@ async def process_screenshot(message: Message, state: FSMContext):
         f"💳 Способ: {'Crypto Bot' if data.get('payment_method') == 'crypto_bot' else 'BEP20'}\n\n"
         f"Администратор проверит оплату и активирует заказ в течение 15 минут.\n"
         f"Следи за уведомлениями! 🎉",
-        reply_markup=main_menu(message.from_user.id)
+        reply_markup=await main_menu(message.from_user.id)
     )
     
     await state.clear()
@@ -987,12 +3055,43 @@ async def support_start(message: Message, state: FSMContext):
     )
     await state.set_state(Form.waiting_support_message)
 
+def ticket_notification(ticket_id, user_id, user_name, text, file_id=None, file_type=None,
+                        title="🆘 НОВАЯ ЗАЯВКА"):
+    """(метод, аргументы) уведомления админу о заявке; с фото или документом — файл с подписью"""
+    # Если есть файл - отправляем его
+    if file_id and file_type in ("photo", "document"):
+        caption = (
+            f"{title} #{ticket_id}\n\n"
+            f"👤 Клиент: {user_name}\n"
+            f"🆔 ID: {user_id}\n"
+            f"📝 Сообщение: {text[:100]}...\n\n"
+            f"Для ответа нажми: /ticket_{ticket_id}"
+        )
+        if file_type == "photo":
+            return "send_photo", {"photo": file_id, "caption": caption}
+        return "send_document", {"document": file_id, "caption": caption}
+    # Если нет файла - просто текст
+    return "send_message", {
+        "text": (
+            f"{title} #{ticket_id}\n\n"
+            f"👤 Клиент: {user_name}\n"
+            f"🆔 ID: {user_id}\n"
+            f"📝 Сообщение: {text[:200]}...\n\n"
+            f"Для ответа нажми: /ticket_{ticket_id}"
+        )
+    }
+
+def escalation_notification(ticket, senior):
+    """Заявку не взяли вовремя: следующему админу — «ждёт ответа», старшим — «без ответа»"""
+    title = "🚨 ЗАЯВКА БЕЗ ОТВЕТА" if senior else "⏰ ЗАЯВКА ЖДЁТ ОТВЕТА"
+    return ticket_notification(*ticket, title=title)
+
 @router.message(Form.waiting_support_message)
 async def support_message_received(message: Message, state: FSMContext):
     if message.text and message.text.startswith('/cancel'):
         await state.clear()
         await message.answer("❌ Создание заявки отменено", 
-                           reply_markup=main_menu(message.from_user.id))
+                           reply_markup=await main_menu(message.from_user.id))
         return
     
     # Получаем текст сообщения или описание вложения
@@ -1020,81 +3119,42 @@ async def support_message_received(message: Message, state: FSMContext):
         if not clean_text or clean_text == "📎 Вложение":
             clean_text = f"📎 Файл: {doc_name}"
     
-    # Создаём заявку
-    ticket_id = db.create_support_ticket(
-        message.from_user.id,
-        message.from_user.full_name or f"User_{message.from_user.id}",
-        clean_text,
-        file_id,
-        file_type
-    )
+    # Уведомление админу, которому назначена заявка, пишется в outbox вместе с заявкой
+    def new_ticket_notification(ticket_id):
+        return ticket_notification(ticket_id, message.from_user.id, message.from_user.full_name or 'Без имени',
+                                   clean_text, file_id, file_type)
     
-    # Отправляем всем админам уведомление (и ТП и Админам)
-    admins = db.get_all_support_admins()
-    
-    for admin in admins:
-        try:
-            # Если есть файл - отправляем его
-            if file_id:
-                if file_type == "photo":
-                    await bot.send_photo(
-                        admin[0],
-                        photo=file_id,
-                        caption=(
-                            f"🆘 НОВАЯ ЗАЯВКА #{ticket_id}\n\n"
-                            f"👤 Клиент: {message.from_user.full_name or 'Без имени'}\n"
-                            f"🆔 ID: {message.from_user.id}\n"
-                            f"📝 Сообщение: {clean_text[:100]}...\n\n"
-                            f"Для ответа нажми: /ticket_{ticket_id}"
-                        )
-                    )
-                elif file_type == "document":
-                    await bot.send_document(
-                        admin[0],
-                        document=file_id,
-                        caption=(
-                            f"🆘 НОВАЯ ЗАЯВКА #{ticket_id}\n\n"
-                            f"👤 Клиент: {message.from_user.full_name or 'Без имени'}\n"
-                            f"🆔 ID: {message.from_user.id}\n"
-                            f"📝 Сообщение: {clean_text[:100]}...\n\n"
-                            f"Для ответа нажми: /ticket_{ticket_id}"
-                        )
-                    )
-            else:
-                # Если нет файла - просто текст
-                await bot.send_message(
-                    admin[0],
-                    (
-                        f"🆘 НОВАЯ ЗАЯВКА #{ticket_id}\n\n"
-                        f"👤 Клиент: {message.from_user.full_name or 'Без имени'}\n"
-                        f"🆔 ID: {message.from_user.id}\n"
-                        f"📝 Сообщение: {clean_text[:200]}...\n\n"
-                        f"Для ответа нажми: /ticket_{ticket_id}"
-                    )
-                )
-        except Exception as e:
-            print(f"Не удалось отправить админу {admin[0]}: {e}")
+    # Создаём заявку
+    ticket_id = await db.create_support_ticket(
+        message.from_user.id,
+        message.from_user.full_name or f"User_{message.from_user.id}",
+        clean_text,
+        file_id,
+        file_type,
+        admin_notification=new_ticket_notification
+    )
+    outbox_worker.wake()
     
     # Ответ пользователю
     await message.answer(
         f"✅ Заявка создана!\n\n"
         f"Номер: #{ticket_id}\n"
-        "ТП-админы уже получили твоё сообщение и скоро ответят.\n\n"
+        "ТП-админ уже получил твоё сообщение и скоро ответит.\n\n"
         "Жди ответа здесь в чате!",
-        reply_markup=main_menu(message.from_user.id)
+        reply_markup=await main_menu(message.from_user.id)
     )
     await state.clear()
 
 # =================== КОМАНДЫ ДЛЯ АДМИНОВ ===================
 @router.message(F.text.startswith("/ticket_"))
 async def admin_view_ticket(message: Message):
-    if not db.is_support_admin(message.from_user.id):
+    if not await db.is_support_admin(message.from_user.id):
         await message.answer("❌ Ты не ТП-админ!")
         return
     
     try:
         ticket_id = int(message.text.split("_")[1])
-        ticket = db.get_ticket_by_id(ticket_id)
+        ticket = await db.get_ticket_by_id(ticket_id)
         
         if not ticket:
             await message.answer("❌ Заявка не найдена!")
@@ -1108,7 +3168,7 @@ async def admin_view_ticket(message: Message):
 
 async def show_ticket_details(message: Message, ticket_id, ticket=None):
     if not ticket:
-        ticket = db.get_ticket_by_id(ticket_id)
+        ticket = await db.get_ticket_by_id(ticket_id)
     
     if not ticket:
         await message.answer("❌ Заявка не найдена!")
@@ -1125,7 +3185,7 @@ async def show_ticket_details(message: Message, ticket_id, ticket=None):
             file_info = "📎 Есть документ"
     
     # Получаем ответы на заявку
-    replies = db.get_ticket_replies(ticket_id)
+    replies = await db.get_ticket_replies(ticket_id)
     
     text = (
         f"🆘 Заявка #{ticket[0]}\n\n"
@@ -1176,7 +3236,7 @@ async def show_ticket_details(message: Message, ticket_id, ticket=None):
 
 @router.message(F.text.startswith("/order_"))
 async def admin_view_order(message: Message):
-    if not db.is_support_admin(message.from_user.id):
+    if not await db.is_support_admin(message.from_user.id):
         await message.answer("❌ Ты не ТП-админ!")
         return
     
@@ -1188,7 +3248,7 @@ async def admin_view_order(message: Message):
         await message.answer("❌ Ошибка! Используй: /order_номер")
 
 async def show_order_admin(message: Message, order_id):
-    order = db.get_order_by_id(order_id)
+    order = await db.get_order_by_id(order_id)
     
     if not order:
         await message.answer("❌ Заказ не найден!")
@@ -1199,30 +3259,31 @@ async def show_order_admin(message: Message, order_id):
         'pending': '🕐 Ожидает',
         'processing': '🔄 В обработке',
         'completed': '✅ Выполнен',
-        'cancelled': '❌ Отменён'
-    }.get(order[7], '❓ Неизвестно')
+        'cancelled': '❌ Отменён',
+        'expired': '⌛ Истёк'
+    }.get(order[11], '❓ Неизвестно')
     
     payment_method = {
         'crypto_bot': '🤖 Crypto Bot',
         'bep20': '💼 BEP20'
-    }.get(order[8], 'Не указан')
+    }.get(order[7], 'Не указан')
     
     text = (
         f"🛒 Заказ #{order[0]}\n\n"
         f"{status_emoji}\n"
-        f"👤 Клиент: {order[18] or 'Без имени'} (@{order[17] or 'нет'})\n"
+        f"👤 Клиент: {order[19] or 'Без имени'} (@{order[18] or 'нет'})\n"
         f"🆔 ID: {order[1]}\n"
         f"📦 Товар: {order[2]}\n"
         f"📊 Количество: {order[3]}\n"
         f"💰 Сумма: {order[4]} {order[5]}\n"
         f"💳 Способ: {payment_method}\n"
-        f"📅 Дата: {order[13].split()[0] if ' ' in str(order[13]) else order[13][:10]}\n"
+        f"📅 Дата: {order[14].split()[0] if ' ' in str(order[14]) else order[14][:10]}\n"
     )
     
     if order[12]:  # admin_comment
         text += f"💬 Комментарий: {order[12]}\n"
     
-    if order[11]:  # screenshot
+    if order[10]:  # screenshot
         text += f"📸 Есть скриншот оплаты\n"
     
     await message.answer(
@@ -1231,33 +3292,38 @@ async def show_order_admin(message: Message, order_id):
     )
 
 # =================== УПРАВЛЕНИЕ ЗАЯВКАМИ ===================
-@router.callback_query(F.data == "admin_new_tickets")
+@on_callback("admin_new_tickets")
 async def show_new_tickets(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    tickets = db.get_new_tickets()
-    
-    if not tickets:
+    if not await show_new_tickets_page(callback):
         await callback.message.edit_text(
             "✅ Нет новых заявок!\n\n"
             "Все заявки обработаны 🎉",
-            reply_markup=admin_menu(db.get_admin_level(callback.from_user.id))
+            reply_markup=admin_menu(await db.get_admin_level(callback.from_user.id))
         )
-        await callback.answer()
-        return
-    
-    # Показываем первую заявку
-    await show_ticket_details_callback(callback, tickets[0][0])
     await callback.answer()
 
-async def show_ticket_details_callback(callback: CallbackQuery, ticket_id):
-    ticket = db.get_ticket_by_id(ticket_id)
+async def show_new_tickets_page(callback: CallbackQuery, cursor_id=None, backwards=False):
+    tickets, has_more = await db.get_new_tickets_page(cursor_id, backwards)
+    if not tickets:
+        return False
+    
+    has_prev, has_next = page_directions(cursor_id, backwards, has_more)
+    ticket = tickets[0]
+    await show_ticket_details_callback(callback, ticket[0], ticket=ticket,
+                                       pager=pager_row("newtickets", ticket[0], ticket[0], has_prev, has_next))
+    return True
+
+async def show_ticket_details_callback(callback: CallbackQuery, ticket_id, ticket=None, pager=None):
+    if ticket is None:
+        ticket = await db.get_ticket_by_id(ticket_id)
     
     if not ticket:
         await callback.message.edit_text("❌ Заявка не найдена!", 
-                                       reply_markup=admin_menu(db.get_admin_level(callback.from_user.id)))
+                                       reply_markup=admin_menu(await db.get_admin_level(callback.from_user.id)))
         return
     
     # Форматируем текст заявки
@@ -1271,7 +3337,7 @@ async def show_ticket_details_callback(callback: CallbackQuery, ticket_id):
             file_info = "📎 Есть документ"
     
     # Получаем ответы на заявку
-    replies = db.get_ticket_replies(ticket_id)
+    replies = await db.get_ticket_replies(ticket_id)
     
     text = (
         f"🆘 Заявка #{ticket[0]}\n\n"
@@ -1299,52 +3365,74 @@ async def show_ticket_details_callback(callback: CallbackQuery, ticket_id):
     # Для callback_query мы не можем отправлять фото, только текст
     await callback.message.edit_text(
         text,
-        reply_markup=ticket_management_keyboard(ticket_id, ticket[6])
+        reply_markup=ticket_management_keyboard(ticket_id, ticket[6], pager)
     )
 
-@router.callback_query(F.data == "admin_my_tickets")
+@on_callback("admin_my_tickets")
 async def show_my_tickets(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    tickets = db.get_my_tickets(callback.from_user.id)
-    
-    if not tickets:
+    if not await show_my_tickets_page(callback):
         await callback.message.edit_text(
             "📭 У тебя нет заявок в работе.\n\n"
             "Возьми заявку из «Новых заявок»!",
-            reply_markup=admin_menu(db.get_admin_level(callback.from_user.id))
+            reply_markup=admin_menu(await db.get_admin_level(callback.from_user.id))
         )
-        await callback.answer()
-        return
-    
-    # Показываем первую заявку
-    await show_ticket_details_callback(callback, tickets[0][0])
     await callback.answer()
 
-@router.callback_query(F.data.startswith("take_ticket_"))
-async def take_ticket(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+async def show_my_tickets_page(callback: CallbackQuery, cursor_id=None, backwards=False):
+    tickets, has_more = await db.get_my_tickets_page(callback.from_user.id, cursor_id, backwards)
+    if not tickets:
+        return False
+    
+    has_prev, has_next = page_directions(cursor_id, backwards, has_more)
+    ticket = tickets[0]
+    await show_ticket_details_callback(callback, ticket[0], ticket=ticket,
+                                       pager=pager_row("mytickets", ticket[0], ticket[0], has_prev, has_next))
+    return True
+
+# Ответ админу, который опоздал: заявку или заказ уже перевёл кто-то другой (ключ — текущий статус)
+TICKET_REFUSALS = {
+    None: "❌ Заявка не найдена!",
+    'in_progress': "⚠️ Заявку уже взял другой админ",
+    'closed': "⚠️ Заявка уже закрыта",
+}
+ORDER_REFUSALS = {
+    None: "❌ Заказ не найден!",
+    'completed': "⚠️ Заказ уже подтверждён другим админом",
+    'cancelled': "⚠️ Заказ уже отменён другим админом",
+    'expired': "⚠️ Заказ истёк — оплата не поступила вовремя",
+}
+
+@on_callback("take_ticket")
+async def take_ticket(callback: CallbackQuery, item_id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
     try:
-        ticket_id = int(callback.data.split("_")[2])
-        db.assign_ticket(ticket_id, callback.from_user.id, callback.from_user.full_name or f"Admin_{callback.from_user.id}")
-        
-        ticket = db.get_ticket_by_id(ticket_id)
-        
-        # Уведомляем клиента
-        try:
-            await bot.send_message(
-                ticket[1],
+        ticket_id = item_id
+        # Клиента уведомит только тот админ, который действительно взял заявку
+        due_at = time.time() + TICKET_SLA_SECONDS
+        taken, status = await db.transition_ticket(
+            ticket_id, 'take', callback.from_user.id,
+            callback.from_user.full_name or f"Admin_{callback.from_user.id}",
+            notification=("send_message", {"text": (
                 f"🔄 Заявка #{ticket_id} взята в работу\n\n"
                 f"Админ уже рассматривает вашу проблему.\n"
                 f"Ответ будет отправлен здесь в чате."
-            )
-        except:
-            pass
+            )}),
+            due_at=due_at
+        )
+        if not taken:
+            await callback.answer(TICKET_REFUSALS.get(status, "⚠️ Заявку уже изменили"))
+            if status is not None:
+                await show_ticket_details_callback(callback, ticket_id)
+            return
+        outbox_worker.wake()
+        timers.schedule('ticket', ticket_id, due_at)
         
         await callback.answer(f"✅ Заявка #{ticket_id} взята в работу!")
         await show_ticket_details_callback(callback, ticket_id)
@@ -1352,14 +3440,14 @@ async def take_ticket(callback: CallbackQuery):
     except Exception as e:
         await callback.answer(f"❌ Ошибка: {str(e)}")
 
-@router.callback_query(F.data.startswith("reply_ticket_"))
-async def reply_ticket_start(callback: CallbackQuery, state: FSMContext):
-    if not db.is_support_admin(callback.from_user.id):
+@on_callback("reply_ticket")
+async def reply_ticket_start(callback: CallbackQuery, state: FSMContext, item_id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
     try:
-        ticket_id = int(callback.data.split("_")[2])
+        ticket_id = item_id
         await state.update_data(ticket_id=ticket_id)
         
         await callback.message.answer(
@@ -1377,7 +3465,7 @@ async def reply_ticket_start(callback: CallbackQuery, state: FSMContext):
 async def admin_reply_send(message: Message, state: FSMContext):
     data = await state.get_data()
     ticket_id = data['ticket_id']
-    ticket = db.get_ticket_by_id(ticket_id)
+    ticket = await db.get_ticket_by_id(ticket_id)
     
     if not ticket:
         await message.answer("❌ Заявка не найдена!")
@@ -1401,7 +3489,7 @@ async def admin_reply_send(message: Message, state: FSMContext):
         )
         
         # Сохраняем ответ в базе
-        db.add_ticket_reply(
+        await db.add_ticket_reply(
             ticket_id,
             message.from_user.id,
             message.from_user.full_name or f"Admin_{message.from_user.id}",
@@ -1411,77 +3499,75 @@ async def admin_reply_send(message: Message, state: FSMContext):
         await message.answer(
             f"✅ Ответ отправлен клиенту!\n"
             f"Заявка #{ticket_id}",
-            reply_markup=main_menu(message.from_user.id)
+            reply_markup=await main_menu(message.from_user.id)
         )
     except Exception as e:
         await message.answer(f"❌ Не удалось отправить ответ!\nОшибка: {str(e)[:100]}")
     
     await state.clear()
 
-@router.callback_query(F.data.startswith("close_ticket_"))
-async def close_ticket(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+def ticket_closed_notification(ticket):
+    """Сообщение клиенту о закрытой заявке; ticket — (id, user_id)"""
+    return "send_message", {"text": (
+        f"✅ Заявка #{ticket[0]} закрыта\n\n"
+        f"Если у тебя ещё остались вопросы — создай новую заявку!"
+    )}
+
+@on_callback("close_ticket")
+async def close_ticket(callback: CallbackQuery, item_id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
     try:
-        ticket_id = int(callback.data.split("_")[2])
-        db.close_ticket(ticket_id)
-        
-        ticket = db.get_ticket_by_id(ticket_id)
-        
-        # Уведомляем клиента
-        try:
-            await bot.send_message(
-                ticket[1],
-                f"✅ Заявка #{ticket_id} закрыта\n\n"
-                f"Если у тебя ещё остались вопросы — создай новую заявку!"
-            )
-        except:
-            pass
+        ticket_id = item_id
+        closed, status = await db.transition_ticket(
+            ticket_id, 'close', notification=ticket_closed_notification((ticket_id, None))
+        )
+        if not closed:
+            await callback.answer(TICKET_REFUSALS.get(status, "⚠️ Заявку уже изменили"))
+            return
+        outbox_worker.wake()
         
         await callback.answer(f"✅ Заявка #{ticket_id} закрыта!")
         await callback.message.edit_text(
             f"✅ Заявка #{ticket_id} закрыта!\n\n"
             f"Клиент уведомлён.",
-            reply_markup=admin_menu(db.get_admin_level(callback.from_user.id))
+            reply_markup=admin_menu(await db.get_admin_level(callback.from_user.id))
         )
         
     except Exception as e:
         await callback.answer(f"❌ Ошибка: {str(e)}")
 
-@router.callback_query(F.data == "all_tickets")
+@on_callback("all_tickets")
 async def show_all_tickets(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    tickets = db.get_all_tickets()
+    summary = await db.get_tickets_summary()
+    total = sum(summary.values())
     
-    if not tickets:
+    if not total:
         await callback.message.edit_text("📋 Заявок нет!", 
-                                       reply_markup=admin_menu(db.get_admin_level(callback.from_user.id)))
+                                       reply_markup=admin_menu(await db.get_admin_level(callback.from_user.id)))
         await callback.answer()
         return
     
     # Показываем статистику
-    new_count = len([t for t in tickets if t[6] == 'new'])
-    in_progress_count = len([t for t in tickets if t[6] == 'in_progress'])
-    closed_count = len([t for t in tickets if t[6] == 'closed'])
-    
-    text = f"📋 Все заявки: {len(tickets)}\n\n"
-    text += f"🆕 Новых: {new_count}\n"
-    text += f"🔄 В работе: {in_progress_count}\n"
-    text += f"✅ Закрыто: {closed_count}\n\n"
+    text = f"📋 Все заявки: {total}\n\n"
+    text += f"🆕 Новых: {summary.get('new', 0)}\n"
+    text += f"🔄 В работе: {summary.get('in_progress', 0)}\n"
+    text += f"✅ Закрыто: {summary.get('closed', 0)}\n\n"
     
     # Показываем последние 5 заявок
     text += "Последние заявки:\n"
-    for i, ticket in enumerate(tickets[:5], 1):
-        status_emoji = "🆕" if ticket[6] == 'new' else "🔄" if ticket[6] == 'in_progress' else "✅"
-        text += f"{i}. {status_emoji} #{ticket[0]} - {ticket[2]}\n"
+    for i, (ticket_id, user_name, status) in enumerate(await db.get_latest_tickets(5), 1):
+        status_emoji = "🆕" if status == 'new' else "🔄" if status == 'in_progress' else "✅"
+        text += f"{i}. {status_emoji} #{ticket_id} - {user_name}\n"
     
-    if len(tickets) > 5:
-        text += f"\n... и ещё {len(tickets) - 5} заявок"
+    if total > 5:
+        text += f"\n... и ещё {total - 5} заявок"
     
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -1494,63 +3580,129 @@ async def show_all_tickets(callback: CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
-# =================== УПРАВЛЕНИЕ ЗАКАЗАМИ (АДМИН) ===================
-@router.callback_query(F.data == "admin_pending_orders")
-async def show_pending_orders(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+# =================== ПОИСК ЗАЯВОК ===================
+SEARCH_PROMPT = (
+    "🔎 Поиск заявок\n\n"
+    "Пришли слова из сообщения клиента, ответа или имя клиента:\n"
+    "Пример: не пришли звёзды\n\n"
+    "Используй /cancel для отмены"
+)
+
+def ticket_search_text(query, results):
+    """Результаты поиска в HTML: найденные слова — жирным, текст клиентов экранирован"""
+    if not results:
+        return f"🔎 По запросу «{html.escape(query)}» ничего не найдено"
+    text = f"🔎 Найдено по запросу «{html.escape(query)}»:\n"
+    for ticket_id, user_name, status, created_at, snippet in results:
+        status_emoji = "🆕" if status == 'new' else "🔄" if status == 'in_progress' else "✅"
+        snippet = html.escape(snippet.replace("\n", " ")).replace("\x02", "<b>").replace("\x03", "</b>")
+        text += (f"\n{status_emoji} #{ticket_id} — {html.escape(user_name or '')} ({str(created_at)[:10]})\n"
+                 f"{snippet}\n/ticket_{ticket_id}\n")
+    return text
+
+async def answer_ticket_search(message: Message, query):
+    results = await db.search_tickets(query)
+    await message.answer(ticket_search_text(query, results), parse_mode="HTML")
+
+@router.message(Command("search"))
+async def search_tickets_command(message: Message, state: FSMContext):
+    if not await db.is_support_admin(message.from_user.id):
+        await message.answer("❌ Ты не ТП-админ!")
+        return
+    
+    query = message.text.partition(" ")[2].strip()
+    if not query:
+        await message.answer(SEARCH_PROMPT, reply_markup=cancel_keyboard())
+        await state.set_state(Form.waiting_ticket_search)
+        return
+    
+    await answer_ticket_search(message, query)
+
+@on_callback("search_tickets")
+async def search_tickets_start(callback: CallbackQuery, state: FSMContext):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    orders = db.get_pending_orders()
+    await callback.message.answer(SEARCH_PROMPT, reply_markup=cancel_keyboard())
+    await state.set_state(Form.waiting_ticket_search)
+    await callback.answer()
+
+@router.message(Form.waiting_ticket_search)
+async def search_tickets_process(message: Message, state: FSMContext):
+    if message.text and message.text.startswith('/cancel'):
+        await state.clear()
+        await message.answer("❌ Поиск отменён", 
+                           reply_markup=await main_menu(message.from_user.id))
+        return
     
-    if not orders:
-        await callback.message.edit_text("✅ Нет новых заказов!", 
-                                       reply_markup=admin_menu(db.get_admin_level(callback.from_user.id)))
-        await callback.answer()
+    if not message.text:
+        await message.answer("❌ Пришли текст для поиска!")
+        return
+    
+    await state.clear()
+    await answer_ticket_search(message, message.text)
+
+# =================== УПРАВЛЕНИЕ ЗАКАЗАМИ (АДМИН) ===================
+@on_callback("admin_pending_orders")
+async def show_pending_orders(callback: CallbackQuery):
+    if not await db.is_support_admin(callback.from_user.id):
+        await callback.answer("❌ Нет доступа!")
         return
     
-    # Показываем первый заказ
-    await show_order_admin_callback(callback, orders[0][0])
+    if not await show_pending_orders_page(callback):
+        await callback.message.edit_text("✅ Нет новых заказов!", 
+                                       reply_markup=admin_menu(await db.get_admin_level(callback.from_user.id)))
     await callback.answer()
 
-@router.callback_query(F.data == "admin_all_orders")
+async def show_pending_orders_page(callback: CallbackQuery, cursor_id=None, backwards=False):
+    orders, has_more = await db.get_pending_orders_page(cursor_id, backwards)
+    if not orders:
+        return False
+    
+    has_prev, has_next = page_directions(cursor_id, backwards, has_more)
+    order = orders[0]
+    pager = pager_row("pending", order[0], order[0], has_prev, has_next)
+    pager.append(InlineKeyboardButton(text="☑️ Выбрать несколько", callback_data="bulk_orders"))
+    await show_order_admin_callback(callback, order[0], order=order, pager=pager)
+    return True
+
+@on_callback("admin_all_orders")
 async def show_all_orders(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    orders = db.get_all_orders()
+    summary = await db.get_orders_summary()
     
-    if not orders:
+    if not summary['total']:
         await callback.message.edit_text("📭 Заказов пока нет!", 
-                                       reply_markup=admin_menu(db.get_admin_level(callback.from_user.id)))
+                                       reply_markup=admin_menu(await db.get_admin_level(callback.from_user.id)))
         await callback.answer()
         return
     
     # Показываем статистику
-    pending_count = len([o for o in orders if o[7] == 'pending'])
-    completed_count = len([o for o in orders if o[7] == 'completed'])
-    cancelled_count = len([o for o in orders if o[7] == 'cancelled'])
-    
-    total_rub = sum([o[4] for o in orders if o[5] == 'RUB' and o[7] == 'completed'])
-    total_usdt = sum([o[4] for o in orders if o[5] == 'USDT' and o[7] == 'completed'])
-    
-    text = f"📦 Все заказы: {len(orders)}\n\n"
-    text += f"🕐 Ожидают: {pending_count}\n"
-    text += f"✅ Выполнены: {completed_count}\n"
-    text += f"❌ Отменены: {cancelled_count}\n\n"
+    by_status = summary['by_status']
+    total_rub = summary['revenue'].get('RUB', 0)
+    total_usdt = summary['revenue'].get('USDT', 0)
+    
+    text = f"📦 Все заказы: {summary['total']}\n\n"
+    text += f"🕐 Ожидают: {by_status.get('pending', 0)}\n"
+    text += f"✅ Выполнены: {by_status.get('completed', 0)}\n"
+    text += f"❌ Отменены: {by_status.get('cancelled', 0)}\n"
+    text += f"⌛ Истекли: {by_status.get('expired', 0)}\n\n"
     text += f"💰 Выручка:\n"
     text += f"   • {total_rub:.2f}₽\n"
     text += f"   • {total_usdt} USDT\n\n"
     
     # Показываем последние 5 заказов
     text += "Последние заказы:\n"
-    for i, order in enumerate(orders[:5], 1):
-        status_emoji = "🕐" if order[7] == 'pending' else "✅" if order[7] == 'completed' else "❌"
-        text += f"{i}. {status_emoji} #{order[0]} - {order[2]} ({order[4]} {order[5]})\n"
+    for i, (order_id, product, total, currency, status) in enumerate(await db.get_latest_orders(5), 1):
+        status_emoji = {'pending': "🕐", 'completed': "✅", 'expired': "⌛"}.get(status, "❌")
+        text += f"{i}. {status_emoji} #{order_id} - {product} ({total} {currency})\n"
     
-    if len(orders) > 5:
-        text += f"\n... и ещё {len(orders) - 5} заказов"
+    if summary['total'] > 5:
+        text += f"\n... и ещё {summary['total'] - 5} заказов"
     
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -1562,8 +3714,9 @@ async def show_all_orders(callback: CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
-async def show_order_admin_callback(callback: CallbackQuery, order_id):
-    order = db.get_order_by_id(order_id)
+async def show_order_admin_callback(callback: CallbackQuery, order_id, order=None, pager=None):
+    if order is None:
+        order = await db.get_order_by_id(order_id)
     
     if not order:
         await callback.message.edit_text("❌ Заказ не найден!")
@@ -1574,110 +3727,149 @@ async def show_order_admin_callback(callback: CallbackQuery, order_id):
         'pending': '🕐 Ожидает',
         'processing': '🔄 В обработке',
         'completed': '✅ Выполнен',
-        'cancelled': '❌ Отменён'
-    }.get(order[7], '❓ Неизвестно')
+        'cancelled': '❌ Отменён',
+        'expired': '⌛ Истёк'
+    }.get(order[11], '❓ Неизвестно')
     
     payment_method = {
         'crypto_bot': '🤖 Crypto Bot',
         'bep20': '💼 BEP20'
-    }.get(order[8], 'Не указан')
+    }.get(order[7], 'Не указан')
     
     text = (
         f"🛒 Заказ #{order[0]}\n\n"
         f"{status_emoji}\n"
-        f"👤 Клиент: {order[18] or 'Без имени'} (@{order[17] or 'нет'})\n"
+        f"👤 Клиент: {order[19] or 'Без имени'} (@{order[18] or 'нет'})\n"
         f"🆔 ID: {order[1]}\n"
         f"📦 Товар: {order[2]}\n"
         f"📊 Количество: {order[3]}\n"
         f"💰 Сумма: {order[4]} {order[5]}\n"
         f"💳 Способ: {payment_method}\n"
-        f"📅 Дата: {order[13].split()[0] if ' ' in str(order[13]) else order[13][:10]}\n"
+        f"📅 Дата: {order[14].split()[0] if ' ' in str(order[14]) else order[14][:10]}\n"
     )
     
     if order[12]:  # admin_comment
         text += f"💬 Комментарий: {order[12]}\n"
     
-    if order[11]:  # screenshot
+    if order[10]:  # screenshot
         text += f"📸 Есть скриншот оплаты\n"
     
     await callback.message.edit_text(
         text,
-        reply_markup=order_management_keyboard(order_id)
+        reply_markup=order_management_keyboard(order_id, pager)
     )
 
-@router.callback_query(F.data.startswith("complete_order_"))
-async def complete_order(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
-        await callback.answer("❌ Нет доступа!")
+PAGE_VIEWS = {
+    "pending": show_pending_orders_page,
+    "newtickets": show_new_tickets_page,
+    "mytickets": show_my_tickets_page,
+}
+
+@on_callback(*(f"page_{view}_{direction}" for view in ("myorders", *PAGE_VIEWS) for direction in ("prev", "next")))
+async def paginate(callback: CallbackQuery, action, item_id):
+    _, view, direction = action.split("_")
+    cursor_id = item_id
+    if not isinstance(cursor_id, int):
+        await callback.answer("❌ Ошибка!")
         return
     
-    order_id = int(callback.data.split("_")[2])
+    backwards = direction == "prev"
     
-    # Обновляем статус заказа
-    db.update_order_status(order_id, "completed", callback.from_user.id, "Заказ выполнен")
+    if view == "myorders":
+        text, keyboard = await render_my_orders(callback.from_user.id, cursor_id, backwards)
+        if text:
+            await callback.message.edit_text(text, reply_markup=keyboard)
+        shown = text is not None
+    else:
+        if not await db.is_support_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа!")
+            return
+        shown = await PAGE_VIEWS[view](callback, cursor_id, backwards)
     
-    # Получаем информацию о заказе
-    order = db.get_order_by_id(order_id)
+    if shown:
+        await callback.answer()
+    else:
+        await callback.answer("📭 Больше записей нет")
+
+def order_completed_notification(order):
+    """Сообщение клиенту о выполненном заказе; order — (id, user_id, product)"""
+    return "send_message", {"text": (
+        f"🎉 Заказ #{order[0]} выполнен!\n\n"
+        f"📦 {order[2]} активирован и отправлен.\n"
+        f"Спасибо за покупку! 🎊\n\n"
+        f"Если есть вопросы — пиши в поддержку!"
+    )}
+
+@on_callback("complete_order")
+async def complete_order(callback: CallbackQuery, item_id):
+    if not await db.is_support_admin(callback.from_user.id):
+        await callback.answer("❌ Нет доступа!")
+        return
     
-    if order:
-        user_id, product = order[1], order[2]
-        
-        # Уведомляем пользователя
-        try:
-            await bot.send_message(
-                user_id,
-                f"🎉 Заказ #{order_id} выполнен!\n\n"
-                f"📦 {product} активирован и отправлен.\n"
-                f"Спасибо за покупку! 🎊\n\n"
-                f"Если есть вопросы — пиши в поддержку!"
-            )
-        except Exception as e:
-            print(f"Не удалось уведомить пользователя {user_id}: {e}")
+    order_id = item_id
+    order = await db.get_order_by_id(order_id)
+    if not order:
+        await callback.answer(ORDER_REFUSALS[None])
+        return
+    
+    # Статус меняет и клиента уведомляет только первый нажавший админ
+    completed, status = await db.transition_order(
+        order_id, 'complete', callback.from_user.id, "Заказ выполнен",
+        notification=order_completed_notification((order_id, order[1], order[2]))
+    )
+    if not completed:
+        await callback.answer(ORDER_REFUSALS.get(status, "⚠️ Заказ уже изменили"), show_alert=True)
+        await show_order_admin_callback(callback, order_id)
+        return
+    outbox_worker.wake()
     
     await callback.answer("✅ Заказ подтверждён!", show_alert=True)
     await show_order_admin_callback(callback, order_id)
 
-@router.callback_query(F.data.startswith("cancel_order_"))
-async def cancel_order(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+@on_callback("cancel_order")
+async def cancel_order(callback: CallbackQuery, item_id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    order_id = int(callback.data.split("_")[2])
-    
-    # Обновляем статус заказа
-    db.update_order_status(order_id, "cancelled", callback.from_user.id, "Заказ отменён")
-    
-    # Получаем информацию о заказе
-    order = db.get_order_by_id(order_id)
+    order_id = item_id
+    order = await db.get_order_by_id(order_id)
+    if not order:
+        await callback.answer(ORDER_REFUSALS[None])
+        return
     
-    if order:
-        user_id, product = order[1], order[2]
-        
-        # Уведомляем пользователя
-        try:
-            await bot.send_message(
-                user_id,
-                f"❌ Заказ #{order_id} отменён\n\n"
-                f"📦 {product}\n"
-                f"Если у тебя были проблемы с оплатой,\n"
-                f"обратись в поддержку для решения вопроса."
-            )
-        except Exception as e:
-            print(f"Не удалось уведомить пользователя {user_id}: {e}")
+    cancelled, status = await db.transition_order(
+        order_id, 'cancel', callback.from_user.id, "Заказ отменён",
+        notification=("send_message", {"text": (
+            f"❌ Заказ #{order_id} отменён\n\n"
+            f"📦 {order[2]}\n"
+            f"Если у тебя были проблемы с оплатой,\n"
+            f"обратись в поддержку для решения вопроса."
+        )})
+    )
+    if not cancelled:
+        await callback.answer(ORDER_REFUSALS.get(status, "⚠️ Заказ уже изменили"), show_alert=True)
+        await show_order_admin_callback(callback, order_id)
+        return
+    outbox_worker.wake()
     
     await callback.answer("❌ Заказ отменён!", show_alert=True)
     await show_order_admin_callback(callback, order_id)
 
-@router.callback_query(F.data.startswith("comment_order_"))
-async def comment_order_start(callback: CallbackQuery, state: FSMContext):
-    if not db.is_support_admin(callback.from_user.id):
+@on_callback("comment_order")
+async def comment_order_start(callback: CallbackQuery, state: FSMContext, item_id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
     try:
-        order_id = int(callback.data.split("_")[2])
-        await state.update_data(order_id=order_id)
+        order_id = item_id
+        order = await db.get_order_by_id(order_id)
+        if not order:
+            await callback.answer(ORDER_REFUSALS[None])
+            return
+        # Версия заказа на момент начала: если его изменят, пока админ пишет, комментарий не сохранится
+        await state.update_data(order_id=order_id, order_version=order[17])
         
         await callback.message.answer(
             f"💬 Комментарий к заказу #{order_id}\n\n"
@@ -1697,28 +3889,34 @@ async def process_order_comment(message: Message, state: FSMContext):
     
     try:
         comment = message.text or ""
+        order = await db.get_order_by_id(order_id)
+        if not order:
+            await message.answer(ORDER_REFUSALS[None])
+            await state.clear()
+            return
         
-        # Обновляем заказ с комментарием
-        order = db.get_order_by_id(order_id)
-        if order:
-            # Сохраняем текущий статус
-            current_status = order[7]
-            db.update_order_status(order_id, current_status, message.from_user.id, comment)
-            
-            # Уведомляем пользователя о комментарии
-            try:
-                await bot.send_message(
-                    order[1],
-                    f"💬 Комментарий к заказу #{order_id}\n\n"
-                    f"{comment}\n\n"
-                    f"Статус заказа: {current_status}"
-                )
-            except:
-                pass
+        # Пока админ писал, заказ могли подтвердить или отменить — тогда комментарий к старому состоянию не нужен
+        saved, status = await db.set_order_comment(
+            order_id, comment, data.get('order_version', order[17]),
+            notification=("send_message", {"text": (
+                f"💬 Комментарий к заказу #{order_id}\n\n"
+                f"{comment}\n\n"
+                f"Статус заказа: {order[11]}"
+            )})
+        )
+        if not saved:
+            await message.answer(
+                f"⚠️ Заказ #{order_id} изменился, пока ты писал комментарий (статус: {status}).\n"
+                f"Открой заказ заново: /order_{order_id}",
+                reply_markup=await main_menu(message.from_user.id)
+            )
+            await state.clear()
+            return
+        outbox_worker.wake()
         
         await message.answer(
             f"✅ Комментарий добавлен к заказу #{order_id}!",
-            reply_markup=main_menu(message.from_user.id)
+            reply_markup=await main_menu(message.from_user.id)
         )
         
     except Exception as e:
@@ -1726,34 +3924,217 @@ async def process_order_comment(message: Message, state: FSMContext):
     
     await state.clear()
 
+# =================== МАССОВЫЕ ДЕЙСТВИЯ ===================
+# После простоя админы подтверждают сотни проверенных оплат разом: отметками в списке новых заказов
+# или командой /complete_bulk 12 15 20-40 (для заявок — /close_bulk). Переход — одна транзакция,
+# уведомления клиентам уходят через outbox под общим лимитом Notifier, а ход рассылки виден
+# в одном сообщении, которое редактируется каждые BULK_PROGRESS_SECONDS.
+BULK_MAX_IDS = int(os.getenv("BULK_MAX_IDS", "2000"))
+BULK_PAGE_SIZE = 8
+BULK_PROGRESS_SECONDS = float(os.getenv("BULK_PROGRESS_SECONDS", "2"))
+BULK_PROGRESS_TIMEOUT = float(os.getenv("BULK_PROGRESS_TIMEOUT", "900"))
+
+# Почему строку пропустили (ключ — её текущий статус)
+BULK_SKIPPED = {
+    None: "не найдены",
+    'completed': "уже подтверждены",
+    'cancelled': "отменены",
+    'expired': "истекли",
+    'closed': "уже закрыты",
+}
+
+# Фоновые задачи отчёта о ходе рассылки — держим ссылки, чтобы их не собрал GC
+bulk_reports = set()
+
+def parse_id_list(text):
+    """'12 15, 20-25' -> [12, 15, 20, ..., 25]; None, если формат неверный или id больше BULK_MAX_IDS"""
+    ids = []
+    for part in text.replace(",", " ").split():
+        first, dash, last = part.partition("-")
+        if not first.isdigit() or (dash and not last.isdigit()):
+            return None
+        first, last = int(first), int(last or first)
+        if last < first or len(ids) + last - first + 1 > BULK_MAX_IDS:
+            return None
+        ids.extend(range(first, last + 1))
+    return ids or None
+
+def bulk_report_text(title, done, refused, waiting, dead, finished):
+    text = f"{title}: {len(done)} из {len(done) + len(refused)}\n"
+    if refused:
+        skipped = {}
+        for status in refused.values():
+            label = BULK_SKIPPED.get(status, status)
+            skipped[label] = skipped.get(label, 0) + 1
+        text += f"⚠️ Пропущено: {len(refused)} (" + ", ".join(f"{label}: {count}" for label, count in skipped.items()) + ")\n"
+    if done:
+        text += f"📨 Уведомления: отправлено {len(done) - waiting - dead} из {len(done)}"
+        text += f", не доставлено: {dead}\n" if dead else "\n"
+    if not finished:
+        text += "\n⏳ Рассылка идёт..."
+    elif waiting:
+        text += "\n⏳ Остальные уведомления дойдут позже"
+    else:
+        text += "\n✅ Готово"
+    return text
+
+async def report_bulk_progress(status_message, title, done, refused, outbox_range):
+    """Редактирует одно сообщение, пока outbox не разошлёт уведомления этого действия"""
+    deadline = time.monotonic() + BULK_PROGRESS_TIMEOUT
+    shown = None
+    while True:
+        waiting, dead = await db.get_outbox_progress(*outbox_range) if outbox_range else (0, 0)
+        finished = not waiting or time.monotonic() >= deadline
+        text = bulk_report_text(title, done, refused, waiting, dead, finished)
+        if text != shown:
+            try:
+                await bot.edit_message_text(text, chat_id=status_message.chat.id,
+                                            message_id=status_message.message_id)
+                shown = text
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest:
+                return  # Сообщение удалили — уведомления дойдут и без отчёта
+        if finished:
+            return
+        await asyncio.sleep(BULK_PROGRESS_SECONDS)
+
+async def run_bulk(status_message, kind, ids, admin_id):
+    """Массово подтверждает заказы (kind='orders') или закрывает заявки и запускает отчёт"""
+    if kind == "orders":
+        title = "✅ Подтверждено заказов"
+        done, refused, outbox_range = await db.bulk_transition_orders(
+            ids, 'complete', admin_id, "Заказ выполнен", order_completed_notification)
+    else:
+        title = "✅ Закрыто заявок"
+        done, refused, outbox_range = await db.bulk_transition_tickets(ids, 'close', ticket_closed_notification)
+    if outbox_range:
+        outbox_worker.wake()
+    task = asyncio.create_task(report_bulk_progress(status_message, title, done, refused, outbox_range))
+    bulk_reports.add(task)
+    task.add_done_callback(bulk_report_done)
+
+def bulk_report_done(task):
+    bulk_reports.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.warning(f"Отчёт о массовом действии прерван: {task.exception()}")
+
+@router.message(Command("complete_bulk", "close_bulk"))
+async def bulk_command(message: Message):
+    if not await db.is_support_admin(message.from_user.id):
+        await message.answer("❌ Ты не ТП-админ!")
+        return
+    
+    command, _, arg = message.text.partition(" ")
+    ids = parse_id_list(arg)
+    if not ids:
+        await message.answer(f"❌ Используй: {command} 12 15 20-40\n(не больше {BULK_MAX_IDS} номеров)")
+        return
+    
+    kind = "orders" if command.startswith("/complete_bulk") else "tickets"
+    status_message = await message.answer(f"⏳ Обрабатываю номера: {len(ids)}...")
+    await run_bulk(status_message, kind, ids, message.from_user.id)
+
+async def show_bulk_orders_page(callback: CallbackQuery, state: FSMContext, cursor_id=None, backwards=False):
+    """Список новых заказов с отметками; выбор и текущая страница хранятся в FSM-данных админа"""
+    orders, has_more = await db.get_pending_orders_page(cursor_id, backwards, BULK_PAGE_SIZE)
+    if not orders and cursor_id is not None:
+        # Страница опустела (заказы подтвердили) — начинаем с первой
+        cursor_id, backwards = None, False
+        orders, has_more = await db.get_pending_orders_page(limit=BULK_PAGE_SIZE)
+    await state.update_data(bulk_page=[cursor_id, backwards])
+    selected = set((await state.get_data()).get("bulk_selected", []))
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"{'☑️' if order[0] in selected else '▫️'} #{order[0]} · {order[2]} · {order[4]} {order[5]}"
+                 f"{' · 📸' if order[10] else ''}",
+            callback_data=pack_callback("bulk_toggle", order[0])
+        )]
+        for order in orders
+    ])
+    if orders:
+        has_prev, has_next = page_directions(cursor_id, backwards, has_more)
+        pager = pager_row("bulk", orders[0][0], orders[-1][0], has_prev, has_next)
+        pager.insert(len(pager) // 2, InlineKeyboardButton(text="☑️ Вся страница", callback_data="bulk_page_all"))
+        keyboard.inline_keyboard.append(pager)
+    keyboard.inline_keyboard.append([
+        InlineKeyboardButton(text=f"✅ Подтвердить ({len(selected)})", callback_data="bulk_complete"),
+        InlineKeyboardButton(text="🧹 Сбросить", callback_data="bulk_clear")
+    ])
+    keyboard.inline_keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_pending_orders")])
+    
+    text = (
+        f"☑️ Выбор заказов — отмечено: {len(selected)}\n\n"
+        f"Отметь заказы, оплату которых ты проверил, и подтверди их разом.\n"
+        f"📸 — клиент прислал скриншот оплаты."
+    )
+    if not orders:
+        text += "\n\n✅ Новых заказов нет"
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+@on_callback("bulk_orders", "page_bulk_prev", "page_bulk_next", "bulk_toggle", "bulk_page_all", "bulk_clear")
+async def bulk_orders_view(callback: CallbackQuery, state: FSMContext, action, item_id):
+    if not await db.is_support_admin(callback.from_user.id):
+        await callback.answer("❌ Нет доступа!")
+        return
+    
+    data = await state.get_data()
+    cursor_id, backwards = data.get("bulk_page", [None, False])
+    selected = data.get("bulk_selected", [])
+    if action == "bulk_orders":
+        cursor_id, backwards = None, False
+    elif action.startswith("page_bulk_"):
+        cursor_id, backwards = item_id, action == "page_bulk_prev"
+    elif action == "bulk_toggle":
+        selected = [order_id for order_id in selected if order_id != item_id] if item_id in selected \
+            else [*selected, item_id][:BULK_MAX_IDS]
+    elif action == "bulk_page_all":
+        orders, _ = await db.get_pending_orders_page(cursor_id, backwards, BULK_PAGE_SIZE)
+        selected = list(dict.fromkeys([*selected, *(order[0] for order in orders)]))[:BULK_MAX_IDS]
+    else:
+        selected = []
+    await state.update_data(bulk_selected=selected)
+    
+    await show_bulk_orders_page(callback, state, cursor_id, backwards)
+    await callback.answer()
+
+@on_callback("bulk_complete")
+async def bulk_complete(callback: CallbackQuery, state: FSMContext):
+    if not await db.is_support_admin(callback.from_user.id):
+        await callback.answer("❌ Нет доступа!")
+        return
+    
+    selected = (await state.get_data()).get("bulk_selected", [])
+    if not selected:
+        await callback.answer("☑️ Сначала отметь заказы")
+        return
+    await state.update_data(bulk_selected=[])
+    
+    await callback.message.edit_text(f"⏳ Подтверждаю заказы: {len(selected)}...")
+    await callback.answer()
+    await run_bulk(callback.message, "orders", selected, callback.from_user.id)
+
 # =================== УПРАВЛЕНИЕ ЦЕНАМИ ===================
-@router.callback_query(F.data == "admin_manage_prices")
+@on_callback("admin_manage_prices")
 async def manage_prices_menu(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    text = "💰 Текущие цены:\n\n"
-    text += f"⭐ Звезда: {PRICES['star_rate']}₽\n"
-    text += f"💎 TON: {PRICES['ton_rate']}₽\n"
-    text += f"🏆 Premium 3 мес: {PRICES['premium_3']} USDT\n"
-    text += f"🏆 Premium 6 мес: {PRICES['premium_6']} USDT\n"
-    text += f"🏆 Premium 12 мес: {PRICES['premium_12']} USDT\n\n"
-    text += "👇 Выбери цену для изменения:"
-    
     await callback.message.edit_text(
-        text,
+        prices_admin_text(price_catalog.snapshot),
         reply_markup=prices_management_menu()
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("price_"))
-async def change_price_start(callback: CallbackQuery, state: FSMContext):
-    if not db.is_support_admin(callback.from_user.id):
+@on_callback("price")
+async def change_price_start(callback: CallbackQuery, state: FSMContext, item_id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    price_key = callback.data.replace("price_", "")
+    price_key = item_id
     
     price_names = {
         "star": "⭐ Цена одной звезды (в рублях)",
@@ -1763,7 +4144,7 @@ async def change_price_start(callback: CallbackQuery, state: FSMContext):
         "premium_12": "🏆 Цена Premium на 12 месяцев (в USDT)"
     }
     
-    current_price = PRICES.get(f"{price_key}", 0)
+    current_price = price_catalog.snapshot.get(price_catalog.resolve_key(price_key), 0)
     
     await state.update_data(price_key=price_key)
     
@@ -1783,7 +4164,7 @@ async def change_price_process(message: Message, state: FSMContext):
     if message.text and message.text.startswith('/cancel'):
         await state.clear()
         await message.answer("❌ Изменение цены отменено", 
-                           reply_markup=main_menu(message.from_user.id))
+                           reply_markup=await main_menu(message.from_user.id))
         return
     
     try:
@@ -1796,7 +4177,7 @@ async def change_price_process(message: Message, state: FSMContext):
             await message.answer("❌ Цена должна быть больше 0!")
             return
         
-        db.update_price(price_key, new_price)
+        await db.update_price(price_key, new_price, message.from_user.id)
         
         price_names = {
             "star": "⭐ Цена звезды",
@@ -1810,7 +4191,7 @@ async def change_price_process(message: Message, state: FSMContext):
             f"✅ Цена изменена!\n\n"
             f"{price_names.get(price_key, 'Цена')}: {new_price}\n\n"
             f"Изменение вступит в силу сразу!",
-            reply_markup=main_menu(message.from_user.id)
+            reply_markup=await main_menu(message.from_user.id)
         )
         
     except ValueError:
@@ -1821,13 +4202,13 @@ async def change_price_process(message: Message, state: FSMContext):
     await state.clear()
 
 # =================== УПРАВЛЕНИЕ ТП-АДМИНАМИ ===================
-@router.callback_query(F.data == "admin_manage_support")
+@on_callback("admin_manage_support")
 async def manage_support_menu(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    admin_level = db.get_admin_level(callback.from_user.id)
+    admin_level = await db.get_admin_level(callback.from_user.id)
     
     await callback.message.edit_text(
         "👨‍💼 Управление ТП-админами\n\n"
@@ -1836,9 +4217,9 @@ async def manage_support_menu(callback: CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "admin_add_support")
+@on_callback("admin_add_support")
 async def add_support_admin_start(callback: CallbackQuery, state: FSMContext):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
@@ -1857,18 +4238,18 @@ async def add_support_admin_process(message: Message, state: FSMContext):
     if message.text and message.text.startswith('/cancel'):
         await state.clear()
         await message.answer("❌ Добавление отменено", 
-                           reply_markup=main_menu(message.from_user.id))
+                           reply_markup=await main_menu(message.from_user.id))
         return
     
     try:
         admin_id = int(message.text)
         
-        if db.is_support_admin(admin_id):
+        if await db.is_support_admin(admin_id):
             await message.answer("❌ Этот пользователь уже ТП-админ!")
             return
         
         # Добавляем как ТП (уровень 1)
-        db.add_support_admin(admin_id, message.from_user.id, admin_level=1)
+        await db.add_support_admin(admin_id, message.from_user.id, admin_level=1)
         
         try:
             await bot.send_message(
@@ -1885,7 +4266,7 @@ async def add_support_admin_process(message: Message, state: FSMContext):
         await message.answer(
             f"✅ ТП-админ {admin_id} добавлен (уровень: ТП)!\n"
             f"Он получил уведомление.",
-            reply_markup=main_menu(message.from_user.id)
+            reply_markup=await main_menu(message.from_user.id)
         )
     except ValueError:
         await message.answer("❌ Пришли только цифры (ID пользователя)!")
@@ -1894,13 +4275,13 @@ async def add_support_admin_process(message: Message, state: FSMContext):
     
     await state.clear()
 
-@router.callback_query(F.data == "admin_remove_support")
+@on_callback("admin_remove_support")
 async def remove_support_admin_start(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    admins = db.get_all_support_admins()
+    admins = await db.get_all_support_admins()
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
     
@@ -1911,7 +4292,7 @@ async def remove_support_admin_start(callback: CallbackQuery):
             keyboard.inline_keyboard.append([
                 InlineKeyboardButton(
                     text=f"❌ {admin_name} ({admin_level})",
-                    callback_data=f"remove_admin_{admin[0]}"
+                    callback_data=pack_callback("remove_admin", admin[0])
                 )
             ])
     
@@ -1926,28 +4307,28 @@ async def remove_support_admin_start(callback: CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("remove_admin_"))
-async def remove_support_admin_process(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+@on_callback("remove_admin")
+async def remove_support_admin_process(callback: CallbackQuery, item_id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
     try:
-        admin_id = int(callback.data.split("_")[2])
+        admin_id = item_id
         
         if admin_id == ADMIN_ID:
             await callback.answer("❌ Нельзя удалить главного админа!", show_alert=True)
             return
         
-        admin_level = db.get_admin_level(admin_id)
+        admin_level = await db.get_admin_level(admin_id)
         
         # Проверяем права
-        user_level = db.get_admin_level(callback.from_user.id)
+        user_level = await db.get_admin_level(callback.from_user.id)
         if admin_level >= 2 and user_level < 2:
             await callback.answer("❌ Ты не можешь удалить админа!", show_alert=True)
             return
         
-        db.remove_support_admin(admin_id)
+        await db.remove_support_admin(admin_id)
         
         try:
             await bot.send_message(
@@ -1967,13 +4348,13 @@ async def remove_support_admin_process(callback: CallbackQuery):
     
     await callback.answer()
 
-@router.callback_query(F.data == "admin_list_support")
+@on_callback("admin_list_support")
 async def list_support_admins(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    admins = db.get_all_support_admins()
+    admins = await db.get_all_support_admins()
     
     text = "👨‍💼 Список ТП-админов:\n\n"
     
@@ -1988,14 +4369,14 @@ async def list_support_admins(callback: CallbackQuery):
     
     await callback.message.edit_text(
         text,
-        reply_markup=support_management_menu(db.get_admin_level(callback.from_user.id))
+        reply_markup=support_management_menu(await db.get_admin_level(callback.from_user.id))
     )
     await callback.answer()
 
 # =================== УПРАВЛЕНИЕ УРОВНЯМИ ===================
-@router.callback_query(F.data == "admin_manage_levels")
+@on_callback("admin_manage_levels")
 async def manage_levels_menu(callback: CallbackQuery):
-    if not db.is_admin(callback.from_user.id):
+    if not await db.is_admin(callback.from_user.id):
         await callback.answer("❌ Только для админов!", show_alert=True)
         return
     
@@ -2006,13 +4387,13 @@ async def manage_levels_menu(callback: CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "admin_list_with_levels")
+@on_callback("admin_list_with_levels")
 async def list_admins_with_levels(callback: CallbackQuery):
-    if not db.is_admin(callback.from_user.id):
+    if not await db.is_admin(callback.from_user.id):
         await callback.answer("❌ Только для админов!", show_alert=True)
         return
     
-    admins = db.get_all_support_admins()
+    admins = await db.get_all_support_admins()
     
     text = "📊 Список админов с уровнями:\n\n"
     
@@ -2028,13 +4409,13 @@ async def list_admins_with_levels(callback: CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "admin_promote")
+@on_callback("admin_promote")
 async def promote_admin_start(callback: CallbackQuery):
-    if not db.is_admin(callback.from_user.id):
+    if not await db.is_admin(callback.from_user.id):
         await callback.answer("❌ Только для админов!", show_alert=True)
         return
     
-    admins = db.get_all_support_admins()
+    admins = await db.get_all_support_admins()
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
     
@@ -2044,7 +4425,7 @@ async def promote_admin_start(callback: CallbackQuery):
             keyboard.inline_keyboard.append([
                 InlineKeyboardButton(
                     text=f"🔼 {admin_name}",
-                    callback_data=f"promote_admin_{admin[0]}"
+                    callback_data=pack_callback("promote_admin", admin[0])
                 )
             ])
     
@@ -2059,20 +4440,20 @@ async def promote_admin_start(callback: CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("promote_admin_"))
-async def promote_admin_process(callback: CallbackQuery):
-    if not db.is_admin(callback.from_user.id):
+@on_callback("promote_admin")
+async def promote_admin_process(callback: CallbackQuery, item_id):
+    if not await db.is_admin(callback.from_user.id):
         await callback.answer("❌ Только для админов!", show_alert=True)
         return
     
     try:
-        admin_id = int(callback.data.split("_")[2])
+        admin_id = item_id
         
         if admin_id == ADMIN_ID:
             await callback.answer("❌ Это главный админ!", show_alert=True)
             return
         
-        db.update_admin_level(admin_id, 2)
+        await db.update_admin_level(admin_id, 2)
         
         try:
             await bot.send_message(
@@ -2096,13 +4477,13 @@ async def promote_admin_process(callback: CallbackQuery):
     
     await callback.answer()
 
-@router.callback_query(F.data == "admin_demote")
+@on_callback("admin_demote")
 async def demote_admin_start(callback: CallbackQuery):
-    if not db.is_admin(callback.from_user.id):
+    if not await db.is_admin(callback.from_user.id):
         await callback.answer("❌ Только для админов!", show_alert=True)
         return
     
-    admins = db.get_all_support_admins()
+    admins = await db.get_all_support_admins()
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
     
@@ -2112,7 +4493,7 @@ async def demote_admin_start(callback: CallbackQuery):
             keyboard.inline_keyboard.append([
                 InlineKeyboardButton(
                     text=f"🔽 {admin_name}",
-                    callback_data=f"demote_admin_{admin[0]}"
+                    callback_data=pack_callback("demote_admin", admin[0])
                 )
             ])
     
@@ -2127,20 +4508,20 @@ async def demote_admin_start(callback: CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("demote_admin_"))
-async def demote_admin_process(callback: CallbackQuery):
-    if not db.is_admin(callback.from_user.id):
+@on_callback("demote_admin")
+async def demote_admin_process(callback: CallbackQuery, item_id):
+    if not await db.is_admin(callback.from_user.id):
         await callback.answer("❌ Только для админов!", show_alert=True)
         return
     
     try:
-        admin_id = int(callback.data.split("_")[2])
+        admin_id = item_id
         
         if admin_id == ADMIN_ID:
             await callback.answer("❌ Нельзя понизить главного админа!", show_alert=True)
             return
         
-        db.update_admin_level(admin_id, 1)
+        await db.update_admin_level(admin_id, 1)
         
         try:
             await bot.send_message(
@@ -2163,13 +4544,13 @@ async def demote_admin_process(callback: CallbackQuery):
     await callback.answer()
 
 # =================== СТАТИСТИКА ===================
-@router.callback_query(F.data == "admin_stats")
+@on_callback("admin_stats")
 async def show_stats(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    stats = db.get_stats()
+    stats = await db.get_stats()
     
     text = (
         "📊 Статистика магазина\n\n"
@@ -2193,10 +4574,68 @@ async def show_stats(callback: CallbackQuery):
     
     await callback.message.edit_text(
         text,
-        reply_markup=admin_menu(db.get_admin_level(callback.from_user.id))
+        reply_markup=admin_menu(await db.get_admin_level(callback.from_user.id))
     )
     await callback.answer()
 
+@router.message(Command("rebuild_stats"))
+async def rebuild_stats_command(message: Message):
+    if not await db.is_admin(message.from_user.id):
+        await message.answer("❌ Только для админов!")
+        return
+    
+    drift = await db.rebuild_stats()
+    
+    if not drift:
+        await message.answer("✅ Счётчики статистики совпадают с данными")
+        return
+    
+    text = "🔧 Счётчики статистики пересчитаны:\n\n"
+    for name, (before, after) in sorted(drift.items()):
+        text += f"• {name}: {before} → {after}\n"
+    await message.answer(text)
+
+@router.message(Command("sql_top"))
+async def sql_top_command(message: Message):
+    if not await db.is_admin(message.from_user.id):
+        await message.answer("❌ Только для админов!")
+        return
+    
+    if not SQL_PROFILE:
+        await message.answer("ℹ️ Профилирование SQL выключено (запусти бота с SQL_PROFILE=1)")
+        return
+    
+    top = sql_profiler.top(10)
+    if not top:
+        await message.answer("📭 Запросов пока не было")
+        return
+    
+    text = f"🐢 Топ запросов по суммарному времени (медленные ≥ {SQL_SLOW_MS:g} мс — в slow log):\n\n"
+    for fingerprint, calls, total, avg_ms, max_ms, rows in top:
+        text += (f"• {total * 1000:.1f} мс всего, {calls} выз., ср. {avg_ms:.2f} мс, макс. {max_ms:.2f} мс, "
+                 f"строк {rows}\n{fingerprint[:200]}\n\n")
+    await message.answer(text[:4000])
+
+@router.message(Command("shift"))
+async def shift_command(message: Message):
+    if not await db.is_support_admin(message.from_user.id):
+        await message.answer("❌ Ты не ТП-админ!")
+        return
+    
+    # /shift on | /shift off; без аргумента — переключить
+    arg = message.text.partition(" ")[2].strip().lower()
+    if arg in ("on", "off"):
+        on_shift = arg == "on"
+    else:
+        on_shift = not await db.is_on_shift(message.from_user.id)
+    await db.set_admin_shift(message.from_user.id, on_shift)
+    
+    if on_shift:
+        await message.answer("🟢 Ты на смене — новые заявки будут назначаться тебе")
+    else:
+        await message.answer("⚪️ Смена закончена — новые заявки тебе не придут, "
+                             "назначенные, но не взятые, передаются другим")
+
 # =================== ОБРАБОТКА ЗАКАЗОВ ИЗ САЙТА ===================
 @router.message(F.web_app_data)
 async def handle_web_app_data(message: Message):
@@ -2204,26 +4643,10 @@ async def handle_web_app_data(message: Message):
         data = json.loads(message.web_app_data.data)
         
         if data.get('type') == 'new_order':
-            order_id = db.create_order(
-                message.from_user.id,
-                data['data']['product'],
-                data['data']['quantity'],
-                data['data']['total'],
-                data['data']['currency'],
-                data['data']['username'],
-                data['data'].get('payment_method'),
-                data['data'].get('crypto_bot_link'),
-                data['data'].get('bep20_wallet'),
-                data['data'].get('screenshot')
-            )
-            
-            # Отправляем всем админам (и ТП и Админам)
-            admins = db.get_all_support_admins()
-            
-            for admin in admins:
-                try:
-                    await bot.send_message(
-                        admin[0],
+            # Уведомление всем админам (и ТП и Админам) пишется в outbox вместе с заказом
+            def new_order_notification(order_id):
+                return "send_message", {
+                    "text": (
                         f"🛒 НОВЫЙ ЗАКАЗ #{order_id}\n\n"
                         f"👤 Клиент: {message.from_user.full_name}\n"
                         f"🆔 ID: {message.from_user.id}\n"
@@ -2235,54 +4658,67 @@ async def handle_web_app_data(message: Message):
                         f"Ожидает оплаты и подтверждения!\n"
                         f"Для управления: /order_{order_id}"
                     )
-                except:
-                    pass
+                }
+            
+            due_at = order_due_at(data['data'].get('screenshot'))
+            order_id = await db.create_order(
+                message.from_user.id,
+                data['data']['product'],
+                data['data']['quantity'],
+                data['data']['total'],
+                data['data']['currency'],
+                data['data']['username'],
+                data['data'].get('payment_method'),
+                data['data'].get('crypto_bot_link'),
+                data['data'].get('bep20_wallet'),
+                data['data'].get('screenshot'),
+                admin_notification=new_order_notification,
+                due_at=due_at
+            )
+            outbox_worker.wake()
+            timers.schedule('order', order_id, due_at)
             
             await message.answer(
                 f"✅ Заказ #{order_id} создан!\n\n"
                 f"После оплаты отправь скриншот в этот чат.\n"
                 f"Мы активируем заказ в течение 15 минут.\n\n"
                 f"Спасибо за покупку! 🎉",
-                reply_markup=main_menu(message.from_user.id)
+                reply_markup=await main_menu(message.from_user.id)
             )
     except Exception as e:
         await message.answer(f"❌ Ошибка обработки заказа: {str(e)}")
 
 # =================== КНОПКИ НАЗАД ===================
-@router.callback_query(F.data == "back_to_shop")
+@on_callback("back_to_shop")
 async def back_to_shop(callback: CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.edit_text(
-        "🛍️ Магазин Art Stars\n\n"
-        "Что хочешь купить? 👇",
-        reply_markup=shop_keyboard()
-    )
+    await callback.message.edit_text(SHOP_TEXT, reply_markup=shop_keyboard())
     await callback.answer()
 
-@router.callback_query(F.data == "back_to_main")
+@on_callback("back_to_main")
 async def back_to_main(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.edit_text(
         "✨ Art Stars - Официальный бот\n\n"
         "Выбери действие:",
-        reply_markup=main_menu(callback.from_user.id)
+        reply_markup=await main_menu(callback.from_user.id)
     )
     await callback.answer()
 
-@router.callback_query(F.data == "cancel")
+@on_callback("cancel")
 async def cancel_action(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.answer("❌ Действие отменено", 
-                                reply_markup=main_menu(callback.from_user.id))
+                                reply_markup=await main_menu(callback.from_user.id))
     await callback.answer()
 
-@router.callback_query(F.data == "admin_back")
+@on_callback("admin_back")
 async def admin_back(callback: CallbackQuery):
-    if not db.is_support_admin(callback.from_user.id):
+    if not await db.is_support_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа!")
         return
     
-    admin_level = db.get_admin_level(callback.from_user.id)
+    admin_level = await db.get_admin_level(callback.from_user.id)
     await callback.message.edit_text(
         f"👑 Админ-панель | Уровень: {'Админ' if admin_level >= 2 else 'ТП'}\n\n"
         "Выбери раздел для управления:",
@@ -2290,20 +4726,359 @@ async def admin_back(callback: CallbackQuery):
     )
     await callback.answer()
 
+# =================== WEBHOOK ===================
+class WebhookIngest:
+    """Приём апдейтов по webhook: проверка секрета, ограниченная очередь и пул воркеров.
+
+    Апдейты одного пользователя всегда попадают к одному воркеру, поэтому
+    обрабатываются по порядку. Если очередь заполнена, отвечаем 503 —
+    Telegram доставит апдейт повторно, он не теряется. Тело, которое не разбирается
+    в Update, получает 400: повторять его бессмысленно, а повторы задержали бы следующие апдейты.
+    """
+    def __init__(self, dispatcher, bot, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE,
+                 secret=WEBHOOK_SECRET):
+        self._dp = dispatcher
+        self._bot = bot
+        self._secret = secret
+        self._queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self._workers = []
+    
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker(q)) for q in self._queues]
+    
+    async def handle(self, request):
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self._secret:
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self._bot})
+        except (ValueError, ValidationError) as e:
+            logging.warning(f"Отброшен некорректный апдейт: {e}")
+            return web.Response(status=400)
+        user = getattr(update.event, "from_user", None)
+        shard = (user.id if user else update.update_id) % len(self._queues)
+        try:
+            self._queues[shard].put_nowait(update)
+        except asyncio.QueueFull:
+            return web.Response(status=503)
+        return web.Response()
+    
+    async def _worker(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self._dp.feed_update(self._bot, update)
+            except Exception as e:
+                logging.exception(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                queue.task_done()
+    
+    async def stop(self, timeout=30):
+        """Дорабатывает уже принятые апдейты и останавливает воркеры"""
+        try:
+            await asyncio.wait_for(asyncio.gather(*[q.join() for q in self._queues]), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Не все принятые апдейты обработаны до остановки")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+async def run_webhook():
+    ingest = WebhookIngest(dp, bot)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, ingest.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    ingest.start()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        # Очередь апдейтов у Telegram не сбрасываем — при деплое ничего не теряется
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=False
+        )
+    print(f"🔗 Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # Сначала перестаём принимать апдейты, потом дорабатываем очередь
+        await runner.cleanup()
+        await ingest.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+
 # =================== ЗАПУСК БОТА ===================
+# Как часто проверять, не поменял ли уровни админов или цены другой процесс бота
+ADMIN_CACHE_POLL_SECONDS = float(os.getenv("ADMIN_CACHE_POLL_SECONDS", "5"))
+
+async def admin_cache_watcher():
+    while True:
+        await asyncio.sleep(ADMIN_CACHE_POLL_SECONDS)
+        try:
+            if await db.refresh_admin_cache_if_stale():
+                logging.info("Кэш уровней админов обновлён из БД")
+            if await db.refresh_prices_if_stale():
+                logging.info(f"Цены обновлены из БД, версия {price_catalog.snapshot.version}")
+        except Exception as e:
+            logging.warning(f"Не удалось проверить кэш админов: {e}")
+
+# Фоновые донастройки данных после миграций: пачка строк за транзакцию, пауза между пачками
+BACKFILL_BATCH = int(os.getenv("BACKFILL_BATCH", "500"))
+BACKFILL_PAUSE_SECONDS = float(os.getenv("BACKFILL_PAUSE_SECONDS", "0.05"))
+
+async def backfill_worker():
+    try:
+        while await db.run_backfill_batch(BACKFILL_BATCH):
+            await asyncio.sleep(BACKFILL_PAUSE_SECONDS)
+    except Exception as e:
+        logging.warning(f"Фоновая донастройка данных прервана: {e}")
+
+# Сколько секунд назначенный админ может не брать заявку, прежде чем её передадут следующему
+TICKET_RESPONSE_SECONDS = float(os.getenv("TICKET_RESPONSE_SECONDS", "300"))
+TICKET_ROUTE_ATTEMPTS = int(os.getenv("TICKET_ROUTE_ATTEMPTS", "3"))
+TICKET_ESCALATION_POLL_SECONDS = float(os.getenv("TICKET_ESCALATION_POLL_SECONDS", "30"))
+
+async def ticket_escalation_worker():
+    while True:
+        await asyncio.sleep(TICKET_ESCALATION_POLL_SECONDS)
+        try:
+            escalated = await db.escalate_stale_tickets(time.time() - TICKET_RESPONSE_SECONDS,
+                                                        TICKET_ROUTE_ATTEMPTS, escalation_notification)
+            if escalated:
+                logging.info(f"Передано другим админам заявок без ответа: {escalated}")
+                outbox_worker.wake()
+        except Exception as e:
+            logging.warning(f"Не удалось эскалировать заявки: {e}")
+
 async def main():
     print("🤖 Art Stars Bot запускается...")
     print(f"👑 Главный админ: {ADMIN_ID}")
     print(f"🌐 Сайт: {WEBAPP_URL}")
-    print("💰 Курсы:")
-    print(f"   ⭐ Звезда: {PRICES['star_rate']}₽")
-    print(f"   💎 TON: {PRICES['ton_rate']}₽")
-    print(f"   👑 Premium: {PRICES['premium_3']}/{PRICES['premium_6']}/{PRICES['premium_12']} USDT")
+    prices = price_catalog.snapshot
+    print(f"💰 Курсы (версия {prices.version}):")
+    print(f"   ⭐ Звезда: {prices['star_rate']}₽")
+    print(f"   💎 TON: {prices['ton_rate']}₽")
+    print(f"   👑 Premium: {prices['premium_3']}/{prices['premium_6']}/{prices['premium_12']} USDT")
     print("🚀 Бот готов к работе!")
     
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    cache_watcher = asyncio.create_task(admin_cache_watcher())
+    backfill = asyncio.create_task(backfill_worker())
+    escalation = asyncio.create_task(ticket_escalation_worker())
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    outbox_worker.start()
+    storage.start()
+    timers.start()
+    loop_watchdog.start()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        cache_watcher.cancel()
+        backfill.cancel()
+        escalation.cancel()
+        loop_watchdog.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await timers.stop()
+        await outbox_worker.stop()
+        await db.close()
+
+async def rebuild_stats_cli():
+    drift = await db.rebuild_stats()
+    if drift:
+        for name, (before, after) in sorted(drift.items()):
+            print(f"   {name}: {before} → {after}")
+    else:
+        print("✅ Счётчики совпадают с таблицами")
+    await db.close()
+
+# Каждый метод Database с примерными аргументами и таблицами, которые он читает целиком намеренно
+# (маленькие справочники, загружаемые в кэш). rebuild_stats и миграции — обслуживание, не проверяются.
+QUERY_PLAN_CHECKS = [
+    ('load_prices', (), {'settings'}),
+    ('update_price', ('star_rate', 1.5, 1), {'settings'}),
+    ('refresh_prices_if_stale', (), set()),
+    ('add_user', (1, 'user', 'User'), set()),
+    ('load_admin_levels', (), {'support_admins'}),
+    ('refresh_admin_cache_if_stale', (), set()),
+    ('add_support_admin', (2, 1, 1), set()),
+    ('update_admin_level', (2, 2), set()),
+    ('get_all_support_admins', (), set()),
+    ('create_support_ticket', (1, 'User', 'text', None, None,
+                               lambda ticket_id: ('send_message', {'text': 'x'})), {'support_admins'}),
+    ('get_new_tickets_page', (), set()),
+    ('get_new_tickets_page', (1, True), set()),
+    ('transition_ticket', (1, 'take', 2, 'Admin', ('send_message', {'text': 'x'})), set()),
+    ('get_my_tickets_page', (2,), set()),
+    ('get_my_tickets_page', (2, 1), set()),
+    ('add_ticket_reply', (1, 2, 'Admin', 'text'), set()),
+    ('get_ticket_replies', (1,), set()),
+    ('search_tickets', ('не пришли звёзды',), set()),
+    ('get_ticket_by_id', (1,), set()),
+    ('get_tickets_summary', (), set()),
+    ('get_latest_tickets', (), set()),
+    ('transition_ticket', (1, 'close'), set()),
+    ('bulk_transition_tickets', ([1, 2], 'close', lambda row: ('send_message', {'text': 'x'})), set()),
+    ('get_admin_loads', (), {'support_admins'}),
+    ('set_admin_shift', (2, False), set()),
+    ('is_on_shift', (2,), set()),
+    ('escalate_stale_tickets', (time.time(), 3, lambda ticket, senior: ('send_message', {'text': 'x'})),
+     {'support_admins'}),
+    ('create_order', (1, 'Stars', 100, 150, 'RUB', 'user', 'crypto_bot', None, None, None, 1,
+                      lambda order_id: ('send_message', {'text': 'x'})), {'support_admins'}),
+    ('create_order', (1, 'Stars', 100, 150, 'RUB', 'user', 'crypto_bot', None, None, None, 1,
+                      None, time.time()), set()),
+    ('get_user_orders_page', (1,), set()),
+    ('get_user_orders_page', (1, 1, True), set()),
+    ('get_pending_orders_page', (), set()),
+    ('get_pending_orders_page', (1,), set()),
+    ('get_order_by_id', (1,), set()),
+    ('get_orders_summary', (), set()),
+    ('get_latest_orders', (), set()),
+    ('set_order_comment', (1, 'ok', 0, ('send_message', {'text': 'x'})), set()),
+    ('transition_order', (1, 'complete', 2, 'ok', ('send_message', {'text': 'x'})), set()),
+    ('transition_order', (1, 'cancel'), set()),
+    ('bulk_transition_orders', ([1, 2, 3], 'complete', 2, 'ok',
+                                lambda row: ('send_message', {'text': 'x'})), set()),
+    ('enqueue_notification', (1, 'send_message'), set()),
+    ('get_due_outbox', (time.time(), 10), set()),
+    ('get_due_timers', (time.time(), 100), set()),
+    ('fire_timers', ([('order', 1), ('ticket', 1)], time.time(),
+                     lambda event, row: ('send_message', {'text': 'x'})), {'support_admins'}),
+    ('complete_outbox', ([1], [(2, 'error', time.time() + 60)]), set()),
+    ('get_outbox_progress', (1, 100), set()),
+    ('save_fsm_records', ([('1:1', 'State:x', '{}', time.time())],), set()),
+    ('load_fsm_record', ('1:1',), set()),
+    ('expire_fsm_records', (time.time() - 60,), set()),
+    ('get_stats', (), {'stats_counters'}),
+    ('remove_support_admin', (2,), set()),
+    ('run_backfill_batch', (100,), set()),
+]
+
+def plan_problems(plan, full_scan_ok):
+    """Полные сканы таблиц и временные B-деревья для сортировки в выводе EXPLAIN QUERY PLAN"""
+    problems = []
+    for detail in plan:
+        if 'USE TEMP B-TREE' in detail:
+            problems.append(detail)
+        # SCAN ... VIRTUAL TABLE — поиск FTS5 по своему индексу, а не перебор строк
+        elif detail.startswith('SCAN ') and ' USING ' not in detail and ' VIRTUAL TABLE ' not in detail:
+            table = detail.split()[1]
+            if table != 'CONSTANT' and table not in full_scan_ok:
+                problems.append(detail)
+    return problems
+
+def check_query_plans():
+    """Выполняет все запросы Database на временной базе и проверяет их планы.
+
+    Возвращает список (метод, SQL, проблемные строки плана); пустой список — всё идёт по индексам.
+    """
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database(os.path.join(tmp, 'plans.db'), readers=1)
+        statements = []
+        database.conn.set_trace_callback(statements.append)
+        with database.pool.reader() as conn:
+            conn.set_trace_callback(statements.append)
+        
+        for name, args, full_scan_ok in QUERY_PLAN_CHECKS:
+            statements.clear()
+            getattr(database, name)(*args)
+            for sql in statements:
+                # Строки "-- ..." — тела триггеров, остальное (BEGIN, COMMIT, PRAGMA) планов не имеет
+                if sql.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+                    continue
+                # Служебные запросы FTS5 к своим таблицам ('main'.'ticket_search_data' и т.п.)
+                if "'main'." in sql:
+                    continue
+                plan = [row[3] for row in database.conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+                problems = plan_problems(plan, full_scan_ok)
+                if problems:
+                    failures.append((name, ' '.join(sql.split()), problems))
+        
+        database.conn.set_trace_callback(None)
+        database.pool.close()
+    return failures
+
+def check_bulk_transitions():
+    """Массовый переход по строкам, которые перевели уже после чтения: они должны быть пропущены.
+
+    Временный триггер отменяет заказ 3, пока executemany обновляет заказ 2, — то есть между
+    чтением статусов и UPDATE заказа 3. Без условия на статус в UPDATE отменённый заказ стал бы
+    выполненным и клиент получил бы уведомление. Возвращает список найденных ошибок.
+    """
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database(os.path.join(tmp, 'bulk.db'), readers=1)
+        for user_id in range(1, 5):
+            database.create_order(user_id, 'Stars', 100, 150, 'RUB', f'user{user_id}')
+        database.conn.execute('''
+            CREATE TEMP TRIGGER cancel_during_bulk AFTER UPDATE OF status ON orders WHEN new.id = 2 BEGIN
+                UPDATE orders SET status = 'cancelled' WHERE id = 3;
+            END
+        ''')
+        notification = lambda order: ('send_message', {'text': f'order {order[0]}'})
+        done, refused, outbox_range = database.bulk_transition_orders([1, 2, 3, 4], 'complete', 1, 'ok', notification)
+        statuses = {row[0]: row[1] for row in database.conn.execute('SELECT id, status FROM orders')}
+        notified = [json.loads(row[0])['text'] for row in database.conn.execute('SELECT payload FROM outbox ORDER BY id')]
+        if done != [1, 2, 4]:
+            problems.append(f"перешли {done}, ожидались [1, 2, 4]")
+        if refused != {3: 'cancelled'}:
+            problems.append(f"отказы {refused}, ожидалось {{3: 'cancelled'}}")
+        if statuses[3] != 'cancelled':
+            problems.append(f"заказ 3 в статусе {statuses[3]} — UPDATE перезаписал отмену")
+        if notified != ['order 1', 'order 2', 'order 4']:
+            problems.append(f"уведомления {notified}")
+        if database.conn.in_transaction:
+            problems.append("транзакция осталась открытой")
+        database.pool.close()
+    return problems
+
+def check_transitions_cli():
+    problems = check_bulk_transitions()
+    for problem in problems:
+        print(f"❌ bulk_transition_orders: {problem}")
+    if problems:
+        sys.exit(1)
+    print("✅ Массовые переходы пропускают строки, изменённые после чтения")
+
+def slow_queries_cli(limit):
+    top = read_slow_log(limit=limit)
+    if not top:
+        print(f"📭 В {SQL_SLOW_LOG} нет медленных запросов")
+        return
+    for fingerprint, calls, total_ms, max_ms in top:
+        print(f"{total_ms:10.1f} мс  {calls:6} выз.  макс. {max_ms:8.1f} мс  {fingerprint}")
+
+def check_plans_cli():
+    failures = check_query_plans()
+    for name, sql, problems in failures:
+        print(f"❌ {name}: {sql}")
+        for detail in problems:
+            print(f"   {detail}")
+    if failures:
+        sys.exit(1)
+    print(f"✅ Планы запросов в порядке ({len(QUERY_PLAN_CHECKS)} вызовов)")
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
+    # python Bot.py rebuild-stats — пересчитать счётчики статистики и выйти
+    if sys.argv[1:2] == ["rebuild-stats"]:
+        asyncio.run(rebuild_stats_cli())
+    # python Bot.py check-plans — проверить, что все запросы идут по индексам (код выхода 1 при ошибке)
+    elif sys.argv[1:2] == ["check-plans"]:
+        check_plans_cli()
+    # python Bot.py check-transitions — массовые переходы не трогают строки, изменённые после чтения
+    elif sys.argv[1:2] == ["check-transitions"]:
+        check_transitions_cli()
+    # python Bot.py slow-queries [N] — топ-N запросов из slow log (пишется при SQL_PROFILE=1)
+    elif sys.argv[1:2] == ["slow-queries"]:
+        slow_queries_cli(int(sys.argv[2]) if len(sys.argv) > 2 else 10)
+    else:
+        asyncio.run(main())
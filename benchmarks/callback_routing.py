@@ -0,0 +1,63 @@
+"""Замер маршрутизации нажатий кнопок: цепочка фильтров F.data против таблицы действий.
+
+Запуск: python benchmarks/callback_routing.py
+
+Для каждого числа кнопок N регистрируются N действий вида admin_btn_<i> (и N хендлеров
+с фильтром F.data == ... для сравнения), после чего меряется время выбора хендлера для
+кнопки из середины списка. Цепочка фильтров растёт линейно с N, таблица — нет.
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+# Бот при импорте открывает базу — кладём её во временный каталог
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiogram import F
+from aiogram.types import CallbackQuery, User
+
+import Bot
+
+SIZES = (10, 50, 200, 1000)
+REPEAT = 20000
+
+def make_callback(data):
+    return CallbackQuery(id="1", from_user=User(id=1, is_bot=False, first_name="Bench"),
+                         chat_instance="bench", data=data)
+
+def linear_route(filters, callback):
+    # Так выбирает хендлер роутер aiogram: фильтры проверяются по очереди до первого совпадения
+    for handler, magic in filters:
+        if magic.resolve(callback):
+            return handler
+    return None
+
+def table_route(callback):
+    action, item_id = Bot.unpack_callback(callback.data)
+    return Bot.CALLBACK_HANDLERS.get(action)
+
+async def handler(callback):
+    pass
+
+def main():
+    print(f"{'кнопок':>8} {'F.data, мкс':>12} {'таблица, мкс':>13}")
+    for size in SIZES:
+        actions = [f"admin_btn_{i}" for i in range(size)]
+        filters = [(handler, F.data == action) for action in actions]
+        registered = Bot.on_callback(*actions)(handler)
+        
+        callback = make_callback(Bot.pack_callback(actions[size // 2], 42))
+        legacy_callback = make_callback(actions[size // 2])
+        assert table_route(callback) is not None and linear_route(filters, legacy_callback) is registered
+        
+        linear = timeit.timeit(lambda: linear_route(filters, legacy_callback), number=REPEAT) / REPEAT
+        table = timeit.timeit(lambda: table_route(callback), number=REPEAT) / REPEAT
+        print(f"{size:>8} {linear * 1e6:>12.2f} {table * 1e6:>13.2f}")
+        
+        for action in actions:
+            del Bot.CALLBACK_HANDLERS[action]
+
+if __name__ == "__main__":
+    main()
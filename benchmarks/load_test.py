@@ -0,0 +1,278 @@
+"""Нагрузочный прогон бота без Telegram: диспетчер против локального фейкового Bot API.
+
+Запуск: python benchmarks/load_test.py [--rate 200] [--duration 10] [--mix start=5,checkout=3,admin=2,support=1]
+                                       [--users 200] [--max-p99-ms 0]
+
+Бот импортируется с TELEGRAM_API_URL, указывающим на заглушку на 127.0.0.1, которая отвечает
+на sendMessage, sendPhoto, editMessageText, answerCallbackQuery (и любой другой метод — true).
+Апдейты подаются в dp.feed_update с заданной частотой (открытая нагрузка: следующий апдейт
+уходит по расписанию, не дожидаясь ответа на предыдущие). Сценарии:
+
+    start     — /start от нового пользователя
+    checkout  — /start → buy_stars → количество (Form.waiting_quantity) → pay:* → скриншот
+    support   — /start → «🆘 Техподдержка» → текст заявки
+    admin     — админ листает панель: статистика, новые/все заказы, страницы, заявки,
+                /order_<id> и /ticket_<id>
+
+Шаги одного пользователя идут строго по очереди, разные пользователи — параллельно.
+В отчёте: пропускная способность, p50/p99 обработки апдейта по сценариям, время в БД
+(из метрик бота) и вызовы Bot API. С --max-p99-ms прогон завершается с кодом 1,
+если общий p99 превысил порог, — для проверки перед выкладкой.
+
+Многие хендлеры ловят исключения сами и отвечают «❌ Ошибка…» — такой ответ заглушка
+считает ошибкой, и прогон тоже завершается с кодом 1: иначе сломанный хендлер
+(например, /ticket_<id>) выглядел бы в отчёте как быстрый и успешный.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+API_PORT = free_port()
+
+# Бот читает настройки при импорте: своя база, заглушка вместо api.telegram.org, без /metrics
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "load.db"))
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{API_PORT}"
+os.environ["METRICS_PORT"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiohttp import web
+from aiogram.types import Update
+
+import Bot
+
+# =================== ЗАГЛУШКА BOT API ===================
+class FakeBotApi:
+    """Отвечает как Bot API и считает вызовы по методам"""
+    def __init__(self):
+        self.calls = {}
+        self.error_replies = []  # тексты ответов «❌ Ошибка…» — исключения, которые хендлер проглотил
+        self._message_ids = itertools.count(1)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        form = await request.post()
+        text = form.get("text") or form.get("caption") or ""
+        if text.startswith("❌ Ошибка"):
+            self.error_replies.append(text)
+        if method in ("sendMessage", "sendPhoto", "sendDocument", "editMessageText"):
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(form.get("chat_id") or 1), "type": "private"},
+            }
+            if form.get("text"):
+                result["text"] = form["text"]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", API_PORT).start()
+        return runner
+
+# =================== СЦЕНАРИИ ===================
+_ids = itertools.count(1)
+_user_ids = itertools.count(10_000_000)
+_tickets = itertools.count(1)
+_last_ticket = 0  # номер последней заявки, которую отправил сценарий support
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"Load {uid}", "username": f"load{uid}"}
+
+def message(uid, text=None, **extra):
+    payload = {"message_id": next(_ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": _user(uid)}
+    if text is not None:
+        payload["text"] = text
+    payload.update(extra)
+    return Update.model_validate({"update_id": next(_ids), "message": payload}, context={"bot": Bot.bot})
+
+def button(uid, data):
+    return Update.model_validate({"update_id": next(_ids), "callback_query": {
+        "id": str(next(_ids)), "from": _user(uid), "chat_instance": "load", "data": data,
+        "message": {"message_id": next(_ids), "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"}, "text": "…"}
+    }}, context={"bot": Bot.bot})
+
+def start_scenario():
+    uid = next(_user_ids)
+    yield message(uid, "/start")
+
+def checkout_scenario():
+    uid = next(_user_ids)
+    yield message(uid, "/start")
+    yield button(uid, "buy_stars")
+    yield message(uid, str(random.choice((100, 500, 1000, 5000, 25000))))
+    yield button(uid, Bot.pack_callback("pay", random.choice(("crypto_bot", "bep20"))))
+    yield message(uid, photo=[{"file_id": f"load-{uid}", "file_unique_id": f"u{uid}", "width": 1, "height": 1}])
+
+def support_scenario():
+    global _last_ticket
+    uid = next(_user_ids)
+    yield message(uid, "/start")
+    yield message(uid, "🆘 Техподдержка")
+    _last_ticket = next(_tickets)
+    yield message(uid, f"Не пришёл заказ, нагрузочный тест {uid}")
+
+def admin_scenario():
+    uid = Bot.ADMIN_ID
+    yield message(uid, "/start")
+    yield button(uid, "admin_stats")
+    yield button(uid, "admin_pending_orders")
+    # Курсор — id где-то в середине уже созданных заказов
+    yield button(uid, Bot.pack_callback("page_pending_next", random.randint(1, max(next(_ids), 2))))
+    yield button(uid, "admin_all_orders")
+    yield button(uid, "admin_new_tickets")
+    yield button(uid, "all_tickets")
+    # Карточки по командам из уведомлений админам; несуществующий номер — тоже нормальный ответ
+    yield message(uid, f"/order_{random.randint(1, max(next(_ids) // 10, 1))}")
+    yield message(uid, f"/ticket_{random.randint(1, max(_last_ticket, 1))}")
+
+SCENARIOS = {"start": start_scenario, "checkout": checkout_scenario, "support": support_scenario,
+             "admin": admin_scenario}
+
+# =================== ПРОГОН ===================
+class Session:
+    __slots__ = ("name", "steps", "busy")
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = collections.deque(SCENARIOS[name]())
+        self.busy = False
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def run_load(rate, duration, mix, max_users):
+    names, weights = zip(*mix.items())
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    active = []
+    in_flight = set()
+    stalled_ticks = 0
+
+    async def send(session, update):
+        start = time.perf_counter()
+        try:
+            await Bot.dp.feed_update(Bot.bot, update)
+        except Exception:
+            errors[session.name] += 1
+        latencies[session.name].append(time.perf_counter() - start)
+        session.busy = False
+        if not session.steps:
+            active.remove(session)
+
+    started = time.perf_counter()
+    for tick in range(int(rate * duration)):
+        delay = started + tick / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        idle = [session for session in active if not session.busy]
+        if len(active) < max_users:
+            idle.append(Session(random.choices(names, weights)[0]))
+        if not idle:
+            # Все пользователи ждут ответа на прошлый шаг — бот не успевает
+            stalled_ticks += 1
+            continue
+
+        session = random.choice(idle)
+        if session not in active:
+            active.append(session)
+        session.busy = True
+        task = asyncio.create_task(send(session, session.steps.popleft()))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    if in_flight:
+        await asyncio.wait(in_flight)
+    return latencies, errors, stalled_ticks, time.perf_counter() - started
+
+def db_time():
+    """(секунд в БД всего, [(метод, вызовов, секунд)]) из гистограммы bot_db_seconds"""
+    per_method = []
+    for labels, histogram in Bot.metrics.histograms.get("bot_db_seconds", {}).items():
+        per_method.append((labels.split('"')[1], histogram.count, histogram.sum))
+    per_method.sort(key=lambda item: item[2], reverse=True)
+    return sum(seconds for _, _, seconds in per_method), per_method
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"неизвестный сценарий {name!r}, есть: {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+async def main(args):
+    api = FakeBotApi()
+    api_runner = await api.start()
+    Bot.outbox_worker.start()
+    Bot.storage.start()
+    try:
+        latencies, errors, stalled_ticks, elapsed = await run_load(args.rate, args.duration, args.mix, args.users)
+        # Даём outbox разослать уведомления, поставленные последними апдейтами
+        await asyncio.sleep(1)
+    finally:
+        await Bot.outbox_worker.stop()
+        await Bot.db.close()
+        await Bot.bot.session.close()
+        await api_runner.cleanup()
+
+    everything = [value for samples in latencies.values() for value in samples]
+    print(f"📦 Апдейтов: {len(everything)} за {elapsed:.1f} с — {len(everything) / elapsed:.0f}/с "
+          f"(цель {args.rate:g}/с, пропущено тиков: {stalled_ticks})")
+    print(f"{'сценарий':>10} {'апдейтов':>9} {'ошибок':>7} {'p50, мс':>8} {'p99, мс':>8} {'max, мс':>8}")
+    for name, samples in [*latencies.items(), ("всего", everything)]:
+        errors_count = errors.get(name, sum(errors.values()))
+        print(f"{name:>10} {len(samples):>9} {errors_count:>7} {percentile(samples, 0.5) * 1000:>8.2f} "
+              f"{percentile(samples, 0.99) * 1000:>8.2f} {max(samples, default=0) * 1000:>8.2f}")
+
+    total_db, per_method = db_time()
+    print(f"\n🗄 Время в БД: {total_db:.2f} с, {total_db / max(len(everything), 1) * 1000:.2f} мс на апдейт")
+    for method, calls, seconds in per_method[:8]:
+        print(f"   {method:<32} {calls:>7} выз. {seconds * 1000 / calls:>8.2f} мс/выз.")
+    print("\n📡 Bot API: " + ", ".join(f"{method} {count}" for method, count in sorted(api.calls.items())))
+    
+    if api.error_replies:
+        print(f"\n❌ Ответов с ошибкой: {len(api.error_replies)}")
+        for text in sorted(set(api.error_replies))[:5]:
+            print(f"   {text[:120]}")
+        return 1
+
+    p99 = percentile(everything, 0.99) * 1000
+    if args.max_p99_ms and p99 > args.max_p99_ms:
+        print(f"\n❌ p99 {p99:.2f} мс больше порога {args.max_p99_ms:g} мс")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против фейкового Bot API")
+    parser.add_argument("--rate", type=float, default=200, help="апдейтов в секунду")
+    parser.add_argument("--duration", type=float, default=10, help="секунд нагрузки")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("start=5,checkout=3,admin=2,support=1"),
+                        help="веса сценариев, например start=5,checkout=3,admin=2,support=1")
+    parser.add_argument("--users", type=int, default=200, help="одновременных пользователей")
+    parser.add_argument("--max-p99-ms", type=float, default=0, help="порог p99 для кода возврата 1")
+    sys.exit(asyncio.run(main(parser.parse_args())))